@@ -1 +1,8 @@
-from .tsne import TSNE, TSNEEmbedding, PartialTSNEEmbedding, OptimizationInterrupt
+from .tsne import (
+    TSNE,
+    TSNEEmbedding,
+    PartialTSNEEmbedding,
+    BatchedTSNEEmbedding,
+    OptimizationHandle,
+    OptimizationInterrupt,
+)
@@ -5,30 +5,29 @@
 # cython: initializedcheck=False
 # cython: warn.undeclared=True
 # cython: language_level=3
+cimport numpy as np
 from .quad_tree cimport QuadTree
 
 
-cpdef double[:, ::1] compute_gaussian_perplexity(
-    double[:, :] distances,
-    double[:] desired_perplexities,
-    double perplexity_tol=*,
-    Py_ssize_t max_iter=*,
-    Py_ssize_t num_threads=*,
-)
+# Sparse matrix index type. scipy switches `indices` and `indptr` to 64-bit
+# integers once the number of stored entries no longer fits into 32 bits, so
+# every kernel walking a CSR matrix has to accept both
+ctypedef fused sparse_index_t:
+    np.int32_t
+    np.int64_t
+
 
-cpdef tuple estimate_positive_gradient_nn(
-    int[:] indices,
-    int[:] indptr,
-    double[:] P_data,
+cpdef double estimate_negative_gradient_bh(
+    QuadTree tree,
     double[:, ::1] embedding,
-    double[:, ::1] reference_embedding,
     double[:, ::1] gradient,
+    double theta=*,
     double dof=*,
     Py_ssize_t num_threads=*,
-    bint should_eval_error=*,
-)
+    bint pairwise_normalization=*,
+) except? -1
 
-cpdef double estimate_negative_gradient_bh(
+cpdef double estimate_negative_gradient_bh_dual(
     QuadTree tree,
     double[:, ::1] embedding,
     double[:, ::1] gradient,
@@ -36,7 +35,8 @@ cpdef double estimate_negative_gradient_bh(
     double dof=*,
     Py_ssize_t num_threads=*,
     bint pairwise_normalization=*,
-)
+    QuadTree reference_tree=*,
+) except? -1
 
 cpdef double estimate_negative_gradient_fft_1d(
     double[::1] embedding,
@@ -44,6 +44,7 @@ cpdef double estimate_negative_gradient_fft_1d(
     Py_ssize_t n_interpolation_points=*,
     Py_ssize_t min_num_intervals=*,
     double ints_in_interval=*,
+    dict timings=*,
 )
 
 cpdef double estimate_negative_gradient_fft_1d_with_reference(
@@ -53,6 +54,7 @@ cpdef double estimate_negative_gradient_fft_1d_with_reference(
     Py_ssize_t n_interpolation_points=*,
     Py_ssize_t min_num_intervals=*,
     double ints_in_interval=*,
+    dict timings=*,
 )
 
 cpdef double estimate_negative_gradient_fft_2d(
@@ -61,6 +63,7 @@ cpdef double estimate_negative_gradient_fft_2d(
     Py_ssize_t n_interpolation_points=*,
     Py_ssize_t min_num_intervals=*,
     double ints_in_interval=*,
+    dict timings=*,
 )
 
 cpdef double estimate_negative_gradient_fft_2d_with_reference(
@@ -70,4 +73,5 @@ cpdef double estimate_negative_gradient_fft_2d_with_reference(
     Py_ssize_t n_interpolation_points=*,
     Py_ssize_t min_num_intervals=*,
     double ints_in_interval=*,
+    dict timings=*,
 )
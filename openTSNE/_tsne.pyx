@@ -7,11 +7,14 @@
 # cython: language_level=3
 cimport numpy as np
 import numpy as np
-from cython.parallel import prange, parallel
+from time import perf_counter
+from cython.parallel import prange, parallel, threadid
 from cpython.mem cimport PyMem_Malloc, PyMem_Free
-from libc.stdlib cimport malloc, free
+from libc.stdlib cimport malloc, calloc, free
+from libc.string cimport memset
+from libc.stdint cimport uint64_t
 
-from .quad_tree cimport QuadTree, Node, is_duplicate
+from .quad_tree cimport QuadTree, is_duplicate
 from ._matrix_mul.matrix_mul cimport matrix_multiply_fft_1d, matrix_multiply_fft_2d
 
 
@@ -28,19 +31,28 @@ cdef extern from "math.h":
     double INFINITY
 
 
-cpdef double[:, ::1] compute_gaussian_perplexity(
-    double[:, :] distances,
+cpdef double[::1] compute_gaussian_perplexity(
+    double[:] distances,
+    sparse_index_t[:] indptr,
     double[:] desired_perplexities,
     double perplexity_tol=1e-8,
     Py_ssize_t max_iter=200,
     Py_ssize_t num_threads=1,
 ):
+    """Calibrate the Gaussian kernels of a CSR distance graph.
+
+    The distances to the neighbors of point `i` are stored in
+    `distances[indptr[i]:indptr[i + 1]]`, so every point may have a different
+    number of neighbors. Returns the row-normalized conditional probabilities,
+    aligned with `distances`.
+
+    """
     cdef:
-        Py_ssize_t n_samples = distances.shape[0]
+        Py_ssize_t n_samples = indptr.shape[0] - 1
         Py_ssize_t n_scales = desired_perplexities.shape[0]
-        Py_ssize_t k_neighbors = distances.shape[1]
-        double[:, ::1] P = np.zeros_like(distances, dtype=float, order="C")
-        double[:, :, ::1] multiscale_P = np.zeros((n_samples, n_scales, k_neighbors))
+        Py_ssize_t n_edges = distances.shape[0]
+        double[::1] P = np.zeros(n_edges, dtype=float)
+        double[:, ::1] multiscale_P = np.zeros((n_scales, n_edges))
         double[:, ::1] tau = np.ones((n_samples, n_scales))
 
         Py_ssize_t i, j, h, iteration
@@ -52,21 +64,25 @@ cpdef double[:, ::1] compute_gaussian_perplexity(
         num_threads = 1
 
     for i in prange(n_samples, nogil=True, schedule="guided", num_threads=num_threads):
-        min_tau, max_tau = -INFINITY, INFINITY
+        # Points without any neighbors have no distribution to calibrate
+        if indptr[i] == indptr[i + 1]:
+            continue
 
         # For every scale find a precision tau that fits the perplexity
         for h in range(n_scales):
+            min_tau, max_tau = -INFINITY, INFINITY
+
             for iteration in range(max_iter):
                 sum_Pi, sum_PiDj = 0, 0
                 sqrt_tau = sqrt(tau[i, h])
 
-                for j in range(k_neighbors):
-                    multiscale_P[i, h, j] = sqrt_tau * exp(-distances[i, j] ** 2 * tau[i, h] / 2)
-                    sum_Pi = sum_Pi + multiscale_P[i, h, j]
+                for j in range(indptr[i], indptr[i + 1]):
+                    multiscale_P[h, j] = sqrt_tau * exp(-distances[j] ** 2 * tau[i, h] / 2)
+                    sum_Pi = sum_Pi + multiscale_P[h, j]
                 sum_Pi = sum_Pi + EPSILON
 
-                for j in range(k_neighbors):
-                    sum_PiDj = sum_PiDj + multiscale_P[i, h, j] / sum_Pi * distances[i, j] ** 2
+                for j in range(indptr[i], indptr[i + 1]):
+                    sum_PiDj = sum_PiDj + multiscale_P[h, j] / sum_Pi * distances[j] ** 2
 
                 entropy = tau[i, h] / 2 * sum_PiDj + log(sum_Pi) - log(tau[i, h]) / 2
                 entropy_diff = entropy - desired_entropies[h]
@@ -89,29 +105,366 @@ cpdef double[:, ::1] compute_gaussian_perplexity(
 
         # Get the probability of the mixture of Gaussians with different precisions
         sum_Pi = 0
-        for j in range(k_neighbors):
+        for j in range(indptr[i], indptr[i + 1]):
             for h in range(n_scales):
-                P[i, j] = P[i, j] + multiscale_P[i, h, j]
-                sum_Pi = sum_Pi + multiscale_P[i, h, j]
+                P[j] = P[j] + multiscale_P[h, j]
+                sum_Pi = sum_Pi + multiscale_P[h, j]
 
         # Perform row-normalization
-        for j in range(k_neighbors):
-            P[i, j] /= sum_Pi
+        for j in range(indptr[i], indptr[i + 1]):
+            P[j] /= sum_Pi
+
+    return P
+
+
+cpdef double[::1] compute_kernel_affinities(
+    double[:] distances,
+    sparse_index_t[:] indptr,
+    str kernel="gaussian",
+    double sigma=1,
+    Py_ssize_t num_threads=1,
+):
+    """Compute row-normalized fixed-bandwidth kernel values on a CSR graph.
+
+    Supported kernels are ``gaussian``, with bandwidth `sigma`, ``adaptive``,
+    a Gaussian with bandwidth `sigma` times the distance to the furthest
+    neighbor of each point, and ``uniform``, which gives all the neighbors
+    of a point the same affinity.
+
+    """
+    cdef:
+        Py_ssize_t n_samples = indptr.shape[0] - 1
+        double[::1] P = np.zeros(distances.shape[0], dtype=float)
+        int kernel_type
+
+        Py_ssize_t i, j
+        double min_dist_sq, max_dist, bandwidth, sum_Pi
+
+    if kernel == "gaussian":
+        kernel_type = 0
+    elif kernel == "adaptive":
+        kernel_type = 1
+    elif kernel == "uniform":
+        kernel_type = 2
+    else:
+        raise ValueError("Unrecognized kernel `%s`." % kernel)
+
+    if num_threads < 1:
+        num_threads = 1
+
+    for i in prange(n_samples, nogil=True, schedule="guided", num_threads=num_threads):
+        if indptr[i] == indptr[i + 1]:
+            continue
+
+        if kernel_type == 2:
+            for j in range(indptr[i], indptr[i + 1]):
+                P[j] = 1. / (indptr[i + 1] - indptr[i])
+            continue
+
+        min_dist_sq, max_dist = INFINITY, 0
+        for j in range(indptr[i], indptr[i + 1]):
+            min_dist_sq = min(min_dist_sq, distances[j] ** 2)
+            max_dist = fmax(max_dist, distances[j])
+
+        bandwidth = sigma
+        if kernel_type == 1:
+            bandwidth = sigma * max_dist
+
+        # Shifting the exponent by the nearest neighbor doesn't change the
+        # normalized affinities, but prevents them from underflowing to zero
+        sum_Pi = 0
+        for j in range(indptr[i], indptr[i + 1]):
+            if bandwidth > 0:
+                P[j] = exp(-(distances[j] ** 2 - min_dist_sq) / (2 * bandwidth ** 2))
+            else:
+                P[j] = 1
+            sum_Pi = sum_Pi + P[j]
+
+        for j in range(indptr[i], indptr[i + 1]):
+            P[j] /= sum_Pi
 
     return P
 
 
+cpdef tuple symmetrize_csr(
+    sparse_index_t[:] indices,
+    sparse_index_t[:] indptr,
+    double[:] data,
+    Py_ssize_t num_threads=1,
+):
+    """Compute (P + P^T) / 2 of a square CSR matrix P.
+
+    The transpose is built with a counting sort, which leaves its rows
+    sorted. The rows of P are sorted in parallel, and then merged with the
+    rows of the transpose. Like scipy, the result has sorted indices, sums up
+    duplicate entries and leaves out the entries summing to zero. Returns the
+    `data`, `indices` and `indptr` arrays of the result.
+
+    """
+    cdef:
+        Py_ssize_t n_samples = indptr.shape[0] - 1
+        Py_ssize_t nnz = indptr[n_samples]
+        np.int64_t[::1] T_indices = np.empty(nnz, dtype=np.int64)
+        np.int64_t[::1] T_indptr = np.empty(n_samples + 1, dtype=np.int64)
+        double[::1] T_data = np.empty(nnz, dtype=float)
+        np.int64_t[::1] T_position = np.empty(n_samples, dtype=np.int64)
+        np.int64_t[::1] P_indices = np.empty(nnz, dtype=np.int64)
+        double[::1] P_data = np.empty(nnz, dtype=float)
+        np.int64_t[::1] S_indptr = np.zeros(n_samples + 1, dtype=np.int64)
+        np.int64_t[::1] S_indices
+        double[::1] S_data
+
+        Py_ssize_t i, j
+
+    if num_threads < 1:
+        num_threads = 1
+    if nnz == 0:
+        return np.zeros(0, dtype=float), np.zeros(0, dtype=np.int64), np.asarray(S_indptr)
+
+    with nogil:
+        _transpose_csr(
+            indices, indptr, data, T_indices, T_indptr, T_data, T_position, num_threads
+        )
+
+        for i in prange(n_samples, schedule="guided", num_threads=num_threads):
+            for j in range(indptr[i], indptr[i + 1]):
+                P_indices[j] = indices[j]
+                P_data[j] = data[j]
+            _sort_csr_row(&P_indices[indptr[i]], &P_data[indptr[i]], indptr[i + 1] - indptr[i])
+
+        # Count the entries of every row first, so the rows can be written
+        # in parallel
+        for i in prange(n_samples, schedule="guided", num_threads=num_threads):
+            S_indptr[i + 1] = _merge_csr_rows(
+                &P_indices[0], &P_data[0], indptr[i], indptr[i + 1],
+                &T_indices[0], &T_data[0], T_indptr[i], T_indptr[i + 1], NULL, NULL,
+            )
+
+        for i in range(n_samples):
+            S_indptr[i + 1] += S_indptr[i]
+
+    S_indices = np.empty(S_indptr[n_samples], dtype=np.int64)
+    S_data = np.empty(S_indptr[n_samples], dtype=float)
+    if S_indptr[n_samples] > 0:
+        with nogil:
+            for i in prange(n_samples, schedule="guided", num_threads=num_threads):
+                _merge_csr_rows(
+                    &P_indices[0], &P_data[0], indptr[i], indptr[i + 1],
+                    &T_indices[0], &T_data[0], T_indptr[i], T_indptr[i + 1],
+                    &S_indices[S_indptr[i]], &S_data[S_indptr[i]],
+                )
+
+    return np.asarray(S_data), np.asarray(S_indices), np.asarray(S_indptr)
+
+
+cdef void _transpose_csr(
+    sparse_index_t[:] indices,
+    sparse_index_t[:] indptr,
+    double[:] data,
+    np.int64_t[::1] T_indices,
+    np.int64_t[::1] T_indptr,
+    double[::1] T_data,
+    np.int64_t[::1] position,
+    Py_ssize_t num_threads,
+) nogil:
+    """Transpose a square CSR matrix with a counting sort.
+
+    Every thread fills a block of rows of the transpose in its own pass over
+    the matrix. All the passes read the whole matrix, but most of the time
+    goes into scattering the entries, which the threads split between them.
+
+    """
+    cdef:
+        Py_ssize_t n_samples = indptr.shape[0] - 1, i, j, k, block
+        Py_ssize_t block_size = (n_samples + num_threads - 1) // num_threads
+        Py_ssize_t block_start, block_end
+
+    T_indptr[:] = 0
+    for j in range(indptr[n_samples]):
+        T_indptr[indices[j] + 1] += 1
+    for i in range(n_samples):
+        T_indptr[i + 1] += T_indptr[i]
+        position[i] = T_indptr[i]
+
+    for block in prange(num_threads, schedule="static", num_threads=num_threads):
+        block_start = block * block_size
+        block_end = min(block_start + block_size, n_samples)
+        for i in range(n_samples):
+            for j in range(indptr[i], indptr[i + 1]):
+                k = indices[j]
+                if block_start <= k < block_end:
+                    T_indices[position[k]] = i
+                    T_data[position[k]] = data[j]
+                    position[k] += 1
+
+
+cdef void _sort_csr_row(np.int64_t * indices, double * data, Py_ssize_t n) nogil:
+    """Sort the entries of a CSR row by their indices with an introsort."""
+    cdef Py_ssize_t i, depth_limit = 0
+
+    for i in range(1, n):
+        if indices[i] < indices[i - 1]:
+            break
+    else:
+        return
+
+    i = n
+    while i > 1:
+        depth_limit += 2
+        i //= 2
+    _introsort(indices, data, n, depth_limit)
+
+
+cdef void _introsort(
+    np.int64_t * indices, double * data, Py_ssize_t n, Py_ssize_t depth_limit
+) nogil:
+    cdef:
+        Py_ssize_t i, j, middle
+        np.int64_t index, pivot
+        double value
+
+    while n > 16:
+        # Quicksort degrades on unlucky pivots, so switch to a heapsort
+        if depth_limit == 0:
+            for i in range((n - 2) // 2, -1, -1):
+                _sift_down(indices, data, i, n)
+            for i in range(n - 1, 0, -1):
+                _swap_entries(indices, data, 0, i)
+                _sift_down(indices, data, 0, i)
+            return
+        depth_limit -= 1
+
+        # Move the median of the first, middle and last index to the front
+        middle = n // 2
+        if indices[middle] < indices[0]:
+            _swap_entries(indices, data, 0, middle)
+        if indices[n - 1] < indices[0]:
+            _swap_entries(indices, data, 0, n - 1)
+        if indices[n - 1] < indices[middle]:
+            _swap_entries(indices, data, middle, n - 1)
+        _swap_entries(indices, data, 0, middle)
+
+        pivot = indices[0]
+        i, j = 0, n
+        while True:
+            i += 1
+            while i < n and indices[i] < pivot:
+                i += 1
+            j -= 1
+            while indices[j] > pivot:
+                j -= 1
+            if i >= j:
+                break
+            _swap_entries(indices, data, i, j)
+        _swap_entries(indices, data, 0, j)
+
+        # Recurse into the smaller part, and continue with the larger one
+        if j < n - j - 1:
+            _introsort(indices, data, j, depth_limit)
+            indices, data, n = indices + j + 1, data + j + 1, n - j - 1
+        else:
+            _introsort(indices + j + 1, data + j + 1, n - j - 1, depth_limit)
+            n = j
+
+    for i in range(1, n):
+        index, value = indices[i], data[i]
+        j = i
+        while j > 0 and indices[j - 1] > index:
+            indices[j], data[j] = indices[j - 1], data[j - 1]
+            j -= 1
+        indices[j], data[j] = index, value
+
+
+cdef inline void _swap_entries(
+    np.int64_t * indices, double * data, Py_ssize_t i, Py_ssize_t j
+) nogil:
+    cdef:
+        np.int64_t index = indices[i]
+        double value = data[i]
+    indices[i], data[i] = indices[j], data[j]
+    indices[j], data[j] = index, value
+
+
+cdef inline void _sift_down(
+    np.int64_t * indices, double * data, Py_ssize_t root, Py_ssize_t end
+) nogil:
+    cdef:
+        Py_ssize_t child
+        np.int64_t index = indices[root]
+        double value = data[root]
+
+    while 2 * root + 1 < end:
+        child = 2 * root + 1
+        if child + 1 < end and indices[child + 1] > indices[child]:
+            child += 1
+        if indices[child] <= index:
+            break
+        indices[root], data[root] = indices[child], data[child]
+        root = child
+    indices[root], data[root] = index, value
+
+
+cdef Py_ssize_t _merge_csr_rows(
+    np.int64_t * a_indices,
+    double * a_data,
+    Py_ssize_t a,
+    Py_ssize_t a_end,
+    np.int64_t * b_indices,
+    double * b_data,
+    Py_ssize_t b,
+    Py_ssize_t b_end,
+    np.int64_t * indices,
+    double * data,
+) nogil:
+    """Write the halved sum of two sorted CSR rows, and return the number of
+    its entries. Only counts them if `indices` is NULL."""
+    cdef:
+        Py_ssize_t count = 0
+        np.int64_t column
+        double value
+
+    while a < a_end or b < b_end:
+        if b == b_end or a < a_end and a_indices[a] <= b_indices[b]:
+            column = a_indices[a]
+        else:
+            column = b_indices[b]
+
+        value = 0
+        while a < a_end and a_indices[a] == column:
+            value += a_data[a]
+            a += 1
+        while b < b_end and b_indices[b] == column:
+            value += b_data[b]
+            b += 1
+
+        if value != 0:
+            if indices != NULL:
+                indices[count] = column
+                data[count] = value / 2
+            count += 1
+
+    return count
+
+
 cpdef tuple estimate_positive_gradient_nn(
-    int[:] indices,
-    int[:] indptr,
-    double[:] P_data,
+    sparse_index_t[:] indices,
+    sparse_index_t[:] indptr,
+    const double[:] P_data,
     double[:, ::1] embedding,
     double[:, ::1] reference_embedding,
     double[:, ::1] gradient,
     double dof=1,
     Py_ssize_t num_threads=1,
     bint should_eval_error=False,
+    double exaggeration=1,
 ):
+    """Compute the positive gradient, optionally exaggerating the affinities.
+
+    The exaggeration only scales the attractive forces. `P_data` is never
+    modified and the KL divergence is always computed w.r.t. the actual
+    affinities.
+
+    """
     cdef:
         Py_ssize_t n_samples = gradient.shape[0]
         Py_ssize_t n_dims = gradient.shape[1]
@@ -149,7 +502,7 @@ cpdef tuple estimate_positive_gradient_nn(
 
                 # Compute F_{attr} of point `j` on point `i`
                 for d in range(n_dims):
-                    gradient[i, d] = gradient[i, d] + q_ij * p_ij * diff[d]
+                    gradient[i, d] = gradient[i, d] + exaggeration * q_ij * p_ij * diff[d]
 
                 # Evaluating the following expressions can slow things down
                 # considerably if evaluated every iteration. Note that the q_ij
@@ -164,6 +517,367 @@ cpdef tuple estimate_positive_gradient_nn(
     return sum_P, kl_divergence
 
 
+cpdef tuple estimate_positive_gradient_nn_symmetric(
+    sparse_index_t[:] indices,
+    sparse_index_t[:] indptr,
+    const double[:] P_data,
+    double[:, ::1] embedding,
+    double[:, ::1] gradient,
+    double dof=1,
+    Py_ssize_t num_threads=1,
+    bint should_eval_error=False,
+    double exaggeration=1,
+):
+    """Compute the positive gradient from the upper triangle of a symmetric P.
+
+    Every edge is stored only once, so we apply its force to both endpoints.
+    To avoid races, the first thread writes directly into `gradient` while
+    every other thread accumulates into its own buffer, which are summed up
+    at the end. As with `estimate_positive_gradient_nn`, the exaggeration
+    only scales the attractive forces.
+
+    """
+    cdef:
+        Py_ssize_t n_samples = gradient.shape[0]
+        Py_ssize_t n_dims = gradient.shape[1]
+        double * diff
+        double * thread_gradient
+        double d_ij, p_ij, q_ij, weight, kl_divergence = 0, sum_P = 0
+
+        Py_ssize_t i, j, k, d, t
+
+    if num_threads < 1:
+        num_threads = 1
+    if n_samples == 0:
+        return sum_P, kl_divergence
+
+    cdef double[:, ::1] thread_buffers = np.zeros(
+        ((num_threads - 1) * n_samples, n_dims), dtype=float
+    ) if num_threads > 1 else gradient
+
+    with nogil, parallel(num_threads=num_threads):
+        diff = <double *>malloc(n_dims * sizeof(double))
+        if not diff:
+            with gil:
+                raise MemoryError()
+
+        t = threadid()
+        if t == 0:
+            thread_gradient = &gradient[0, 0]
+        else:
+            thread_gradient = &thread_buffers[(t - 1) * n_samples, 0]
+
+        for i in prange(n_samples, schedule="guided"):
+            for k in range(indptr[i], indptr[i + 1]):
+                j = indices[k]
+                p_ij = P_data[k]
+
+                d_ij = 0
+                for d in range(n_dims):
+                    diff[d] = embedding[i, d] - embedding[j, d]
+                    d_ij = d_ij + diff[d] ** 2
+
+                q_ij = dof / (dof + d_ij)
+                if dof != 1:
+                    q_ij = q_ij ** ((dof + 1) / 2)
+
+                # Compute F_{attr} between points `i` and `j`
+                for d in range(n_dims):
+                    thread_gradient[i * n_dims + d] += exaggeration * q_ij * p_ij * diff[d]
+                    thread_gradient[j * n_dims + d] -= exaggeration * q_ij * p_ij * diff[d]
+
+                # The entries below the diagonal are implied, so they count
+                # towards the error as well
+                if should_eval_error:
+                    weight = 1 if i == j else 2
+                    sum_P += weight * p_ij
+                    kl_divergence += weight * p_ij * log(p_ij / (q_ij + EPSILON))
+
+        free(diff)
+
+    if num_threads > 1:
+        for i in prange(n_samples, nogil=True, schedule="static", num_threads=num_threads):
+            for t in range(num_threads - 1):
+                for d in range(n_dims):
+                    gradient[i, d] += thread_buffers[t * n_samples + i, d]
+
+    return sum_P, kl_divergence
+
+
+cpdef tuple estimate_positive_gradient_nn_batched(
+    sparse_index_t[:] indices,
+    sparse_index_t[:] indptr,
+    const double[:] P_data,
+    double[:, :, ::1] embedding,
+    double[:, :, ::1] gradient,
+    double dof=1,
+    Py_ssize_t num_threads=1,
+    bint should_eval_error=False,
+    double exaggeration=1,
+    double[:, :, ::1] points=None,
+):
+    """Compute the positive gradient for a batch of embeddings of the same P.
+
+    `embedding` and `gradient` contain the stacked embeddings with shape
+    `(n_batch, n_samples, n_dims)`. Every row of P is read only once and
+    applied to all the embeddings. Returns the sum of P and an array with the
+    KL divergence terms of every embedding.
+
+    `points` is a buffer of shape `(n_samples, n_batch, n_dims)` for the
+    positions of the points, which is allocated if not given.
+
+    """
+    cdef:
+        Py_ssize_t n_batch = gradient.shape[0]
+        Py_ssize_t n_samples = gradient.shape[1]
+        Py_ssize_t n_dims = gradient.shape[2]
+        double[::1] kl_divergence = np.zeros(n_batch, dtype=float)
+        double * diff
+        double * local_kl_divergence
+        double * point_i
+        double * point_j
+        double * force_i
+        double d_ij, p_ij, q_ij, sum_P = 0
+
+        Py_ssize_t i, j, k, b, d, t
+
+    if num_threads < 1:
+        num_threads = 1
+
+    # Neighbors are accessed randomly, so store the positions of every point
+    # in all the embeddings next to each other. This way, each neighbor costs
+    # a single memory access for the whole batch
+    if points is None or points.shape[0] != n_samples or points.shape[1] != n_batch \
+            or points.shape[2] != n_dims:
+        points = np.empty((n_samples, n_batch, n_dims), dtype=float)
+    with nogil:
+        for i in prange(n_samples, schedule="static", num_threads=num_threads):
+            for b in range(n_batch):
+                for d in range(n_dims):
+                    points[i, b, d] = embedding[b, i, d]
+
+    with nogil, parallel(num_threads=num_threads):
+        # The forces on a point are accumulated for the whole batch before
+        # they are added to the gradients
+        diff = <double *>malloc(n_dims * sizeof(double))
+        force_i = <double *>malloc(n_batch * n_dims * sizeof(double))
+        local_kl_divergence = <double *>calloc(n_batch, sizeof(double))
+        if not diff or not force_i or not local_kl_divergence:
+            with gil:
+                raise MemoryError()
+
+        for i in prange(n_samples, schedule="guided"):
+            point_i = &points[i, 0, 0]
+            for d in range(n_batch * n_dims):
+                force_i[d] = 0
+
+            for k in range(indptr[i], indptr[i + 1]):
+                j = indices[k]
+                p_ij = P_data[k]
+                point_j = &points[j, 0, 0]
+
+                for b in range(n_batch):
+                    d_ij = 0
+                    for d in range(n_dims):
+                        diff[d] = point_i[b * n_dims + d] - point_j[b * n_dims + d]
+                        d_ij = d_ij + diff[d] * diff[d]
+
+                    q_ij = dof / (dof + d_ij)
+                    if dof != 1:
+                        q_ij = q_ij ** ((dof + 1) / 2)
+
+                    for d in range(n_dims):
+                        force_i[b * n_dims + d] += exaggeration * q_ij * p_ij * diff[d]
+
+                    if should_eval_error:
+                        local_kl_divergence[b] = local_kl_divergence[b] + \
+                            p_ij * log(p_ij / (q_ij + EPSILON))
+
+                if should_eval_error:
+                    sum_P += p_ij
+
+            for b in range(n_batch):
+                for d in range(n_dims):
+                    gradient[b, i, d] += force_i[b * n_dims + d]
+
+        with gil:
+            for t in range(n_batch):
+                kl_divergence[t] += local_kl_divergence[t]
+        free(diff)
+        free(force_i)
+        free(local_kl_divergence)
+
+    return sum_P, np.asarray(kl_divergence)
+
+
+cdef inline int sign(double x) nogil:
+    return (x > 0) - (x < 0)
+
+
+cpdef double update_embedding(
+    double[:, ::1] embedding,
+    double[:, ::1] gradient,
+    double[:, ::1] update,
+    double[:, ::1] gains,
+    double learning_rate,
+    double momentum,
+    double min_gain,
+    double max_grad_norm,
+    bint should_center=True,
+    Py_ssize_t num_threads=1,
+):
+    """Perform a single gradient descent step with momentum and gains.
+
+    Clips the gradient of every point to `max_grad_norm` (pass infinity to
+    disable clipping), updates the gains and the momentum term, moves the
+    points and optionally re-centers the embedding, all in place and in a
+    single pass over the points. Returns the norm of the clipped gradient.
+
+    """
+    cdef:
+        Py_ssize_t n_samples = embedding.shape[0]
+        Py_ssize_t n_dims = embedding.shape[1]
+        double[::1] mean = np.zeros(n_dims, dtype=float)
+        bint should_clip = not isinf(max_grad_norm)
+        double * local_sum
+
+        Py_ssize_t i, d, k
+        double norm, coeff, g, u, grad_norm_sq = 0
+
+    if num_threads < 1:
+        num_threads = 1
+
+    with nogil, parallel(num_threads=num_threads):
+        local_sum = <double *>calloc(n_dims, sizeof(double))
+        if not local_sum:
+            with gil:
+                raise MemoryError()
+
+        for i in prange(n_samples, schedule="static"):
+            # Clip gradients to avoid points shooting off
+            if should_clip:
+                norm = 0
+                for d in range(n_dims):
+                    norm = norm + gradient[i, d] ** 2
+                coeff = max_grad_norm / (sqrt(norm) + 1e-6)
+                if coeff < 1:
+                    for d in range(n_dims):
+                        gradient[i, d] = gradient[i, d] * coeff
+
+            for d in range(n_dims):
+                g = gradient[i, d]
+                u = update[i, d]
+                if sign(u) != sign(g):
+                    gains[i, d] = gains[i, d] + 0.2
+                else:
+                    gains[i, d] = gains[i, d] * 0.8 + min_gain
+
+                u = momentum * u - learning_rate * gains[i, d] * g
+                update[i, d] = u
+                embedding[i, d] = embedding[i, d] + u
+
+                local_sum[d] = local_sum[d] + embedding[i, d]
+                grad_norm_sq += g * g
+
+        with gil:
+            for k in range(n_dims):
+                mean[k] += local_sum[k]
+        free(local_sum)
+
+    if should_center and n_samples > 0:
+        for d in range(n_dims):
+            mean[d] /= n_samples
+        for i in prange(n_samples, nogil=True, schedule="static", num_threads=num_threads):
+            for d in range(n_dims):
+                embedding[i, d] -= mean[d]
+
+    return sqrt(grad_norm_sq)
+
+
+cpdef double update_embedding_adam(
+    double[:, ::1] embedding,
+    double[:, ::1] gradient,
+    double[:, ::1] first_moment,
+    double[:, ::1] second_moment,
+    double learning_rate,
+    double beta1,
+    double beta2,
+    double epsilon,
+    Py_ssize_t step,
+    double max_grad_norm,
+    bint should_center=True,
+    Py_ssize_t num_threads=1,
+):
+    """Perform a single Adam step.
+
+    Same as `update_embedding`, but the points are moved using bias-corrected
+    estimates of the first and second moments of the gradient. `step` is the
+    1-based number of this step. Returns the norm of the clipped gradient.
+
+    """
+    cdef:
+        Py_ssize_t n_samples = embedding.shape[0]
+        Py_ssize_t n_dims = embedding.shape[1]
+        double[::1] mean = np.zeros(n_dims, dtype=float)
+        bint should_clip = not isinf(max_grad_norm)
+        double * local_sum
+
+        # Bias corrections for the zero-initialized moment estimates
+        double correction1 = 1 - beta1 ** step
+        double correction2 = 1 - beta2 ** step
+
+        Py_ssize_t i, d, k
+        double norm, coeff, g, m, v, grad_norm_sq = 0
+
+    if num_threads < 1:
+        num_threads = 1
+
+    with nogil, parallel(num_threads=num_threads):
+        local_sum = <double *>calloc(n_dims, sizeof(double))
+        if not local_sum:
+            with gil:
+                raise MemoryError()
+
+        for i in prange(n_samples, schedule="static"):
+            # Clip gradients to avoid points shooting off
+            if should_clip:
+                norm = 0
+                for d in range(n_dims):
+                    norm = norm + gradient[i, d] ** 2
+                coeff = max_grad_norm / (sqrt(norm) + 1e-6)
+                if coeff < 1:
+                    for d in range(n_dims):
+                        gradient[i, d] = gradient[i, d] * coeff
+
+            for d in range(n_dims):
+                g = gradient[i, d]
+                m = beta1 * first_moment[i, d] + (1 - beta1) * g
+                v = beta2 * second_moment[i, d] + (1 - beta2) * g * g
+                first_moment[i, d] = m
+                second_moment[i, d] = v
+
+                embedding[i, d] = embedding[i, d] - learning_rate * (m / correction1) / (
+                    sqrt(v / correction2) + epsilon
+                )
+
+                local_sum[d] = local_sum[d] + embedding[i, d]
+                grad_norm_sq += g * g
+
+        with gil:
+            for k in range(n_dims):
+                mean[k] += local_sum[k]
+        free(local_sum)
+
+    if should_center and n_samples > 0:
+        for d in range(n_dims):
+            mean[d] /= n_samples
+        for i in prange(n_samples, nogil=True, schedule="static", num_threads=num_threads):
+            for d in range(n_dims):
+                embedding[i, d] -= mean[d]
+
+    return sqrt(grad_norm_sq)
+
+
 cpdef double estimate_negative_gradient_bh(
     QuadTree tree,
     double[:, ::1] embedding,
@@ -172,7 +886,7 @@ cpdef double estimate_negative_gradient_bh(
     double dof=1,
     Py_ssize_t num_threads=1,
     bint pairwise_normalization=True,
-):
+) except? -1:
     """Estimate the negative tSNE gradient using the Barnes Hut approximation.
     
     Notes
@@ -187,15 +901,65 @@ cpdef double estimate_negative_gradient_bh(
         Py_ssize_t i, j, num_points = embedding.shape[0]
         double sum_Q = 0
         double[::1] sum_Qi = np.zeros(num_points, dtype=float)
+        int quarters = _kernel_quarters(dof)
+
+        double * center_of_mass
+        double * length
+        Py_ssize_t * tree_num_points
+        Py_ssize_t * first_child
+        Py_ssize_t * first_point
+        unsigned char * duplicates_only
+        double * tree_points
+        Py_ssize_t stack_size = tree.max_stack_size()
+        Py_ssize_t * stack
+
+    # A tree that has not been built yet contains no points
+    if tree.n_nodes == 0:
+        return 0
+
+    center_of_mass = &tree.center_of_mass[0, 0]
+    length = &tree.length[0]
+    tree_num_points = &tree.num_points[0]
+    first_child = &tree.first_child[0]
+    first_point = &tree.first_point[0]
+    duplicates_only = &tree.duplicates_only[0]
+    tree_points = &tree.points[0, 0] if tree.points.shape[0] > 0 else NULL
 
     if num_threads < 1:
         num_threads = 1
 
     # In order to run gradient estimation in parallel, we need to pass each
     # worker it's own memory slot to write sum_Qs
-    for i in prange(num_points, nogil=True, num_threads=num_threads, schedule="guided"):
-        _estimate_negative_gradient_single(
-            &tree.root, &embedding[i, 0], &gradient[i, 0], &sum_Qi[i], theta, dof)
+    with nogil, parallel(num_threads=num_threads):
+        # Every thread needs its own stack of nodes left to visit
+        stack = <Py_ssize_t *>malloc(stack_size * sizeof(Py_ssize_t))
+        if not stack:
+            with gil:
+                raise MemoryError()
+
+        # The common two and three dimensional embeddings have their own
+        # kernels with the loops over dimensions unrolled
+        for i in prange(num_points, schedule="guided"):
+            if tree.n_dims == 2:
+                _estimate_negative_gradient_single_2d(
+                    center_of_mass, length, tree_num_points, first_child, first_point,
+                    duplicates_only, tree_points, stack, &embedding[i, 0], &gradient[i, 0],
+                    &sum_Qi[i], theta, dof, quarters,
+                )
+            elif tree.n_dims == 3:
+                _estimate_negative_gradient_single_3d(
+                    center_of_mass, length, tree_num_points, first_child, first_point,
+                    duplicates_only, tree_points, stack, &embedding[i, 0], &gradient[i, 0],
+                    &sum_Qi[i], theta, dof, quarters,
+                )
+            else:
+                _estimate_negative_gradient_single(
+                    center_of_mass, length, tree_num_points, first_child, first_point,
+                    duplicates_only, tree_points, tree.n_dims, stack, &embedding[i, 0],
+                    &gradient[i, 0], &sum_Qi[i], theta, dof, quarters,
+                )
+
+        free(stack)
 
     for i in range(num_points):
         sum_Q += sum_Qi[i]
@@ -212,42 +976,1720 @@ cpdef double estimate_negative_gradient_bh(
 
 
 cdef void _estimate_negative_gradient_single(
-    Node * node,
+    double * center_of_mass,
+    double * length,
+    Py_ssize_t * num_points,
+    Py_ssize_t * first_child,
+    Py_ssize_t * first_point,
+    unsigned char * duplicates_only,
+    double * points,
+    Py_ssize_t n_dims,
+    Py_ssize_t * stack,
     double * point,
     double * gradient,
     double * sum_Q,
     double theta,
     double dof,
+    int quarters,
 ) nogil:
-    # Make sure that we spend no time on empty nodes or self-interactions
-    if node.num_points == 0 or node.is_leaf and is_duplicate(node, point):
-        return
+    cdef:
+        Py_ssize_t n_children = 1 << n_dims
+        Py_ssize_t stack_top = 1, node, child, j, d
+        double distance, q_ij
+        double * node_center_of_mass
+        double * other
+
+    # Traverse the tree depth-first, starting at the root
+    stack[0] = 0
+    while stack_top > 0:
+        stack_top -= 1
+        node = stack[stack_top]
+        node_center_of_mass = &center_of_mass[node * n_dims]
+
+        # Make sure that we spend no time on empty nodes or self-interactions.
+        # Only leaves whose points all coincide can be skipped as a whole; in
+        # other leaves, the point is skipped when visiting the leaf's points
+        if num_points[node] == 0 or first_child[node] < 0 and (
+            num_points[node] == 1 or duplicates_only[node]
+        ) and is_duplicate(node_center_of_mass, point, n_dims):
+            continue
+
+        # Compute the squared euclidean disstance in the embedding space from
+        # the new point to the center of mass
+        distance = EPSILON
+        for d in range(n_dims):
+            distance += (node_center_of_mass[d] - point[d]) ** 2
+
+        # Check whether we can use this node as a summary
+        if length[node] / sqrt(distance) < theta or first_child[node] < 0 and (
+            num_points[node] == 1 or duplicates_only[node]
+        ):
+            q_ij = _kernel(distance, dof, quarters)
+            sum_Q[0] += num_points[node] * q_ij
+
+            for d in range(n_dims):
+                gradient[d] -= num_points[node] * q_ij ** 2 * (point[d] - node_center_of_mass[d])
+
+            continue
+
+        # Leaves holding several points are too close to be summarized, so
+        # compute their interactions exactly
+        if first_child[node] < 0:
+            for j in range(first_point[node], first_point[node] + num_points[node]):
+                other = &points[j * n_dims]
+                if is_duplicate(other, point, n_dims):
+                    continue
+                distance = EPSILON
+                for d in range(n_dims):
+                    distance += (other[d] - point[d]) ** 2
 
+                q_ij = _kernel(distance, dof, quarters)
+                sum_Q[0] += q_ij
+
+                for d in range(n_dims):
+                    gradient[d] -= q_ij ** 2 * (point[d] - other[d])
+
+            continue
+
+        # Otherwise we have to look for summaries in the children. Push them
+        # in reverse, so they are visited in order
+        for child in range(first_child[node] + n_children - 1, first_child[node] - 1, -1):
+            if num_points[child] > 0:
+                stack[stack_top] = child
+                stack_top += 1
+
+
+cdef void _estimate_negative_gradient_single_2d(
+    double * center_of_mass,
+    double * length,
+    Py_ssize_t * num_points,
+    Py_ssize_t * first_child,
+    Py_ssize_t * first_point,
+    unsigned char * duplicates_only,
+    double * points,
+    Py_ssize_t * stack,
+    double * point,
+    double * gradient,
+    double * sum_Q,
+    double theta,
+    double dof,
+    int quarters,
+) nogil:
+    """`_estimate_negative_gradient_single` for two dimensional embeddings."""
     cdef:
-        double distance = EPSILON
-        double q_ij
-        Py_ssize_t d
+        Py_ssize_t stack_top = 1, node, child, j
+        double x = point[0], y = point[1], dx, dy, distance, q_ij, weight
+        double sum_Q_i = 0, gradient_x = 0, gradient_y = 0
+        double theta_sq = theta * theta
+
+    stack[0] = 0
+    while stack_top > 0:
+        stack_top -= 1
+        node = stack[stack_top]
+        dx = x - center_of_mass[2 * node]
+        dy = y - center_of_mass[2 * node + 1]
+
+        if num_points[node] == 0 or first_child[node] < 0 and (
+            num_points[node] == 1 or duplicates_only[node]
+        ) and is_duplicate(&center_of_mass[2 * node], point, 2):
+            continue
+
+        distance = EPSILON + dx * dx + dy * dy
+
+        # Comparing squares saves a square root for every visited node
+        if length[node] * length[node] < theta_sq * distance or first_child[node] < 0 and (
+            num_points[node] == 1 or duplicates_only[node]
+        ):
+            q_ij = _kernel(distance, dof, quarters)
+            weight = num_points[node] * q_ij
+            sum_Q_i += weight
+            weight *= q_ij
+            gradient_x -= weight * dx
+            gradient_y -= weight * dy
+            continue
+
+        if first_child[node] < 0:
+            for j in range(first_point[node], first_point[node] + num_points[node]):
+                dx = x - points[2 * j]
+                dy = y - points[2 * j + 1]
+                if is_duplicate(&points[2 * j], point, 2):
+                    continue
+                q_ij = _kernel(EPSILON + dx * dx + dy * dy, dof, quarters)
+                sum_Q_i += q_ij
+                q_ij *= q_ij
+                gradient_x -= q_ij * dx
+                gradient_y -= q_ij * dy
+            continue
+
+        child = first_child[node]
+        for j in range(3, -1, -1):
+            if num_points[child + j] > 0:
+                stack[stack_top] = child + j
+                stack_top += 1
+
+    sum_Q[0] += sum_Q_i
+    gradient[0] += gradient_x
+    gradient[1] += gradient_y
+
+
+cdef void _estimate_negative_gradient_single_3d(
+    double * center_of_mass,
+    double * length,
+    Py_ssize_t * num_points,
+    Py_ssize_t * first_child,
+    Py_ssize_t * first_point,
+    unsigned char * duplicates_only,
+    double * points,
+    Py_ssize_t * stack,
+    double * point,
+    double * gradient,
+    double * sum_Q,
+    double theta,
+    double dof,
+    int quarters,
+) nogil:
+    """`_estimate_negative_gradient_single` for three dimensional embeddings."""
+    cdef:
+        Py_ssize_t stack_top = 1, node, child, j
+        double x = point[0], y = point[1], z = point[2], dx, dy, dz, distance, q_ij, weight
+        double sum_Q_i = 0, gradient_x = 0, gradient_y = 0, gradient_z = 0
+        double theta_sq = theta * theta
+
+    stack[0] = 0
+    while stack_top > 0:
+        stack_top -= 1
+        node = stack[stack_top]
+        dx = x - center_of_mass[3 * node]
+        dy = y - center_of_mass[3 * node + 1]
+        dz = z - center_of_mass[3 * node + 2]
+
+        if num_points[node] == 0 or first_child[node] < 0 and (
+            num_points[node] == 1 or duplicates_only[node]
+        ) and is_duplicate(&center_of_mass[3 * node], point, 3):
+            continue
+
+        distance = EPSILON + dx * dx + dy * dy + dz * dz
+
+        if length[node] * length[node] < theta_sq * distance or first_child[node] < 0 and (
+            num_points[node] == 1 or duplicates_only[node]
+        ):
+            q_ij = _kernel(distance, dof, quarters)
+            weight = num_points[node] * q_ij
+            sum_Q_i += weight
+            weight *= q_ij
+            gradient_x -= weight * dx
+            gradient_y -= weight * dy
+            gradient_z -= weight * dz
+            continue
+
+        if first_child[node] < 0:
+            for j in range(first_point[node], first_point[node] + num_points[node]):
+                dx = x - points[3 * j]
+                dy = y - points[3 * j + 1]
+                dz = z - points[3 * j + 2]
+                if is_duplicate(&points[3 * j], point, 3):
+                    continue
+                q_ij = _kernel(EPSILON + dx * dx + dy * dy + dz * dz, dof, quarters)
+                sum_Q_i += q_ij
+                q_ij *= q_ij
+                gradient_x -= q_ij * dx
+                gradient_y -= q_ij * dy
+                gradient_z -= q_ij * dz
+            continue
+
+        child = first_child[node]
+        for j in range(7, -1, -1):
+            if num_points[child + j] > 0:
+                stack[stack_top] = child + j
+                stack_top += 1
+
+    sum_Q[0] += sum_Q_i
+    gradient[0] += gradient_x
+    gradient[1] += gradient_y
+    gradient[2] += gradient_z
+
+
+cdef inline int _kernel_quarters(double dof) nogil:
+    """Get the exponent ``(dof + 1) / 2`` of the kernel in quarters, or -1 if
+    it is not a small multiple of a quarter, as for integer and half-integer
+    degrees of freedom."""
+    cdef double quarters = 2 * (dof + 1)
+    if 0 < quarters <= 64 and quarters == <int>quarters:
+        return <int>quarters
+    return -1
+
+
+cdef inline double _kernel(double distance, double dof, int quarters) nogil:
+    """Evaluate the t-distribution kernel ``(dof / (dof + distance)) ** ((dof + 1) / 2)``.
+
+    Exponents that are multiples of a quarter are computed with
+    multiplications and square roots, which are much cheaper than ``pow``.
+
+    """
+    cdef:
+        double q = dof / (dof + distance), result = 1, root
+        int exponent
+
+    if quarters == 4:
+        return q
+    if quarters < 0:
+        return q ** ((dof + 1) / 2)
+
+    if quarters & 3:
+        root = sqrt(q)
+        if quarters & 2:
+            result = root
+        if quarters & 1:
+            result *= sqrt(root)
+    exponent = quarters >> 2
+    while exponent:
+        if exponent & 1:
+            result *= q
+        q *= q
+        exponent >>= 1
+    return result
+
+
+cdef struct _TreeView:
+    double * center_of_mass
+    # The distance from the center of mass to the farthest point in the node
+    double * radius
+    # The sum of the outer products of the points' offsets from the center of
+    # mass
+    double * second_moment
+    Py_ssize_t * num_points
+    Py_ssize_t * first_child
+    Py_ssize_t * first_point
+    unsigned char * duplicates_only
+    double * points
+
+
+cdef struct _Expansions:
+    # The second-order expansions of the repulsion received by each node,
+    # around its center of mass: the value, gradient and Hessian of sum_Q and
+    # the value, Jacobian and second derivatives of the force
+    double * q
+    double * dq
+    double * ddq
+    double * force
+    double * dforce
+    double * ddforce
+
+
+cdef _TreeView _view(
+    QuadTree tree, double[::1] radius, double[:, :, ::1] second_moment,
+    Py_ssize_t num_threads,
+):
+    """Collect the arrays of a tree and compute the radii and second moments
+    of its nodes into the given arrays, which must outlive the view."""
+    cdef:
+        _TreeView view
+        Py_ssize_t level, start, end, node
+
+    view.center_of_mass = &tree.center_of_mass[0, 0]
+    view.num_points = &tree.num_points[0]
+    view.first_child = &tree.first_child[0]
+    view.first_point = &tree.first_point[0]
+    view.duplicates_only = &tree.duplicates_only[0]
+    view.points = &tree.points[0, 0] if tree.points.shape[0] > 0 else NULL
+
+    # The points are often much closer together than the size of their node
+    # suggests, so the radii are computed bottom-up
+    view.radius = &radius[0]
+    view.second_moment = &second_moment[0, 0, 0]
+    with nogil:
+        for level in range(tree.n_levels - 1, -1, -1):
+            start, end = tree.level_offsets[level], tree.level_offsets[level + 1]
+            for node in prange(start, end, num_threads=num_threads):
+                _node_moments(&view, tree.n_dims, node)
+
+    return view
+
+
+cpdef double estimate_negative_gradient_bh_dual(
+    QuadTree tree,
+    double[:, ::1] embedding,
+    double[:, ::1] gradient,
+    double theta=0.5,
+    double dof=1,
+    Py_ssize_t num_threads=1,
+    bint pairwise_normalization=True,
+    QuadTree reference_tree=None,
+) except? -1:
+    """Estimate the negative tSNE gradient using a dual-tree traversal.
+
+    Instead of traversing the tree once for every point, pairs of nodes are
+    interacted with each other. When two nodes are far enough apart, the
+    repulsion of the one on the other is expanded to second order around the
+    receiving node's center of mass. The expansions are pushed down the tree
+    and evaluated at the points at the end, so nearby points share most of
+    the work. Leaves that are close together interact exactly, so this works
+    best with leaves of a few dozen points.
+
+    The sending node is summarized by its center of mass and second moment,
+    so the relative error of an interaction is on the order of
+    ``(r_s / (d - r_r)) ** 3 + (r_r / (d - r_s)) ** 3``, where ``d`` is the
+    distance between the nodes and ``r_s`` and ``r_r`` are the radii of the
+    sending and receiving node. Nodes interact when this is below
+    ``theta ** 3``.
+
+    Parameters
+    ----------
+    tree: QuadTree
+        The tree built from ``embedding``.
+
+    reference_tree: Optional[QuadTree]
+        The tree of the points that repel the points in ``embedding``. By
+        default, the points in ``embedding`` repel each other.
+
+    Notes
+    -----
+    Changes the gradient inplace to avoid needless memory allocation. As
+    such, this must be run before estimating the positive gradients, since
+    the negative gradient must be normalized at the end with the sum of
+    q_{ij}s.
 
-    # Compute the squared euclidean disstance in the embedding space from the
-    # new point to the center of mass
-    for d in range(node.n_dims):
-        distance += (node.center_of_mass[d] - point[d]) ** 2
+    """
+    cdef:
+        QuadTree source = tree if reference_tree is None else reference_tree
+        Py_ssize_t i, j, t, node, level, start, end
+        Py_ssize_t num_points = embedding.shape[0], n_dims = embedding.shape[1]
+        Py_ssize_t n_nodes = tree.n_nodes, n_children = 1 << n_dims
+        double sum_Q = 0
+        double[::1] sum_Qi = np.zeros(num_points, dtype=float)
+
+        double[::1] node_q = np.zeros(n_nodes, dtype=float)
+        double[:, ::1] node_dq = np.zeros((n_nodes, n_dims), dtype=float)
+        double[:, :, ::1] node_ddq = np.zeros((n_nodes, n_dims, n_dims), dtype=float)
+        double[:, ::1] node_force = np.zeros((n_nodes, n_dims), dtype=float)
+        double[:, :, ::1] node_dforce = np.zeros((n_nodes, n_dims, n_dims), dtype=float)
+        double[:, :, :, ::1] node_ddforce = np.zeros(
+            (n_nodes, n_dims, n_dims, n_dims), dtype=float
+        )
+        _Expansions expansions
+        # The repulsion each point receives directly, in tree order
+        double[::1] point_q = np.zeros(num_points, dtype=float)
+        double[:, ::1] point_force = np.zeros((num_points, n_dims), dtype=float)
+
+        _TreeView target_view, source_view
+        double[::1] target_radius = np.zeros(tree.n_nodes, dtype=float)
+        double[::1] source_radius = np.zeros(source.n_nodes, dtype=float)
+        double[:, :, ::1] target_moment = np.zeros((tree.n_nodes, n_dims, n_dims), dtype=float)
+        double[:, :, ::1] source_moment = np.zeros((source.n_nodes, n_dims, n_dims), dtype=float)
+        Py_ssize_t[::1] tasks, level_offsets = tree.level_offsets
+        Py_ssize_t[::1] first_child = tree.first_child, order = tree.order
+        Py_ssize_t stack_size
+        Py_ssize_t * stack
+
+    # The expansions keep their offsets and derivatives in fixed size buffers
+    if n_dims > 3:
+        raise ValueError(
+            "The dual-tree approximation supports at most 3 dimensions, got %d." % n_dims
+        )
+    if tree.n_nodes == 0 or source.n_nodes == 0:
+        return 0
+    if tree.points.shape[0] != num_points or tree.n_dims != n_dims \
+            or source.n_dims != n_dims:
+        raise ValueError("The tree must be built from the embedding.")
+
+    target_view = _view(tree, target_radius, target_moment, num_threads)
+    if reference_tree is None:
+        source_view = target_view
+    else:
+        source_view = _view(source, source_radius, source_moment, num_threads)
+    expansions.q, expansions.dq, expansions.ddq = &node_q[0], &node_dq[0, 0], &node_ddq[0, 0, 0]
+    expansions.force, expansions.dforce, expansions.ddforce = \
+        &node_force[0, 0], &node_dforce[0, 0, 0], &node_ddforce[0, 0, 0, 0]
+
+    # Every pair of nodes on the stack has a parent pair, one of whose nodes
+    # was split, so the stack never grows past all the siblings along the
+    # deepest chain of splits
+    stack_size = n_children * (tree.n_levels + source.n_levels) + 1
+
+    if num_threads < 1:
+        num_threads = 1
+
+    # The receiving side is split up into subtrees that are processed
+    # independently, so every thread writes only to its own nodes. These are
+    # the nodes on the first level with enough of them to balance the work,
+    # along with any leaves above it
+    for level in range(tree.n_levels):
+        if level_offsets[level + 1] - level_offsets[level] >= 64:
+            break
+    tasks = np.concatenate([
+        np.flatnonzero(np.asarray(first_child[:level_offsets[level]]) < 0),
+        np.arange(level_offsets[level], level_offsets[level + 1]),
+    ]).astype(np.intp)
+
+    with nogil, parallel(num_threads=num_threads):
+        stack = <Py_ssize_t *>malloc(2 * stack_size * sizeof(Py_ssize_t))
+        if not stack:
+            with gil:
+                raise MemoryError()
+
+        for t in prange(tasks.shape[0], schedule="dynamic"):
+            _dual_tree_interactions(
+                &target_view, &source_view, n_dims, stack, tasks[t], theta, dof,
+                &expansions, &point_q[0], &point_force[0, 0],
+            )
+
+        free(stack)
+
+    with nogil:
+        # Shift the expansions of the nodes to the centers of mass of their
+        # children, level by level
+        for level in range(tree.n_levels - 1):
+            start, end = level_offsets[level], level_offsets[level + 1]
+            for node in prange(start, end, num_threads=num_threads):
+                if first_child[node] >= 0:
+                    _shift_expansion(&target_view, n_dims, node, &expansions)
+
+        # Evaluate the expansions of the leaves at their points
+        for node in prange(n_nodes, num_threads=num_threads, schedule="guided"):
+            if first_child[node] < 0:
+                _evaluate_expansion(
+                    &target_view, n_dims, node, &order[0], &expansions, &point_q[0],
+                    &point_force[0, 0], &gradient[0, 0], &sum_Qi[0],
+                )
+
+    for i in range(num_points):
+        sum_Q += sum_Qi[i]
+
+    # Normalize q_{ij}s
+    for i in range(gradient.shape[0]):
+        for j in range(gradient.shape[1]):
+            if pairwise_normalization:
+                gradient[i, j] /= sum_Q + EPSILON
+            else:
+                gradient[i, j] /= sum_Qi[i] + EPSILON
+
+    return sum_Q
+
+
+cdef void _dual_tree_interactions(
+    _TreeView * target,
+    _TreeView * source,
+    Py_ssize_t n_dims,
+    Py_ssize_t * stack,
+    Py_ssize_t root,
+    double theta,
+    double dof,
+    _Expansions * expansions,
+    double * point_q,
+    double * point_force,
+) nogil:
+    """Accumulate the repulsion received by the subtree of the target tree at
+    `root` from the whole source tree."""
+    cdef:
+        Py_ssize_t n_children = 1 << n_dims
+        Py_ssize_t stack_top = 1, a, b, child, k, d, n_sources
+        bint a_leaf, b_leaf
+        double distance, error
+        double * a_center
+        double * b_center
+        double * sources
+
+    # Traverse the pairs of nodes depth-first, starting with the whole source
+    # tree
+    stack[0], stack[1] = root, 0
+    while stack_top > 0:
+        stack_top -= 1
+        a, b = stack[2 * stack_top], stack[2 * stack_top + 1]
+
+        a_center = &target.center_of_mass[a * n_dims]
+        b_center = &source.center_of_mass[b * n_dims]
+        a_leaf, b_leaf = target.first_child[a] < 0, source.first_child[b] < 0
+        distance = EPSILON
+        for d in range(n_dims):
+            distance += (a_center[d] - b_center[d]) ** 2
+        distance = sqrt(distance)
+
+        # Well separated nodes interact through the expansion of the target
+        # node. Nodes of duplicates have no extent, so they must not interact
+        # with themselves this way
+        error = INFINITY
+        if distance > target.radius[a] + source.radius[b]:
+            error = (source.radius[b] / (distance - target.radius[a])) ** 3 \
+                + (target.radius[a] / (distance - source.radius[b])) ** 3
+        if error < theta ** 3 and not is_duplicate(a_center, b_center, n_dims):
+            # Neither the derivatives at a leaf with all its points at the
+            # center of mass nor the second moment of such a leaf are of any
+            # use
+            _add_interaction(
+                expansions, n_dims, a, a_center, b_center, source.num_points[b],
+                &source.second_moment[b * n_dims * n_dims] if source.radius[b] > 0 else NULL,
+                distance ** 2, dof, not a_leaf or target.radius[a] > 0,
+            )
+            continue
+
+        # Neighboring leaves interact exactly. Leaves of duplicates act as a
+        # single point, on either side
+        if a_leaf and b_leaf:
+            if source.num_points[b] == 1 or source.duplicates_only[b]:
+                sources, n_sources = b_center, 1
+            else:
+                sources = &source.points[source.first_point[b] * n_dims]
+                n_sources = source.num_points[b]
+
+            if target.duplicates_only[a]:
+                _exact_interactions(
+                    a_center, sources, n_sources,
+                    source.num_points[b] if n_sources == 1 else 1,
+                    n_dims, dof, &expansions.q[a], &expansions.force[a * n_dims],
+                )
+            else:
+                for k in range(target.first_point[a], target.first_point[a] + target.num_points[a]):
+                    _exact_interactions(
+                        &target.points[k * n_dims], sources, n_sources,
+                        source.num_points[b] if n_sources == 1 else 1,
+                        n_dims, dof, &point_q[k], &point_force[k * n_dims],
+                    )
+            continue
+
+        # Otherwise, split the larger node
+        if b_leaf or not a_leaf and target.radius[a] >= source.radius[b]:
+            for child in range(target.first_child[a] + n_children - 1, target.first_child[a] - 1, -1):
+                if target.num_points[child] > 0:
+                    stack[2 * stack_top], stack[2 * stack_top + 1] = child, b
+                    stack_top += 1
+        else:
+            for child in range(source.first_child[b] + n_children - 1, source.first_child[b] - 1, -1):
+                if source.num_points[child] > 0:
+                    stack[2 * stack_top], stack[2 * stack_top + 1] = a, child
+                    stack_top += 1
+
+
+cdef inline void _add_interaction(
+    _Expansions * expansions,
+    Py_ssize_t n_dims,
+    Py_ssize_t node,
+    double * center,
+    double * source,
+    double weight,
+    double * second_moment,
+    double distance,
+    double dof,
+    bint derivatives,
+) nogil:
+    """Add the expansion of the repulsion of a source node around the center
+    of mass of a receiving node to the receiving node's expansion. Without
+    `derivatives`, only the value of the expansion is updated. Without a
+    `second_moment`, the source node is treated as a point mass."""
+    cdef:
+        Py_ssize_t d, e, f, offset
+        double exponent = (dof + 1) / 2
+        double r[3]
+        double hessian_q[3][3]
+        double hessian_force[3][3][3]
+        double q, dq, ddq, g, dg, ddg
+
+    # The kernels and their first two derivatives w.r.t. the squared distance
+    q = dof / (dof + distance)
+    if dof != 1:
+        q = q ** exponent
+    dq = -exponent / (dof + distance) * q
+    ddq = exponent * (exponent + 1) / (dof + distance) ** 2 * q
+    g = q * q
+    dg = -2 * exponent / (dof + distance) * g
+    ddg = 2 * exponent * (2 * exponent + 1) / (dof + distance) ** 2 * g
+
+    for d in range(n_dims):
+        r[d] = center[d] - source[d]
+
+    expansions.q[node] += weight * q
+    for d in range(n_dims):
+        expansions.force[node * n_dims + d] += weight * g * r[d]
+
+    if not derivatives and second_moment == NULL:
+        return
+
+    for d in range(n_dims):
+        for e in range(n_dims):
+            hessian_q[d][e] = 4 * ddq * r[d] * r[e] + 2 * dq * (d == e)
+            for f in range(n_dims):
+                hessian_force[d][e][f] = 4 * ddg * r[d] * r[e] * r[f] + 2 * dg * (
+                    r[f] * (d == e) + r[e] * (d == f) + r[d] * (e == f)
+                )
+
+    # The source points have no dipole moment around their center of mass, so
+    # the first correction to summarizing them by it comes from their second
+    # moment. It is applied to the values only, since its effect on the
+    # derivatives is of the same order as the error of the expansion
+    if second_moment != NULL:
+        for d in range(n_dims):
+            for e in range(n_dims):
+                expansions.q[node] += 0.5 * second_moment[d * n_dims + e] * hessian_q[d][e]
+                for f in range(n_dims):
+                    expansions.force[node * n_dims + f] += \
+                        0.5 * second_moment[d * n_dims + e] * hessian_force[f][d][e]
+
+    if not derivatives:
+        return
+
+    for d in range(n_dims):
+        expansions.dq[node * n_dims + d] += weight * 2 * dq * r[d]
+        for e in range(n_dims):
+            offset = (node * n_dims + d) * n_dims + e
+            expansions.ddq[offset] += weight * hessian_q[d][e]
+            expansions.dforce[offset] += weight * (2 * dg * r[d] * r[e] + g * (d == e))
+            for f in range(n_dims):
+                expansions.ddforce[offset * n_dims + f] += weight * hessian_force[d][e][f]
+
+
+cdef inline void _exact_interactions(
+    double * point,
+    double * sources,
+    Py_ssize_t n_sources,
+    double weight,
+    Py_ssize_t n_dims,
+    double dof,
+    double * sum_Q,
+    double * force,
+) nogil:
+    """Add the repulsion of the source points, each with the given weight, on
+    a point, ignoring its duplicates."""
+    cdef:
+        Py_ssize_t j, d
+        double distance, q_ij
+        double * other
+
+    for j in range(n_sources):
+        other = &sources[j * n_dims]
+        if is_duplicate(other, point, n_dims):
+            continue
+        distance = EPSILON
+        for d in range(n_dims):
+            distance += (other[d] - point[d]) ** 2
 
-    # Check whether we can use this node as a summary
-    if node.is_leaf or node.length / sqrt(distance) < theta:
         q_ij = dof / (dof + distance)
         if dof != 1:
             q_ij = q_ij ** ((dof + 1) / 2)
-        sum_Q[0] += node.num_points * q_ij
+        sum_Q[0] += weight * q_ij
 
-        for d in range(node.n_dims):
-            gradient[d] -= node.num_points * q_ij ** 2 * (point[d] - node.center_of_mass[d])
+        for d in range(n_dims):
+            force[d] += weight * q_ij ** 2 * (point[d] - other[d])
 
+
+cdef void _node_moments(_TreeView * tree, Py_ssize_t n_dims, Py_ssize_t node) nogil:
+    """Compute the radius and second moment of a node from its points, or
+    from the ones of its children. The radius is then an upper bound."""
+    cdef:
+        Py_ssize_t child, k, d, e
+        double radius = 0, distance
+        double offset[3]
+        double * center = &tree.center_of_mass[node * n_dims]
+        double * second_moment = &tree.second_moment[node * n_dims * n_dims]
+
+    if tree.first_child[node] < 0:
+        for k in range(tree.first_point[node], tree.first_point[node] + tree.num_points[node]):
+            distance = 0
+            for d in range(n_dims):
+                offset[d] = tree.points[k * n_dims + d] - center[d]
+                distance += offset[d] ** 2
+            radius = fmax(radius, sqrt(distance))
+            for d in range(n_dims):
+                for e in range(n_dims):
+                    second_moment[d * n_dims + e] += offset[d] * offset[e]
+        tree.radius[node] = radius
         return
 
-    # Otherwise we have to look for summaries in the children
-    for d in range(1 << node.n_dims):
-        _estimate_negative_gradient_single(&node.children[d], point, gradient, sum_Q, theta, dof)
+    for child in range(tree.first_child[node], tree.first_child[node] + (1 << n_dims)):
+        if tree.num_points[child] == 0:
+            continue
+        distance = 0
+        for d in range(n_dims):
+            offset[d] = tree.center_of_mass[child * n_dims + d] - center[d]
+            distance += offset[d] ** 2
+        radius = fmax(radius, sqrt(distance) + tree.radius[child])
+        for d in range(n_dims):
+            for e in range(n_dims):
+                second_moment[d * n_dims + e] += \
+                    tree.second_moment[(child * n_dims + d) * n_dims + e] \
+                    + tree.num_points[child] * offset[d] * offset[e]
+    tree.radius[node] = radius
+
+
+cdef void _shift_expansion(
+    _TreeView * tree,
+    Py_ssize_t n_dims,
+    Py_ssize_t node,
+    _Expansions * expansions,
+) nogil:
+    """Add the expansion of a node, shifted to the centers of mass of its
+    children, to theirs."""
+    cdef:
+        Py_ssize_t child, d, e, f, offset, child_offset
+        double delta[3]
+
+    for child in range(tree.first_child[node], tree.first_child[node] + (1 << n_dims)):
+        if tree.num_points[child] == 0:
+            continue
+        for d in range(n_dims):
+            delta[d] = tree.center_of_mass[child * n_dims + d] - tree.center_of_mass[node * n_dims + d]
+
+        expansions.q[child] += expansions.q[node]
+        for d in range(n_dims):
+            expansions.q[child] += expansions.dq[node * n_dims + d] * delta[d]
+            expansions.dq[child * n_dims + d] += expansions.dq[node * n_dims + d]
+            expansions.force[child * n_dims + d] += expansions.force[node * n_dims + d]
+            for e in range(n_dims):
+                offset = (node * n_dims + d) * n_dims + e
+                child_offset = (child * n_dims + d) * n_dims + e
+                expansions.q[child] += 0.5 * expansions.ddq[offset] * delta[d] * delta[e]
+                expansions.dq[child * n_dims + d] += expansions.ddq[offset] * delta[e]
+                expansions.ddq[child_offset] += expansions.ddq[offset]
+                expansions.force[child * n_dims + d] += expansions.dforce[offset] * delta[e]
+                expansions.dforce[child_offset] += expansions.dforce[offset]
+                for f in range(n_dims):
+                    expansions.force[child * n_dims + d] += \
+                        0.5 * expansions.ddforce[offset * n_dims + f] * delta[e] * delta[f]
+                    expansions.dforce[child_offset] += \
+                        expansions.ddforce[offset * n_dims + f] * delta[f]
+                    expansions.ddforce[child_offset * n_dims + f] += \
+                        expansions.ddforce[offset * n_dims + f]
+
+
+cdef void _evaluate_expansion(
+    _TreeView * tree,
+    Py_ssize_t n_dims,
+    Py_ssize_t node,
+    Py_ssize_t * order,
+    _Expansions * expansions,
+    double * point_q,
+    double * point_force,
+    double * gradient,
+    double * sum_Qi,
+) nogil:
+    """Add the expansion of a leaf, evaluated at its points, to the repulsion
+    they received directly and write both to the points' original rows."""
+    cdef:
+        Py_ssize_t k, i, d, e, f, offset
+        double delta[3]
+        double force
+
+    for k in range(tree.first_point[node], tree.first_point[node] + tree.num_points[node]):
+        for d in range(n_dims):
+            delta[d] = tree.points[k * n_dims + d] - tree.center_of_mass[node * n_dims + d]
+
+        i = order[k]
+        sum_Qi[i] = point_q[k] + expansions.q[node]
+        for d in range(n_dims):
+            sum_Qi[i] += expansions.dq[node * n_dims + d] * delta[d]
+            force = point_force[k * n_dims + d] + expansions.force[node * n_dims + d]
+            for e in range(n_dims):
+                offset = (node * n_dims + d) * n_dims + e
+                sum_Qi[i] += 0.5 * expansions.ddq[offset] * delta[d] * delta[e]
+                force += expansions.dforce[offset] * delta[e]
+                for f in range(n_dims):
+                    force += 0.5 * expansions.ddforce[offset * n_dims + f] * delta[e] * delta[f]
+            gradient[i * n_dims + d] -= force
+
+
+cdef inline uint64_t splitmix64(uint64_t * state) nogil:
+    """Advance the state and return the next pseudo-random number."""
+    cdef uint64_t z
+    state[0] += 0x9E3779B97F4A7C15ULL
+    z = state[0]
+    z = (z ^ (z >> 30)) * 0xBF58476D1CE4E5B9ULL
+    z = (z ^ (z >> 27)) * 0x94D049BB133111EBULL
+    return z ^ (z >> 31)
+
+
+cdef inline bint _is_neighbor(
+    sparse_index_t[:] indices, Py_ssize_t start, Py_ssize_t end, Py_ssize_t j
+) nogil:
+    """Binary search for `j` among the sorted column indices of a row."""
+    cdef Py_ssize_t low = start, high = end, middle
+    while low < high:
+        middle = (low + high) // 2
+        if indices[middle] < j:
+            low = middle + 1
+        else:
+            high = middle
+    return low < end and indices[low] == j
+
+
+cdef inline void _add_repulsion(
+    double * point,
+    double * other,
+    double * gradient,
+    double * sum_Q,
+    double weight,
+    double dof,
+    Py_ssize_t n_dims,
+) nogil:
+    cdef:
+        double d_ij = 0, q_ij
+        Py_ssize_t d
+
+    for d in range(n_dims):
+        d_ij += (point[d] - other[d]) ** 2
+
+    q_ij = dof / (dof + d_ij)
+    if dof != 1:
+        q_ij = q_ij ** ((dof + 1) / 2)
+    sum_Q[0] += weight * q_ij
+
+    for d in range(n_dims):
+        gradient[d] -= weight * q_ij ** 2 * (point[d] - other[d])
+
+
+cpdef double estimate_negative_gradient_sampled(
+    sparse_index_t[:] indices,
+    sparse_index_t[:] indptr,
+    double[:, ::1] embedding,
+    double[:, ::1] reference_embedding,
+    double[:, ::1] gradient,
+    Py_ssize_t n_negative_samples=5,
+    Py_ssize_t batch_size=1,
+    uint64_t seed=0,
+    double dof=1,
+    Py_ssize_t num_threads=1,
+    bint pairwise_normalization=True,
+):
+    """Estimate the negative tSNE gradient from randomly sampled points.
+
+    Most of the repulsive forces acting on a point come from its nearest
+    neighbors. These are given by the sparsity pattern of P in `indices` and
+    `indptr`, whose rows must be sorted, and their forces are computed
+    exactly. The forces of all other points are estimated from
+    `n_negative_samples` points drawn uniformly from the reference embedding,
+    skipping any neighbors, which keeps the estimate unbiased. If `indptr` is
+    empty, all the forces are estimated from the samples.
+
+    Consecutive rows are split into blocks of `batch_size` points which share
+    the same samples, so the sampled points stay in cache for the whole
+    block. Each block draws its samples from its own random stream, derived
+    from `seed` and the block index, so the results do not depend on the
+    number of threads.
+
+    Notes
+    -----
+    Changes the gradient inplace to avoid needless memory allocation. As
+    such, this must be run before estimating the positive gradients, since
+    the negative gradient must be normalized at the end with the sum of
+    q_{ij}s.
+
+    When `pairwise_normalization` is set, the embedding is its own reference
+    and a point is never used as its own negative sample.
+
+    """
+    cdef:
+        Py_ssize_t num_points = embedding.shape[0]
+        Py_ssize_t n_dims = embedding.shape[1]
+        Py_ssize_t n_candidates = reference_embedding.shape[0] - pairwise_normalization
+        bint has_neighbors = indptr.shape[0] == num_points + 1
+        Py_ssize_t n_blocks
+        double[::1] sum_Qi = np.zeros(num_points, dtype=float)
+        double sum_Q = 0, scale
+        uint64_t state
+
+        Py_ssize_t * samples
+        Py_ssize_t block, i, j, k, d
+
+    if num_threads < 1:
+        num_threads = 1
+    if batch_size < 1:
+        batch_size = 1
+    if n_negative_samples < 1 or n_candidates < 1:
+        return 0
+
+    n_blocks = (num_points + batch_size - 1) // batch_size
+    # Every sample stands in for `n_candidates / n_negative_samples` points,
+    # so the estimates of the forces and normalization are unbiased
+    scale = <double>n_candidates / n_negative_samples
+
+    with nogil, parallel(num_threads=num_threads):
+        samples = <Py_ssize_t *>malloc(n_negative_samples * sizeof(Py_ssize_t))
+        if not samples:
+            with gil:
+                raise MemoryError()
+
+        for block in prange(n_blocks, schedule="guided"):
+            state = seed ^ (<uint64_t>block * 0xD1B54A32D192ED03ULL)
+            for k in range(n_negative_samples):
+                samples[k] = splitmix64(&state) % n_candidates
+
+            for i in range(block * batch_size, min((block + 1) * batch_size, num_points)):
+                if has_neighbors:
+                    for k in range(indptr[i], indptr[i + 1]):
+                        _add_repulsion(
+                            &embedding[i, 0], &reference_embedding[indices[k], 0],
+                            &gradient[i, 0], &sum_Qi[i], 1, dof, n_dims,
+                        )
+
+                for k in range(n_negative_samples):
+                    j = samples[k]
+                    # Skip over the point itself, so every other point is
+                    # sampled with equal probability
+                    if pairwise_normalization and j >= i:
+                        j = j + 1
+                    if has_neighbors and _is_neighbor(indices, indptr[i], indptr[i + 1], j):
+                        continue
+
+                    _add_repulsion(
+                        &embedding[i, 0], &reference_embedding[j, 0],
+                        &gradient[i, 0], &sum_Qi[i], scale, dof, n_dims,
+                    )
+
+        free(samples)
+
+    for i in range(num_points):
+        sum_Q += sum_Qi[i]
+
+    # Normalize q_{ij}s
+    for i in range(gradient.shape[0]):
+        for d in range(gradient.shape[1]):
+            if pairwise_normalization:
+                gradient[i, d] /= sum_Q + EPSILON
+            else:
+                gradient[i, d] /= sum_Qi[i] + EPSILON
+
+    return sum_Q
+
+
+# The number of points in a tile of the exact kernel. A pair of tiles of
+# three dimensional points takes up 12kB, which stays in the L1 cache
+cdef Py_ssize_t EXACT_TILE_SIZE = 256
+
+
+cpdef double estimate_negative_gradient_exact(
+    double[:, ::1] embedding,
+    double[:, ::1] reference_embedding,
+    double[:, ::1] gradient,
+    double dof=1,
+    Py_ssize_t num_threads=1,
+    bint pairwise_normalization=True,
+    double[:, :, ::1] thread_gradient=None,
+):
+    """Compute the negative tSNE gradient exactly, summing over all pairs of
+    points.
+
+    The points are split into tiles of `EXACT_TILE_SIZE` points, and the
+    interactions are computed tile by tile, so the points of both tiles stay
+    in cache. When `pairwise_normalization` is set, the embedding is its own
+    reference and every pair of points is visited only once, adding the
+    forces to both points. Every thread then accumulates the forces in its
+    own buffer, so the results may differ with the number of threads, but
+    only up to rounding. Otherwise, the threads split the points of the
+    embedding between them. The buffers of the threads may be passed in as
+    `thread_gradient`, with shape (num_threads, num_points, n_dims), so they
+    are not allocated on every call.
+
+    Unlike the approximations, points coinciding with other points are
+    repelled by them. Only the interaction of a point with itself is left
+    out.
+
+    Notes
+    -----
+    Changes the gradient inplace to avoid needless memory allocation. As
+    such, this must be run before estimating the positive gradients, since
+    the negative gradient must be normalized at the end with the sum of
+    q_{ij}s.
+
+    """
+    cdef:
+        Py_ssize_t num_points = embedding.shape[0]
+        Py_ssize_t n_dims = embedding.shape[1]
+        Py_ssize_t n_tiles = (num_points + EXACT_TILE_SIZE - 1) // EXACT_TILE_SIZE
+        Py_ssize_t n_reference_tiles
+        Py_ssize_t i, j, d, t, tile, pair, n_pairs
+        int quarters = _kernel_quarters(dof)
+        double sum_Q = 0
+        double[::1] sum_Qi
+        double[:, ::1] thread_sum_Q
+
+    if num_threads < 1:
+        num_threads = 1
+    if num_points == 0 or n_dims == 0:
+        return 0
+
+    if pairwise_normalization:
+        n_pairs = n_tiles * (n_tiles + 1) // 2
+
+        if thread_gradient is None or thread_gradient.shape[0] < num_threads \
+                or thread_gradient.shape[1] != num_points \
+                or thread_gradient.shape[2] != n_dims:
+            thread_gradient = np.zeros((num_threads, num_points, n_dims), dtype=float)
+        else:
+            with nogil:
+                for t in prange(num_threads, schedule="static", num_threads=num_threads):
+                    memset(&thread_gradient[t, 0, 0], 0, num_points * n_dims * sizeof(double))
+
+        # Keep the sums of the threads on separate cache lines
+        thread_sum_Q = np.zeros((num_threads, 8), dtype=float)
+        with nogil, parallel(num_threads=num_threads):
+            t = threadid()
+            for pair in prange(n_pairs, schedule="guided"):
+                i = _upper_triangle_row(pair, n_tiles)
+                j = i + pair - (i * (2 * n_tiles - i + 1)) // 2
+                thread_sum_Q[t, 0] += _exact_tile_pair(
+                    &embedding[0, 0], &thread_gradient[t, 0, 0], n_dims, num_points,
+                    i * EXACT_TILE_SIZE, j * EXACT_TILE_SIZE, dof, quarters,
+                )
+
+        for t in range(num_threads):
+            sum_Q += thread_sum_Q[t, 0]
+            for i in range(num_points):
+                for d in range(n_dims):
+                    gradient[i, d] += thread_gradient[t, i, d]
+
+        for i in range(num_points):
+            for d in range(n_dims):
+                gradient[i, d] /= sum_Q + EPSILON
+
+    else:
+        sum_Qi = np.zeros(num_points, dtype=float)
+        n_reference_tiles = (
+            reference_embedding.shape[0] + EXACT_TILE_SIZE - 1
+        ) // EXACT_TILE_SIZE
+        if n_reference_tiles > 0:
+            with nogil:
+                for tile in prange(n_tiles, schedule="guided", num_threads=num_threads):
+                    _exact_tile_reference(
+                        &embedding[0, 0], &reference_embedding[0, 0], &gradient[0, 0],
+                        &sum_Qi[0], n_dims, num_points, reference_embedding.shape[0],
+                        tile * EXACT_TILE_SIZE, dof, quarters,
+                    )
+
+        for i in range(num_points):
+            sum_Q += sum_Qi[i]
+            for d in range(n_dims):
+                gradient[i, d] /= sum_Qi[i] + EPSILON
+
+    return sum_Q
+
+
+cdef inline Py_ssize_t _upper_triangle_row(Py_ssize_t index, Py_ssize_t n) nogil:
+    """Find the row of the `index`-th entry of the upper triangle, including
+    the diagonal, of an n x n matrix enumerated row by row."""
+    cdef Py_ssize_t row = 0, row_start = 0
+    while row_start + n - row <= index:
+        row_start += n - row
+        row += 1
+    return row
+
+
+cdef double _exact_tile_pair(
+    double * embedding,
+    double * gradient,
+    Py_ssize_t n_dims,
+    Py_ssize_t num_points,
+    Py_ssize_t start_i,
+    Py_ssize_t start_j,
+    double dof,
+    int quarters,
+) nogil:
+    """Add the forces between the points of two tiles to both, and return the
+    sum of their q_{ij}s. The pairs within a tile are visited once."""
+    cdef:
+        Py_ssize_t i, j, d
+        Py_ssize_t end_i = min(start_i + EXACT_TILE_SIZE, num_points)
+        Py_ssize_t end_j = min(start_j + EXACT_TILE_SIZE, num_points)
+        double distance, q_ij, diff, sum_Q = 0
+        double x, y, z, dx, dy, dz, force_x, force_y, force_z
+        double * point
+        double * other
+
+    # Two and three dimensional points have the loops over dimensions
+    # unrolled, and the forces on the point of the outer loop accumulated in
+    # registers
+    if n_dims == 2:
+        for i in range(start_i, end_i):
+            x, y = embedding[2 * i], embedding[2 * i + 1]
+            force_x = force_y = 0
+            for j in range(max(start_j, i + 1), end_j):
+                dx = x - embedding[2 * j]
+                dy = y - embedding[2 * j + 1]
+                q_ij = _kernel(dx * dx + dy * dy, dof, quarters)
+                sum_Q += q_ij
+                q_ij *= q_ij
+                force_x += q_ij * dx
+                force_y += q_ij * dy
+                gradient[2 * j] += q_ij * dx
+                gradient[2 * j + 1] += q_ij * dy
+            gradient[2 * i] -= force_x
+            gradient[2 * i + 1] -= force_y
+        return 2 * sum_Q
+
+    if n_dims == 3:
+        for i in range(start_i, end_i):
+            x, y, z = embedding[3 * i], embedding[3 * i + 1], embedding[3 * i + 2]
+            force_x = force_y = force_z = 0
+            for j in range(max(start_j, i + 1), end_j):
+                dx = x - embedding[3 * j]
+                dy = y - embedding[3 * j + 1]
+                dz = z - embedding[3 * j + 2]
+                q_ij = _kernel(dx * dx + dy * dy + dz * dz, dof, quarters)
+                sum_Q += q_ij
+                q_ij *= q_ij
+                force_x += q_ij * dx
+                force_y += q_ij * dy
+                force_z += q_ij * dz
+                gradient[3 * j] += q_ij * dx
+                gradient[3 * j + 1] += q_ij * dy
+                gradient[3 * j + 2] += q_ij * dz
+            gradient[3 * i] -= force_x
+            gradient[3 * i + 1] -= force_y
+            gradient[3 * i + 2] -= force_z
+        return 2 * sum_Q
+
+    for i in range(start_i, end_i):
+        point = &embedding[i * n_dims]
+        for j in range(max(start_j, i + 1), end_j):
+            other = &embedding[j * n_dims]
+            distance = 0
+            for d in range(n_dims):
+                distance += (point[d] - other[d]) ** 2
+
+            q_ij = _kernel(distance, dof, quarters)
+            sum_Q += 2 * q_ij
+            q_ij *= q_ij
+            for d in range(n_dims):
+                diff = q_ij * (point[d] - other[d])
+                gradient[i * n_dims + d] -= diff
+                gradient[j * n_dims + d] += diff
+
+    return sum_Q
+
+
+cdef void _exact_tile_reference(
+    double * embedding,
+    double * reference_embedding,
+    double * gradient,
+    double * sum_Qi,
+    Py_ssize_t n_dims,
+    Py_ssize_t num_points,
+    Py_ssize_t num_reference_points,
+    Py_ssize_t start_i,
+    double dof,
+    int quarters,
+) nogil:
+    """Add the forces of all the reference points to the points of a tile,
+    going through the reference points tile by tile."""
+    cdef:
+        Py_ssize_t i, j, d, tile, start_j
+        Py_ssize_t end_i = min(start_i + EXACT_TILE_SIZE, num_points)
+        double distance, q_ij
+        double * point
+        double * other
+
+    for tile in range((num_reference_points + EXACT_TILE_SIZE - 1) // EXACT_TILE_SIZE):
+        start_j = tile * EXACT_TILE_SIZE
+        for i in range(start_i, end_i):
+            point = &embedding[i * n_dims]
+            for j in range(start_j, min(start_j + EXACT_TILE_SIZE, num_reference_points)):
+                other = &reference_embedding[j * n_dims]
+                distance = 0
+                for d in range(n_dims):
+                    distance += (point[d] - other[d]) ** 2
+
+                q_ij = _kernel(distance, dof, quarters)
+                sum_Qi[i] += q_ij
+                q_ij *= q_ij
+                for d in range(n_dims):
+                    gradient[i * n_dims + d] -= q_ij * (point[d] - other[d])
+
+
+# The one dimensional Cauchy kernel sums are computed with series expansions
+# of up to `EXACT_1D_ORDER` terms. Two intervals whose combined radius is at
+# most `EXACT_1D_SEPARATION` times their distance interact through their
+# expansions, each with a relative error of at most about 0.4 ** 32 < 1e-12
+cdef enum:
+    EXACT_1D_ORDER = 32
+
+cdef double EXACT_1D_SEPARATION = 0.4
+cdef Py_ssize_t EXACT_1D_LEAF_SIZE = 64
+
+
+cdef struct _IntervalView:
+    double * points
+    Py_ssize_t * lo
+    Py_ssize_t * hi
+    Py_ssize_t * first_child
+    double * center
+    double * radius
+    # The expansions are kept in powers of distances relative to the scale of
+    # their node, so the coefficients stay in range for large intervals
+    double * scale
+
+
+cdef double[:, ::1] _binomial_coefficients():
+    """The binomial coefficients needed to shift the expansions."""
+    cdef:
+        double[:, ::1] binomial = np.zeros((2 * EXACT_1D_ORDER, 2 * EXACT_1D_ORDER))
+        Py_ssize_t k, l
+
+    for k in range(2 * EXACT_1D_ORDER):
+        binomial[k, 0] = 1
+        for l in range(1, k + 1):
+            binomial[k, l] = binomial[k - 1, l - 1] + binomial[k - 1, l]
+    return binomial
+
+
+cdef class _IntervalTree:
+    """A binary tree over one dimensional points, sorting them and splitting
+    them in halves until at most `leaf_size` are left. Node `i` holds the
+    sorted points `points[lo[i]:hi[i]]`, and `order` maps them back to the
+    original ones. The nodes are stored level by level, and the children of
+    a node next to each other, starting at `first_child`, which is -1 for
+    leaves.
+
+    The multipole moments of the nodes depend only on the points, so they
+    are computed once, when the tree first acts as a reference tree. This
+    way, the tree of a fixed reference embedding can be reused between
+    gradient evaluations."""
+    cdef:
+        double[::1] points
+        Py_ssize_t[::1] order
+        Py_ssize_t n_nodes, n_levels
+        Py_ssize_t[::1] level_offsets, lo, hi, first_child
+        double[::1] center, radius, scale
+        bint has_moments
+        double[:, ::1] moments
+
+    def __init__(self, double[::1] points, Py_ssize_t leaf_size):
+        cdef:
+            Py_ssize_t num_points = points.shape[0]
+            # Leaves hold at least half of `leaf_size` points
+            Py_ssize_t max_nodes = 4 * (num_points // leaf_size + 1)
+            Py_ssize_t node, start, end, middle, child
+
+        self.order = np.argsort(points).astype(np.intp)
+        points = self.points = np.asarray(points)[self.order]
+        self.has_moments = False
+        self.lo = np.zeros(max_nodes, dtype=np.intp)
+        self.hi = np.zeros(max_nodes, dtype=np.intp)
+        self.first_child = np.full(max_nodes, -1, dtype=np.intp)
+        self.center = np.zeros(max_nodes, dtype=float)
+        self.radius = np.zeros(max_nodes, dtype=float)
+        self.scale = np.zeros(max_nodes, dtype=float)
+
+        self.lo[0], self.hi[0] = 0, num_points
+        self.n_nodes = 1
+        level_offsets = [0]
+        start = 0
+        while start < self.n_nodes:
+            end = self.n_nodes
+            for node in range(start, end):
+                self.center[node] = (points[self.lo[node]] + points[self.hi[node] - 1]) / 2
+                self.radius[node] = (points[self.hi[node] - 1] - points[self.lo[node]]) / 2
+                self.scale[node] = fmax(self.radius[node], 1)
+                if self.hi[node] - self.lo[node] <= leaf_size:
+                    continue
+
+                middle = (self.lo[node] + self.hi[node]) // 2
+                child = self.first_child[node] = self.n_nodes
+                self.lo[child], self.hi[child] = self.lo[node], middle
+                self.lo[child + 1], self.hi[child + 1] = middle, self.hi[node]
+                self.n_nodes += 2
+
+            level_offsets.append(end)
+            start = end
+
+        self.n_levels = len(level_offsets) - 1
+        self.level_offsets = np.array(level_offsets, dtype=np.intp)
+
+    def is_built_from(self, double[::1] points):
+        """Check whether the tree holds exactly the given points, e.g. to
+        decide whether a cached tree can be reused."""
+        cdef Py_ssize_t i
+        if points.shape[0] != self.points.shape[0]:
+            return False
+        for i in range(points.shape[0]):
+            if self.points[i] != points[self.order[i]]:
+                return False
+        return True
+
+    cdef void compute_moments(self, double[:, ::1] binomial, Py_ssize_t num_threads) except *:
+        """Compute the multipole moments of the nodes, from the leaves up,
+        unless they are already known."""
+        cdef:
+            _IntervalView view = self.view()
+            Py_ssize_t level, start, end, node
+
+        if self.has_moments:
+            return
+        self.moments = np.zeros((self.n_nodes, EXACT_1D_ORDER), dtype=float)
+        with nogil:
+            for level in range(self.n_levels - 1, -1, -1):
+                start, end = self.level_offsets[level], self.level_offsets[level + 1]
+                for node in prange(start, end, num_threads=num_threads):
+                    _interval_moments(&view, node, &binomial[0, 0], &self.moments[0, 0])
+        self.has_moments = True
+
+    cdef _IntervalView view(self):
+        cdef _IntervalView view
+        view.points = &self.points[0]
+        view.lo, view.hi = &self.lo[0], &self.hi[0]
+        view.first_child = &self.first_child[0]
+        view.center, view.radius = &self.center[0], &self.radius[0]
+        view.scale = &self.scale[0]
+        return view
+
+
+cpdef _IntervalTree interval_tree(double[::1] points):
+    """Build the tree of a one dimensional reference embedding, which can be
+    passed to `estimate_negative_gradient_exact_1d` repeatedly."""
+    return _IntervalTree(points, EXACT_1D_LEAF_SIZE)
+
+
+cpdef double estimate_negative_gradient_exact_1d(
+    double[::1] embedding,
+    double[::1] reference_embedding,
+    double[::1] gradient,
+    Py_ssize_t num_threads=1,
+    bint pairwise_normalization=True,
+    _IntervalTree reference_tree=None,
+) except? -1:
+    """Compute the negative tSNE gradient of a one dimensional embedding with
+    the Cauchy kernel in time linear in the number of points after sorting
+    them. The expansions are truncated, so the gradient is accurate to a
+    relative error of about 1e-12 rather than to machine precision.
+
+    With `d = x_i - x_j`, the kernel is `q_ij = Im(1 / (d - i))` and the
+    repulsive force `q_ij^2 d = Im(1 / (d - i)^2) / 2`. Both are sums of
+    the Cauchy kernel `1 / (z - x_j)` evaluated at `z = x_i - i`, which lies
+    at distance at least one from every point. The sums are computed with a
+    fast multipole method on binary trees over the sorted points and
+    reference points. The multipole expansions of the reference points of
+    a node are converted into local expansions of the points of another
+    node whenever the nodes are well separated, taking into account the
+    shift of `z` off the real line, so nearby points whose intervals are
+    small enough also interact through their expansions. Only the remaining
+    pairs of leaves are summed over directly.
+
+    Like `estimate_negative_gradient_exact`, points coinciding with other
+    points are repelled by them, and only the interaction of a point with
+    itself is left out. The embedding is its own reference when
+    `pairwise_normalization` is set. Otherwise, the tree of the reference
+    embedding, as returned by `interval_tree`, may be passed in as
+    `reference_tree`, so it is built only once.
+
+    Notes
+    -----
+    Changes the gradient inplace to avoid needless memory allocation. As
+    such, this must be run before estimating the positive gradients, since
+    the negative gradient must be normalized at the end with the sum of
+    q_{ij}s.
+
+    """
+    cdef:
+        Py_ssize_t num_points = embedding.shape[0]
+        Py_ssize_t i, k, t, node, level, start, end
+        double sum_Q = 0
+        double[::1] sum_Qi = np.zeros(num_points, dtype=float)
+        Py_ssize_t[::1] order, tasks
+        _IntervalTree targets, sources
+        _IntervalView target_view, source_view
+        double[:, ::1] binomial = _binomial_coefficients()
+        double[:, ::1] moments
+        double complex[:, ::1] local
+        # The interactions summed over directly and the results, in sorted order
+        double[::1] point_q = np.zeros(num_points, dtype=float)
+        double[::1] point_force = np.zeros(num_points, dtype=float)
+        Py_ssize_t stack_size
+        Py_ssize_t * stack
+
+    if num_threads < 1:
+        num_threads = 1
+    if num_points == 0 or reference_embedding.shape[0] == 0:
+        return 0
+
+    targets = _IntervalTree(embedding, EXACT_1D_LEAF_SIZE)
+    order = targets.order
+    if pairwise_normalization:
+        sources = targets
+    elif reference_tree is not None:
+        if reference_tree.points.shape[0] != reference_embedding.shape[0]:
+            raise ValueError("The tree must be built from the reference embedding.")
+        sources = reference_tree
+    else:
+        sources = _IntervalTree(reference_embedding, EXACT_1D_LEAF_SIZE)
+    target_view, source_view = targets.view(), sources.view()
+
+    # Compute the multipole expansions of the reference points
+    sources.compute_moments(binomial, num_threads)
+    moments = sources.moments
+    local = np.zeros((targets.n_nodes, EXACT_1D_ORDER), dtype=np.complex128)
+
+    # Every pair of nodes on the stack has a parent pair, one of whose nodes
+    # was split, so the stack never grows past the siblings along the deepest
+    # chain of splits
+    stack_size = 2 * (targets.n_levels + sources.n_levels) + 1
+
+    # Like in the dual-tree Barnes-Hut method, the points are split up into
+    # subtrees that are processed independently, so every thread writes only
+    # to its own nodes and points
+    for level in range(targets.n_levels):
+        if targets.level_offsets[level + 1] - targets.level_offsets[level] >= 64:
+            break
+    tasks = np.concatenate([
+        np.flatnonzero(np.asarray(targets.first_child[:targets.level_offsets[level]]) < 0),
+        np.arange(targets.level_offsets[level], targets.level_offsets[level + 1]),
+    ]).astype(np.intp)
+
+    with nogil, parallel(num_threads=num_threads):
+        stack = <Py_ssize_t *>malloc(2 * stack_size * sizeof(Py_ssize_t))
+        if not stack:
+            with gil:
+                raise MemoryError()
+
+        for t in prange(tasks.shape[0], schedule="dynamic"):
+            _interval_interactions(
+                &target_view, &source_view, tasks[t], stack, &binomial[0, 0],
+                &moments[0, 0], &local[0, 0], &point_q[0], &point_force[0],
+            )
+
+        free(stack)
+
+    with nogil:
+        # Pass the local expansions down to the leaves, and evaluate them at
+        # their points
+        for level in range(targets.n_levels - 1):
+            start, end = targets.level_offsets[level], targets.level_offsets[level + 1]
+            for node in prange(start, end, num_threads=num_threads):
+                _shift_local_expansion(&target_view, node, &binomial[0, 0], &local[0, 0])
+
+        for node in prange(targets.n_nodes, num_threads=num_threads, schedule="guided"):
+            if target_view.first_child[node] < 0:
+                _evaluate_local_expansion(
+                    &target_view, node, &local[0, 0], &point_q[0], &point_force[0],
+                )
+
+    for k in range(num_points):
+        i = order[k]
+        # Every point was included in its own sums, with q_ii = 1 and no force
+        sum_Qi[i] = point_q[k] - 1 if pairwise_normalization else point_q[k]
+        gradient[i] -= point_force[k]
+        sum_Q += sum_Qi[i]
+
+    # Normalize q_{ij}s
+    for i in range(num_points):
+        if pairwise_normalization:
+            gradient[i] /= sum_Q + EPSILON
+        else:
+            gradient[i] /= sum_Qi[i] + EPSILON
+
+    return sum_Q
+
+
+cdef void _interval_moments(
+    _IntervalView * tree, Py_ssize_t node, double * binomial, double * moments
+) nogil:
+    """Compute the moments `sum_j ((x_j - center) / scale)^k` of the points of
+    a node, directly for leaves, and from the moments of the children for the
+    other nodes."""
+    cdef:
+        Py_ssize_t i, k, m, child
+        double power, offset, ratio, shift
+        double * moment = &moments[node * EXACT_1D_ORDER]
+        double * child_moment
+        double scaled[EXACT_1D_ORDER]
+        double shift_power[EXACT_1D_ORDER]
+
+    if tree.first_child[node] < 0:
+        for i in range(tree.lo[node], tree.hi[node]):
+            offset = (tree.points[i] - tree.center[node]) / tree.scale[node]
+            power = 1
+            for k in range(EXACT_1D_ORDER):
+                moment[k] += power
+                power *= offset
+        return
+
+    for child in range(tree.first_child[node], tree.first_child[node] + 2):
+        child_moment = &moments[child * EXACT_1D_ORDER]
+        ratio = tree.scale[child] / tree.scale[node]
+        shift = (tree.center[child] - tree.center[node]) / tree.scale[node]
+        power = 1
+        for k in range(EXACT_1D_ORDER):
+            scaled[k] = child_moment[k] * power
+            power *= ratio
+        power = 1
+        for k in range(EXACT_1D_ORDER):
+            shift_power[k] = power
+            power *= shift
+
+        for k in range(EXACT_1D_ORDER):
+            for m in range(k + 1):
+                moment[k] += binomial[k * 2 * EXACT_1D_ORDER + m] * scaled[m] * shift_power[k - m]
+
+
+cdef void _interval_interactions(
+    _IntervalView * targets,
+    _IntervalView * sources,
+    Py_ssize_t task,
+    Py_ssize_t * stack,
+    double * binomial,
+    double * moments,
+    double complex * local,
+    double * point_q,
+    double * point_force,
+) nogil:
+    """Traverse the pairs of the subtree of `task` and the reference tree,
+    expanding the interactions of well separated nodes, and summing over the
+    pairs of points of the remaining leaves directly."""
+    cdef:
+        Py_ssize_t n_pairs = 1, target, source, child, i, j
+        double distance, diff, q_ij, sum_q, force
+
+    stack[0], stack[1] = task, 0
+    while n_pairs > 0:
+        n_pairs -= 1
+        target, source = stack[2 * n_pairs], stack[2 * n_pairs + 1]
+
+        distance = targets.center[target] - sources.center[source]
+        if targets.radius[target] + sources.radius[source] \
+                < EXACT_1D_SEPARATION * sqrt(distance * distance + 1):
+            _expand_interaction(
+                targets, sources, target, source, binomial, moments, local,
+            )
+
+        elif targets.first_child[target] < 0 and sources.first_child[source] < 0:
+            for i in range(targets.lo[target], targets.hi[target]):
+                sum_q = force = 0
+                for j in range(sources.lo[source], sources.hi[source]):
+                    diff = targets.points[i] - sources.points[j]
+                    q_ij = 1 / (1 + diff * diff)
+                    sum_q += q_ij
+                    force += q_ij * q_ij * diff
+                point_q[i] += sum_q
+                point_force[i] += force
+
+        # Split the larger of the nodes
+        elif sources.first_child[source] < 0 or (
+            targets.first_child[target] >= 0
+            and targets.radius[target] >= sources.radius[source]
+        ):
+            for child in range(targets.first_child[target], targets.first_child[target] + 2):
+                stack[2 * n_pairs], stack[2 * n_pairs + 1] = child, source
+                n_pairs += 1
+
+        else:
+            for child in range(sources.first_child[source], sources.first_child[source] + 2):
+                stack[2 * n_pairs], stack[2 * n_pairs + 1] = target, child
+                n_pairs += 1
+
+
+cdef inline void _expand_interaction(
+    _IntervalView * targets,
+    _IntervalView * sources,
+    Py_ssize_t target,
+    Py_ssize_t source,
+    double * binomial,
+    double * moments,
+    double complex * local,
+) nogil:
+    """Add the multipole expansion of the reference points of `source` to the
+    local expansion of `target` around `center - i`."""
+    cdef:
+        Py_ssize_t k, l, n_terms
+        double separation
+        double complex u = 1 / (targets.center[target] - sources.center[source] - 1j)
+        double complex target_ratio = targets.scale[target] * u
+        double complex source_ratio = sources.scale[source] * u
+        double complex power, total
+        double complex terms[EXACT_1D_ORDER]
+        double * moment = &moments[source * EXACT_1D_ORDER]
+        double complex * coefficient = &local[target * EXACT_1D_ORDER]
+
+    # The terms of total degree n are bounded by the n-th power of the
+    # separation, so closer nodes need more of them. The forces come from the
+    # derivative of the expansion, so one more is kept for it, even when both
+    # nodes hold only duplicates
+    separation = (targets.radius[target] + sources.radius[source]) * sqrt(
+        u.real * u.real + u.imag * u.imag
+    )
+    n_terms = EXACT_1D_ORDER
+    if separation < EXACT_1D_SEPARATION / 2:
+        n_terms = min(
+            2 + <Py_ssize_t>(EXACT_1D_ORDER * log(EXACT_1D_SEPARATION) / log(separation)),
+            EXACT_1D_ORDER,
+        ) if separation > 0 else 2
+
+    power = 1
+    for k in range(n_terms):
+        terms[k] = moment[k] * power
+        power = power * source_ratio
+
+    power = u
+    for l in range(n_terms):
+        total = 0
+        for k in range(n_terms - l):
+            total = total + binomial[(k + l) * 2 * EXACT_1D_ORDER + l] * terms[k]
+        coefficient[l] = coefficient[l] + power * total
+        power = -power * target_ratio
+
+
+cdef void _shift_local_expansion(
+    _IntervalView * tree, Py_ssize_t node, double * binomial, double complex * local
+) nogil:
+    """Add the local expansion of a node to the expansions of its children."""
+    cdef:
+        Py_ssize_t k, m, child
+        double power, ratio, shift
+        double complex total
+        double complex * coefficient = &local[node * EXACT_1D_ORDER]
+        double complex * child_coefficient
+        double shift_power[EXACT_1D_ORDER]
+
+    if tree.first_child[node] < 0:
+        return
+
+    for child in range(tree.first_child[node], tree.first_child[node] + 2):
+        child_coefficient = &local[child * EXACT_1D_ORDER]
+        ratio = tree.scale[child] / tree.scale[node]
+        shift = (tree.center[child] - tree.center[node]) / tree.scale[node]
+        power = 1
+        for k in range(EXACT_1D_ORDER):
+            shift_power[k] = power
+            power *= shift
+
+        power = 1
+        for m in range(EXACT_1D_ORDER):
+            total = 0
+            for k in range(m, EXACT_1D_ORDER):
+                total = total + binomial[k * 2 * EXACT_1D_ORDER + m] * shift_power[k - m] * coefficient[k]
+            child_coefficient[m] = child_coefficient[m] + power * total
+            power *= ratio
+
+
+cdef void _evaluate_local_expansion(
+    _IntervalView * tree,
+    Py_ssize_t node,
+    double complex * local,
+    double * point_q,
+    double * point_force,
+) nogil:
+    """Add the local expansion of a leaf, and its derivative, evaluated at
+    its points to their sums of q_{ij}s and forces."""
+    cdef:
+        Py_ssize_t i, l, n_terms = EXACT_1D_ORDER
+        double offset, ratio
+        double complex value, derivative
+        double complex * coefficient = &local[node * EXACT_1D_ORDER]
+
+    # The terms of the expansion are bounded by the powers of the radius of
+    # the leaf relative to the distance to the reference points it was
+    # expanded from, so leaves of densely packed points need only a few of
+    # them. One more is kept for the derivative
+    ratio = tree.radius[node] / tree.scale[node] / (1 - EXACT_1D_SEPARATION)
+    if ratio < EXACT_1D_SEPARATION:
+        n_terms = min(
+            2 + <Py_ssize_t>(EXACT_1D_ORDER * log(EXACT_1D_SEPARATION) / log(ratio)),
+            EXACT_1D_ORDER,
+        ) if ratio > 0 else 2
+
+    for i in range(tree.lo[node], tree.hi[node]):
+        offset = (tree.points[i] - tree.center[node]) / tree.scale[node]
+        value = derivative = 0
+        for l in range(n_terms - 1, -1, -1):
+            derivative = derivative * offset + value
+            value = value * offset + coefficient[l]
+        # The expansion is of `sum_j 1 / (z - x_j)`, whose derivative is
+        # `-sum_j 1 / (z - x_j)^2`
+        point_q[i] += value.imag
+        point_force[i] -= derivative.imag / tree.scale[node] / 2
 
 
 cdef inline double squared_cauchy_1d(double x, double y) nogil:
@@ -313,13 +2755,33 @@ cdef double[::1] compute_kernel_tilde_1d(
     return kernel_tilde
 
 
+cdef inline double _start_timer(dict timings):
+    if timings is None:
+        return 0
+    return perf_counter()
+
+
+cdef double _lap(dict timings, str name, double start):
+    """Add the time elapsed since `start` to `timings[name]` and return the
+    current time. Does nothing if `timings` is None."""
+    cdef double now
+    if timings is None:
+        return 0
+    now = perf_counter()
+    timings[name] = timings.get(name, 0) + now - start
+    return now
+
+
 cpdef double estimate_negative_gradient_fft_1d(
     double[::1] embedding,
     double[::1] gradient,
     Py_ssize_t n_interpolation_points=3,
     Py_ssize_t min_num_intervals=10,
     double ints_in_interval=1,
+    dict timings=None,
 ):
+    cdef double start = _start_timer(timings)
+
     cdef Py_ssize_t i, j, d, box_idx, n_samples = embedding.shape[0]
     cdef double y_max = -INFINITY, y_min = INFINITY
     # Determine the min/max values of the embedding
@@ -389,9 +2851,13 @@ cpdef double estimate_negative_gradient_fft_1d(
             for d in range(n_terms):
                 w_coefficients[box_idx + j, d] += interpolated_values[i, j] * q_j[i, d]
 
+    start = _lap(timings, "interpolation", start)
+
     # STEP 2: Compute the kernel values evaluated at the interpolation nodes
     cdef double[:, ::1] y_tilde_values = matrix_multiply_fft_1d(kernel_tilde, w_coefficients)
 
+    start = _lap(timings, "convolution", start)
+
     # STEP 3: Compute the potentials \tilde{\phi(y_i)}
     cdef double[:, ::1] phi = np.zeros((n_samples, n_terms), dtype=float)
     for i in range(n_samples):
@@ -416,6 +2882,8 @@ cpdef double estimate_negative_gradient_fft_1d(
     for i in range(n_samples):
         gradient[i] -= (embedding[i] * phi[i, 0] - phi[i, 1]) / (sum_Q + EPSILON)
 
+    _lap(timings, "potentials", start)
+
     return sum_Q
 
 
@@ -426,7 +2894,10 @@ cpdef double estimate_negative_gradient_fft_1d_with_reference(
     Py_ssize_t n_interpolation_points=3,
     Py_ssize_t min_num_intervals=10,
     double ints_in_interval=1,
+    dict timings=None,
 ):
+    cdef double start = _start_timer(timings)
+
     cdef:
         Py_ssize_t i, j, d, box_idx
         Py_ssize_t n_samples = embedding.shape[0]
@@ -518,9 +2989,13 @@ cpdef double estimate_negative_gradient_fft_1d_with_reference(
             for d in range(n_terms):
                 w_coefficients[box_idx + j, d] += reference_interpolated_values[i, j] * q_j[i, d]
 
+    start = _lap(timings, "interpolation", start)
+
     # STEP 2: Compute the kernel values evaluated at the interpolation nodes
     cdef double[:, ::1] y_tilde_values = matrix_multiply_fft_1d(kernel_tilde, w_coefficients)
 
+    start = _lap(timings, "convolution", start)
+
     # STEP 3: Compute the potentials \tilde{\phi(y_i)}
     # Compute the relative position of each new embedding point in its box
     cdef double[::1] y_in_box = np.empty(n_samples, dtype=float)
@@ -559,6 +3034,8 @@ cpdef double estimate_negative_gradient_fft_1d_with_reference(
     for i in range(n_samples):
         gradient[i] -= (embedding[i] * phi[i, 0] - phi[i, 1]) / (sum_Qi[i] + EPSILON)
 
+    _lap(timings, "potentials", start)
+
     return sum_Q
 
 
@@ -603,7 +3080,10 @@ cpdef double estimate_negative_gradient_fft_2d(
     Py_ssize_t n_interpolation_points=3,
     Py_ssize_t min_num_intervals=10,
     double ints_in_interval=1,
+    dict timings=None,
 ):
+    cdef double start = _start_timer(timings)
+
     cdef:
         Py_ssize_t i, j, d, box_idx
         Py_ssize_t n_samples = embedding.shape[0]
@@ -716,9 +3196,13 @@ cpdef double estimate_negative_gradient_fft_2d(
                         y_interpolated_values[i, interp_j] * \
                         q_j[i, d]
 
+    start = _lap(timings, "interpolation", start)
+
     # STEP 2: Compute the kernel values evaluated at the interpolation nodes
     cdef double[:, ::1] y_tilde_values = matrix_multiply_fft_2d(kernel_tilde, w_coefficients)
 
+    start = _lap(timings, "convolution", start)
+
     # STEP 3: Compute the potentials \tilde{\phi(y_i)}
     cdef double[:, ::1] phi = np.zeros((n_samples, n_terms), dtype=float)
     for i in range(n_samples):
@@ -756,6 +3240,8 @@ cpdef double estimate_negative_gradient_fft_2d(
         gradient[i, 0] -= (embedding[i, 0] * phi[i, 0] - phi[i, 1]) / (sum_Q + EPSILON)
         gradient[i, 1] -= (embedding[i, 1] * phi[i, 0] - phi[i, 2]) / (sum_Q + EPSILON)
 
+    _lap(timings, "potentials", start)
+
     return sum_Q
 
 
@@ -766,7 +3252,10 @@ cpdef double estimate_negative_gradient_fft_2d_with_reference(
     Py_ssize_t n_interpolation_points=3,
     Py_ssize_t min_num_intervals=10,
     double ints_in_interval=1,
+    dict timings=None,
 ):
+    cdef double start = _start_timer(timings)
+
     cdef:
         Py_ssize_t i, j, d, box_idx
         Py_ssize_t n_samples = embedding.shape[0]
@@ -905,9 +3394,13 @@ cpdef double estimate_negative_gradient_fft_2d_with_reference(
                         reference_y_interpolated_values[i, interp_j] * \
                         q_j[i, d]
 
+    start = _lap(timings, "interpolation", start)
+
     # STEP 2: Compute the kernel values evaluated at the interpolation nodes
     cdef double[:, ::1] y_tilde_values = matrix_multiply_fft_2d(kernel_tilde, w_coefficients)
 
+    start = _lap(timings, "convolution", start)
+
     # STEP 3: Compute the potentials \tilde{\phi(y_i)}
     # Compute the relative position of each new embedding point in its box
     cdef:
@@ -967,4 +3460,6 @@ cpdef double estimate_negative_gradient_fft_2d_with_reference(
         gradient[i, 0] -= (embedding[i, 0] * phi[i, 0] - phi[i, 1]) / (sum_Qi[i] + EPSILON)
         gradient[i, 1] -= (embedding[i, 1] * phi[i, 0] - phi[i, 2]) / (sum_Qi[i] + EPSILON)
 
+    _lap(timings, "potentials", start)
+
     return sum_Q
@@ -7,6 +7,7 @@ import scipy.sparse as sp
 
 from . import _tsne
 from . import nearest_neighbors
+from . import profiling
 
 log = logging.getLogger(__name__)
 
@@ -65,6 +66,116 @@ class Affinities:
         """
 
 
+class CompactSymmetricMatrix:
+    """A symmetric sparse matrix storing only its upper triangle.
+
+    The affinity matrices used by standard t-SNE are symmetric, so storing
+    every edge once halves their memory footprint. The gradient computations
+    recognize this representation and apply the force of every stored edge to
+    both of its endpoints.
+
+    Parameters
+    ----------
+    P: sp.spmatrix
+        A symmetric sparse matrix. Only its upper triangle is used.
+
+    Attributes
+    ----------
+    data: np.ndarray
+        The values of the upper triangle, including the diagonal, in CSR
+        format.
+
+    indices: np.ndarray
+        The column indices of the upper triangle in CSR format.
+
+    indptr: np.ndarray
+        The row pointers of the upper triangle in CSR format.
+
+    """
+
+    def __init__(self, P):
+        if isinstance(P, CompactSymmetricMatrix):
+            upper = P._upper.copy()
+        else:
+            if P.shape[0] != P.shape[1]:
+                raise ValueError(
+                    "Only square matrices can be symmetric. Got shape %s."
+                    % (P.shape,)
+                )
+            upper = sp.triu(P, format="csr")
+        self._upper = upper
+
+    @classmethod
+    def from_upper_triangle(cls, upper):
+        """Wrap the upper triangle of a symmetric matrix without copying it.
+
+        Parameters
+        ----------
+        upper: sp.csr_matrix
+            The upper triangle, including the diagonal.
+
+        Returns
+        -------
+        CompactSymmetricMatrix
+
+        """
+        matrix = cls.__new__(cls)
+        matrix._upper = upper
+        return matrix
+
+    @property
+    def data(self):
+        return self._upper.data
+
+    @property
+    def indices(self):
+        return self._upper.indices
+
+    @property
+    def indptr(self):
+        return self._upper.indptr
+
+    @property
+    def shape(self):
+        return self._upper.shape
+
+    @property
+    def dtype(self):
+        return self._upper.dtype
+
+    @property
+    def nnz(self):
+        """The number of non-zero entries of the full symmetric matrix."""
+        n_diagonal = np.count_nonzero(self._upper.diagonal())
+        return 2 * self._upper.nnz - n_diagonal
+
+    def tocsr(self):
+        """Expand into a regular CSR matrix containing both triangles."""
+        lower = sp.triu(self._upper, k=1).T
+        return (self._upper + lower).tocsr()
+
+    def toarray(self):
+        return self.tocsr().toarray()
+
+    def copy(self):
+        return CompactSymmetricMatrix(self)
+
+    def sum(self, axis=None, dtype=None, out=None):
+        if axis is None:
+            diagonal = self._upper.diagonal()
+            total = 2 * np.sum(self._upper.data) - np.sum(diagonal)
+            return np.asarray(total, dtype=dtype)[()]
+        return self.tocsr().sum(axis=axis, dtype=dtype, out=out)
+
+    def __imul__(self, other):
+        self._upper.data *= other
+        return self
+
+    def __itruediv__(self, other):
+        self._upper.data /= other
+        return self
+
+
 class PerplexityBasedNN(Affinities):
     """Compute affinities using nearest neighbors.
 
@@ -136,6 +247,182 @@ class PerplexityBasedNN(Affinities):
 
         self.n_jobs = n_jobs
 
+    @classmethod
+    def from_neighbors(
+        cls, neighbors, distances, perplexity=30, symmetrize=True, knn_index=None,
+        n_jobs=1,
+    ):
+        """Compute affinities from a precomputed nearest neighbor graph.
+
+        This skips building a nearest neighbor index, which is useful when a
+        :math:`k`-nearest neighbor graph is already available, e.g. from an
+        upstream clustering step. Only the first ``3 * perplexity`` neighbors
+        of each point are used.
+
+        Parameters
+        ----------
+        neighbors: np.ndarray
+            A `n_samples * k_neighbors` matrix containing the indices of each
+            point's nearest neighbors, sorted by increasing distance. The point
+            itself should not be included.
+
+        distances: np.ndarray
+            A `n_samples * k_neighbors` matrix containing the distances to the
+            neighbors in `neighbors`.
+
+        perplexity: float
+            Perplexity can be thought of as the continuous :math:`k` number of
+            nearest neighbors, for which t-SNE will attempt to preserve
+            distances.
+
+        symmetrize: bool
+            Symmetrize affinity matrix. Standard t-SNE symmetrizes the
+            interactions but when embedding new data, symmetrization is not
+            performed.
+
+        knn_index: Optional[nearest_neighbors.KNNIndex]
+            An index built on the original data. It is only needed by
+            :meth:`to_new` and may also be attached later through the
+            ``knn_index`` attribute.
+
+        n_jobs: int
+            The number of threads to use while running t-SNE. This follows the
+            scikit-learn convention, ``-1`` meaning all processors, ``-2``
+            meaning all but one, etc.
+
+        Returns
+        -------
+        PerplexityBasedNN
+
+        """
+        neighbors = np.asarray(neighbors)
+        distances = np.asarray(distances, dtype=float)
+        if neighbors.ndim != 2 or neighbors.shape != distances.shape:
+            raise ValueError(
+                "`neighbors` and `distances` must be matrices of the same shape. "
+                "Got %s and %s." % (neighbors.shape, distances.shape)
+            )
+
+        obj = cls.__new__(cls)
+        obj.n_samples = neighbors.shape[0]
+        obj.perplexity = obj.check_perplexity(perplexity)
+        obj.knn_index = knn_index
+        obj.n_jobs = n_jobs
+
+        k_neighbors = min(neighbors.shape[1], int(3 * obj.perplexity))
+        if k_neighbors < int(3 * obj.perplexity):
+            log.warning(
+                "Perplexity %.2f requires %d neighbors but only %d were "
+                "provided. Computing affinities from the available neighbors."
+                % (obj.perplexity, int(3 * obj.perplexity), k_neighbors)
+            )
+        obj.__neighbors = neighbors[:, :k_neighbors]
+        obj.__distances = distances[:, :k_neighbors]
+
+        obj.P = joint_probabilities_nn(
+            obj.__neighbors,
+            obj.__distances,
+            [obj.perplexity],
+            symmetrize=symmetrize,
+            n_jobs=n_jobs,
+        )
+
+        return obj
+
+    @classmethod
+    def from_distance_graph(
+        cls, distance_graph, perplexity=30, symmetrize=True, knn_index=None,
+        n_jobs=1,
+    ):
+        """Compute affinities from a precomputed sparse distance graph.
+
+        Every stored entry of the graph is considered a neighbor, so points
+        may have a different number of neighbors. As with
+        :meth:`from_neighbors`, only the ``3 * perplexity`` nearest neighbors
+        in each row are used. Graphs with the same number of neighbors in
+        every row are handled by :meth:`from_neighbors` and support
+        :meth:`set_perplexity`.
+
+        Parameters
+        ----------
+        distance_graph: sp.spmatrix
+            A square `n_samples * n_samples` sparse matrix where entry
+            :math:`(i, j)` holds the distance from point :math:`i` to its
+            neighbor :math:`j`. Explicitly stored zeros are considered
+            neighbors at distance zero.
+
+        perplexity: float
+            Perplexity can be thought of as the continuous :math:`k` number of
+            nearest neighbors, for which t-SNE will attempt to preserve
+            distances.
+
+        symmetrize: bool
+            Symmetrize affinity matrix. Standard t-SNE symmetrizes the
+            interactions but when embedding new data, symmetrization is not
+            performed.
+
+        knn_index: Optional[nearest_neighbors.KNNIndex]
+            An index built on the original data. It is only needed by
+            :meth:`to_new` and may also be attached later through the
+            ``knn_index`` attribute.
+
+        n_jobs: int
+            The number of threads to use while running t-SNE. This follows the
+            scikit-learn convention, ``-1`` meaning all processors, ``-2``
+            meaning all but one, etc.
+
+        Returns
+        -------
+        PerplexityBasedNN
+
+        """
+        distance_graph = sp.csr_matrix(distance_graph)
+        n_samples = distance_graph.shape[0]
+        if distance_graph.shape[1] != n_samples:
+            raise ValueError(
+                "The distance graph must be a square matrix. Got shape %s."
+                % (distance_graph.shape,)
+            )
+
+        row_lengths = np.diff(distance_graph.indptr)
+        if n_samples > 0 and np.all(row_lengths == row_lengths[0]):
+            k_neighbors = row_lengths[0]
+            neighbors = distance_graph.indices.reshape(n_samples, k_neighbors)
+            distances = distance_graph.data.reshape(n_samples, k_neighbors)
+            order = np.argsort(distances, axis=1, kind="stable")
+            return cls.from_neighbors(
+                np.take_along_axis(neighbors, order, axis=1),
+                np.take_along_axis(distances, order, axis=1),
+                perplexity=perplexity,
+                symmetrize=symmetrize,
+                knn_index=knn_index,
+                n_jobs=n_jobs,
+            )
+
+        obj = cls.__new__(cls)
+        obj.n_samples = n_samples
+        obj.perplexity = obj.check_perplexity(perplexity)
+        obj.knn_index = knn_index
+        obj.n_jobs = n_jobs
+        # Rows of different lengths can't be truncated to the neighbors
+        # needed by a different perplexity, so `set_perplexity` is unsupported
+        obj.__neighbors = obj.__distances = None
+
+        k_neighbors = int(3 * obj.perplexity)
+        if np.any(row_lengths < k_neighbors):
+            log.warning(
+                "Perplexity %.2f requires %d neighbors but some points have "
+                "only %d. Computing affinities from the available neighbors."
+                % (obj.perplexity, k_neighbors, np.min(row_lengths))
+            )
+        distance_graph = _nearest_in_rows(distance_graph, k_neighbors)
+
+        obj.P = joint_probabilities_graph(
+            distance_graph, [obj.perplexity], symmetrize=symmetrize, n_jobs=n_jobs
+        )
+
+        return obj
+
     def set_perplexity(self, new_perplexity):
         """Change the perplexity of the affinity matrix.
 
@@ -157,6 +444,13 @@ class PerplexityBasedNN(Affinities):
             return
         # Verify that the perplexity isn't too large
         new_perplexity = self.check_perplexity(new_perplexity)
+        if self.__neighbors is None:
+            raise RuntimeError(
+                "The perplexity of affinities computed from a distance graph "
+                "with a variable number of neighbors can not be changed. "
+                "Please create a new `%s` instance instead."
+                % self.__class__.__name__
+            )
         # Recompute the affinity matrix
         k_neighbors = min(self.n_samples - 1, int(3 * new_perplexity))
         if k_neighbors > self.__neighbors.shape[1]:
@@ -221,7 +515,14 @@ class PerplexityBasedNN(Affinities):
         perplexity = self.check_perplexity(perplexity)
         k_neighbors = min(self.n_samples - 1, int(3 * perplexity))
 
-        neighbors, distances = self.knn_index.query(data, k_neighbors)
+        if self.knn_index is None:
+            raise RuntimeError(
+                "These affinities were computed from precomputed neighbors and "
+                "have no nearest neighbor index to query. Please attach a "
+                "`KNNIndex` built on the original data to `knn_index` first."
+            )
+        with profiling.phase("affinities.knn_query"):
+            neighbors, distances = self.knn_index.query(data, k_neighbors)
 
         P = joint_probabilities_nn(
             neighbors,
@@ -276,11 +577,33 @@ def build_knn_index(
             random_state=random_state,
         )
 
-    neighbors, distances = knn_index.build(data, k=k)
+    with profiling.phase("affinities.knn"):
+        neighbors, distances = knn_index.build(data, k=k)
 
     return knn_index, neighbors, distances
 
 
+def _sparse_index_dtype(max_value):
+    """Get the smallest integer type scipy can use to index `max_value` entries.
+
+    The gradient kernels accept both 32 and 64-bit sparse indices, so we only
+    switch to 64-bit indices when the number of edges in the affinity graph
+    requires it.
+
+    """
+    if max_value > np.iinfo(np.int32).max:
+        return np.int64
+    return np.int32
+
+
+def _nn_indptr(n_samples, k_neighbors):
+    """Construct the CSR `indptr` array of a `k_neighbors` nearest neighbor graph."""
+    n_edges = n_samples * k_neighbors
+    return np.arange(
+        0, n_edges + 1, k_neighbors, dtype=_sparse_index_dtype(n_edges)
+    )
+
+
 def joint_probabilities_nn(
     neighbors,
     distances,
@@ -329,34 +652,113 @@ def joint_probabilities_nn(
         that a new sample would appear as a neighbor of a reference point.
 
     """
-    assert normalization in (
-        "pair-wise",
-        "point-wise",
-    ), f"Unrecognized normalization scheme `{normalization}`."
-
     n_samples, k_neighbors = distances.shape
 
     if n_reference_samples is None:
         n_reference_samples = n_samples
 
-    # Compute asymmetric pairwise input similarities
-    conditional_P = _tsne.compute_gaussian_perplexity(
-        distances, np.array(perplexities, dtype=float), num_threads=n_jobs
-    )
-    conditional_P = np.asarray(conditional_P)
-
-    P = sp.csr_matrix(
+    distance_graph = sp.csr_matrix(
         (
-            conditional_P.ravel(),
+            np.asarray(distances, dtype=float).ravel(),
             neighbors.ravel(),
-            range(0, n_samples * k_neighbors + 1, k_neighbors),
+            _nn_indptr(n_samples, k_neighbors),
         ),
         shape=(n_samples, n_reference_samples),
     )
 
+    return joint_probabilities_graph(
+        distance_graph,
+        perplexities,
+        symmetrize=symmetrize,
+        normalization=normalization,
+        n_jobs=n_jobs,
+    )
+
+
+def joint_probabilities_graph(
+    distance_graph,
+    perplexities,
+    symmetrize=True,
+    normalization="pair-wise",
+    n_jobs=1,
+):
+    """Compute the conditional probability matrix P_{j|i} on a distance graph.
+
+    Same as :func:`joint_probabilities_nn`, but the neighbors are given as a
+    sparse distance graph, so every point may have a different number of
+    neighbors.
+
+    Parameters
+    ----------
+    distance_graph: sp.csr_matrix
+        A `n_samples * n_reference_samples` sparse matrix where every stored
+        entry is the distance from a point to one of its neighbors. Explicitly
+        stored zeros are treated as neighbors at distance zero.
+    perplexities: double
+        The desired perplexity of the probability distribution.
+    symmetrize: bool
+        Whether to symmetrize the probability matrix or not.
+    normalization: str
+        The normalization scheme to use for the affinities, either
+        ``pair-wise`` or ``point-wise``. See :func:`joint_probabilities_nn`.
+    n_jobs: int
+        Number of threads.
+
+    Returns
+    -------
+    csr_matrix
+        A `n_samples * n_reference_samples` affinity matrix with the same
+        sparsity structure as `distance_graph`, before symmetrization.
+
+    """
+    assert normalization in (
+        "pair-wise",
+        "point-wise",
+    ), f"Unrecognized normalization scheme `{normalization}`."
+
+    # Compute asymmetric pairwise input similarities
+    with profiling.phase("affinities.perplexity"):
+        conditional_P = _tsne.compute_gaussian_perplexity(
+            np.asarray(distance_graph.data, dtype=float),
+            distance_graph.indptr,
+            np.array(perplexities, dtype=float),
+            num_threads=n_jobs,
+        )
+
+    P = sp.csr_matrix(
+        (np.asarray(conditional_P), distance_graph.indices, distance_graph.indptr),
+        shape=distance_graph.shape,
+    )
+
+    return _symmetrize_and_normalize(P, symmetrize, normalization, n_jobs=n_jobs)
+
+
+def _nearest_in_rows(distance_graph, k_neighbors):
+    """Keep only the `k_neighbors` smallest distances in every row of a CSR
+    distance graph. Entries within each row are then ordered by distance."""
+    row_lengths = np.diff(distance_graph.indptr)
+    if np.all(row_lengths <= k_neighbors):
+        return distance_graph
+
+    rows = np.repeat(np.arange(distance_graph.shape[0]), row_lengths)
+    order = np.lexsort((distance_graph.data, rows))
+    rank = np.arange(distance_graph.nnz) - np.repeat(distance_graph.indptr[:-1], row_lengths)
+    keep = order[rank < k_neighbors]
+
+    indptr = np.zeros_like(distance_graph.indptr)
+    np.cumsum(np.minimum(row_lengths, k_neighbors), out=indptr[1:])
+
+    return sp.csr_matrix(
+        (distance_graph.data[keep], distance_graph.indices[keep], indptr),
+        shape=distance_graph.shape,
+    )
+
+
+def _symmetrize_and_normalize(P, symmetrize, normalization, n_jobs=1):
     # Symmetrize the probability matrix
     if symmetrize:
-        P = (P + P.T) / 2
+        with profiling.phase("affinities.symmetrize"):
+            P = _symmetrize(P, n_jobs=n_jobs)
 
     if normalization == "pair-wise":
         P /= np.sum(P)
@@ -366,6 +768,93 @@ def joint_probabilities_nn(
     return P
 
 
+def _symmetrize(P, n_jobs=1):
+    """Compute (P + P^T) / 2 of a square sparse matrix in parallel."""
+    if P.shape[0] != P.shape[1]:
+        raise ValueError(
+            "Only square affinity matrices can be symmetrized, got shape %s."
+            % (P.shape,)
+        )
+    P = P.tocsr()
+    data, indices, indptr = _tsne.symmetrize_csr(
+        P.indices, P.indptr, np.asarray(P.data, dtype=float), num_threads=n_jobs
+    )
+    P = sp.csr_matrix((data, indices, indptr), shape=P.shape)
+    P.has_sorted_indices = True
+
+    return P
+
+
+def kernel_affinities_nn(
+    neighbors,
+    distances,
+    kernel="gaussian",
+    sigma=1,
+    symmetrize=True,
+    normalization="pair-wise",
+    n_reference_samples=None,
+    n_jobs=1,
+):
+    """Compute the affinity matrix using a fixed-bandwidth kernel.
+
+    Parameters
+    ----------
+    neighbors: np.ndarray
+        A `n_samples * k_neighbors` matrix containing the indices to each
+        points" nearest neighbors in descending order.
+    distances: np.ndarray
+        A `n_samples * k_neighbors` matrix containing the distances to the
+        neighbors at indices defined in the neighbors parameter.
+    kernel: str
+        The kernel to use, either ``gaussian``, ``adaptive`` or ``uniform``.
+        See :class:`FixedSigmaNN`.
+    sigma: float
+        The bandwidth of the ``gaussian`` kernel, or the factor of the
+        distance to the furthest neighbor for the ``adaptive`` kernel.
+    symmetrize: bool
+        Whether to symmetrize the probability matrix or not.
+    normalization: str
+        The normalization scheme to use for the affinities, either
+        ``pair-wise`` or ``point-wise``. See :func:`joint_probabilities_nn`.
+    n_reference_samples: int
+        The number of samples in the existing (reference) embedding. Needed to
+        properly construct the sparse P matrix.
+    n_jobs: int
+        Number of threads.
+
+    Returns
+    -------
+    csr_matrix
+        A `n_samples * n_reference_samples` affinity matrix.
+
+    """
+    assert normalization in (
+        "pair-wise",
+        "point-wise",
+    ), f"Unrecognized normalization scheme `{normalization}`."
+
+    n_samples, k_neighbors = distances.shape
+
+    if n_reference_samples is None:
+        n_reference_samples = n_samples
+
+    indptr = _nn_indptr(n_samples, k_neighbors)
+    conditional_P = _tsne.compute_kernel_affinities(
+        np.asarray(distances, dtype=float).ravel(),
+        indptr,
+        kernel=kernel,
+        sigma=sigma,
+        num_threads=n_jobs,
+    )
+
+    P = sp.csr_matrix(
+        (np.asarray(conditional_P), neighbors.ravel(), indptr),
+        shape=(n_samples, n_reference_samples),
+    )
+
+    return _symmetrize_and_normalize(P, symmetrize, normalization, n_jobs=n_jobs)
+
+
 class FixedSigmaNN(Affinities):
     """Compute affinities using using nearest neighbors and a fixed bandwidth
     for the Gaussians in the ambient space.
@@ -382,6 +871,9 @@ class FixedSigmaNN(Affinities):
 
     sigma: float
         The bandwidth to use for the Gaussian kernels in the ambient space.
+        With the ``adaptive`` kernel, this is the factor of the distance to
+        the furthest neighbor used as the bandwidth of each point. Ignored by
+        the ``uniform`` kernel.
 
     k: int
         The number of nearest neighbors to consider for each kernel.
@@ -412,12 +904,19 @@ class FixedSigmaNN(Affinities):
         be used as the random number generator. If the value is None, the random
         number generator is the RandomState instance used by `np.random`.
 
+    kernel: str
+        The kernel to use. ``gaussian`` uses the same bandwidth ``sigma`` for
+        every point. ``adaptive`` uses a Gaussian kernel whose bandwidth is
+        ``sigma`` times the distance to the :math:`k`-th nearest neighbor of
+        each point. ``uniform`` assigns the same affinity to all :math:`k`
+        nearest neighbors, which is very fast to compute.
+
     """
 
     def __init__(
         self,
         data,
-        sigma,
+        sigma=None,
         k=30,
         method="approx",
         metric="euclidean",
@@ -425,39 +924,35 @@ class FixedSigmaNN(Affinities):
         symmetrize=True,
         n_jobs=1,
         random_state=None,
+        kernel="gaussian",
     ):
-        self.n_samples = n_samples = data.shape[0]
+        self.n_samples = data.shape[0]
 
         if k >= self.n_samples:
             raise ValueError(
                 "`k` (%d) cannot be larger than N-1 (%d)." % (k, self.n_samples)
             )
 
+        sigma = self.check_sigma(sigma, kernel)
+
         knn_index, neighbors, distances = build_knn_index(
             data, method, k, metric, metric_params, n_jobs, random_state
         )
 
         self.knn_index = knn_index
 
-        # Compute asymmetric pairwise input similarities
-        conditional_P = np.exp(-distances ** 2 / (2 * sigma ** 2))
-        conditional_P /= np.sum(conditional_P, axis=1)[:, np.newaxis]
-
-        P = sp.csr_matrix(
-            (conditional_P.ravel(), neighbors.ravel(), range(0, n_samples * k + 1, k)),
-            shape=(n_samples, n_samples),
+        self.P = kernel_affinities_nn(
+            neighbors,
+            distances,
+            kernel=kernel,
+            sigma=sigma,
+            symmetrize=symmetrize,
+            n_jobs=n_jobs,
         )
 
-        # Symmetrize the probability matrix
-        if symmetrize:
-            P = (P + P.T) / 2
-
-        # Convert weights to probabilities
-        P /= np.sum(P)
-
         self.sigma = sigma
         self.k = k
-        self.P = P
+        self.kernel = kernel
         self.n_jobs = n_jobs
 
     def to_new(self, data, k=None, sigma=None, return_distances=False):
@@ -476,6 +971,7 @@ class FixedSigmaNN(Affinities):
 
         sigma: float
             The bandwidth to use for the Gaussian kernels in the ambient space.
+            See the ``kernel`` parameter of :class:`FixedSigmaNN`.
 
         return_distances: bool
             If needed, the function can return the indices of the nearest
@@ -499,7 +995,6 @@ class FixedSigmaNN(Affinities):
             data point.
 
         """
-        n_samples = data.shape[0]
         n_reference_samples = self.n_samples
 
         if k is None:
@@ -512,19 +1007,21 @@ class FixedSigmaNN(Affinities):
 
         if sigma is None:
             sigma = self.sigma
+        sigma = self.check_sigma(sigma, self.kernel)
 
         # Find nearest neighbors and the distances to the new points
-        neighbors, distances = self.knn_index.query(data, k)
+        with profiling.phase("affinities.knn_query"):
+            neighbors, distances = self.knn_index.query(data, k)
 
-        # Compute asymmetric pairwise input similarities
-        conditional_P = np.exp(-distances ** 2 / (2 * sigma ** 2))
-
-        # Convert weights to probabilities
-        conditional_P /= np.sum(conditional_P, axis=1)[:, np.newaxis]
-
-        P = sp.csr_matrix(
-            (conditional_P.ravel(), neighbors.ravel(), range(0, n_samples * k + 1, k)),
-            shape=(n_samples, n_reference_samples),
+        P = kernel_affinities_nn(
+            neighbors,
+            distances,
+            kernel=self.kernel,
+            sigma=sigma,
+            symmetrize=False,
+            normalization="point-wise",
+            n_reference_samples=n_reference_samples,
+            n_jobs=self.n_jobs,
         )
 
         if return_distances:
@@ -532,6 +1029,25 @@ class FixedSigmaNN(Affinities):
 
         return P
 
+    @staticmethod
+    def check_sigma(sigma, kernel):
+        if kernel not in ("gaussian", "adaptive", "uniform"):
+            raise ValueError(
+                "Unrecognized kernel `%s`. Please choose one of `gaussian`, "
+                "`adaptive` or `uniform`." % kernel
+            )
+
+        if kernel == "uniform":
+            return 1
+        if sigma is None:
+            if kernel == "adaptive":
+                return 1
+            raise ValueError("The `gaussian` kernel requires a bandwidth `sigma`.")
+        if sigma <= 0:
+            raise ValueError("`sigma` must be positive. %.2f given" % sigma)
+
+        return sigma
+
 
 class MultiscaleMixture(Affinities):
     """Calculate affinities using a Gaussian mixture kernel.
@@ -724,7 +1240,8 @@ class MultiscaleMixture(Affinities):
         max_perplexity = np.max(perplexities)
         k_neighbors = min(self.n_samples - 1, int(3 * max_perplexity))
 
-        neighbors, distances = self.knn_index.query(data, k_neighbors)
+        with profiling.phase("affinities.knn_query"):
+            neighbors, distances = self.knn_index.query(data, k_neighbors)
 
         P = self._calculate_P(
             neighbors,
@@ -853,3 +1370,83 @@ class Multiscale(MultiscaleMixture):
             P = sp.diags(np.asarray(1 / P.sum(axis=1)).ravel()) @ P
 
         return P
+
+
+class PermutedAffinities(Affinities):
+    """Affinities of a reordered set of points.
+
+    Reordering the points can greatly improve memory locality during
+    optimization. This wraps an existing affinity object so that both the
+    affinity matrix and the affinities of new data points refer to the points
+    in their new order.
+
+    Parameters
+    ----------
+    affinities: Affinities
+        The affinities of the points in their original order.
+
+    permutation: np.ndarray
+        The new position ``i`` holds the original point ``permutation[i]``.
+
+    """
+
+    def __init__(self, affinities, permutation):
+        permutation = np.asarray(permutation, dtype=np.intp)
+        n_samples = affinities.P.shape[0]
+        if permutation.shape != (n_samples,):
+            raise ValueError(
+                "The permutation must contain exactly one entry for each of the "
+                "%d samples. Got %d." % (n_samples, permutation.shape[0])
+            )
+
+        self.affinities = affinities
+        self.permutation = permutation
+        self.inverse_permutation = np.empty_like(permutation)
+        self.inverse_permutation[permutation] = np.arange(n_samples)
+
+        P = affinities.P.tocsr()[permutation][:, permutation]
+        if isinstance(affinities.P, CompactSymmetricMatrix):
+            P = CompactSymmetricMatrix(P)
+        self.P = P
+
+    def to_new(self, data, return_distances=False, **affinity_params):
+        """Compute the affinities of new samples to the reordered samples.
+
+        Parameters
+        ----------
+        data: np.ndarray
+            The data points to be added to the existing embedding.
+
+        return_distances: bool
+            If needed, the function can return the indices of the nearest
+            neighbors and their corresponding distances.
+
+        **affinity_params: dict
+            Additional params to be passed to the ``to_new`` method of the
+            wrapped affinities.
+
+        Returns
+        -------
+        P: array_like
+            An :math:`N \\times M` affinity matrix expressing interactions
+            between :math:`N` new data points the initial :math:`M` data
+            samples, in their new order.
+
+        indices: np.ndarray
+            Returned if ``return_distances=True``. The indices of the nearest
+            neighbors in the reordered embedding for every new data point.
+
+        distances: np.ndarray
+            Returned if ``return_distances=True``. The distances to the nearest
+            neighbors for every new data point.
+
+        """
+        P, neighbors, distances = self.affinities.to_new(
+            data, return_distances=True, **affinity_params
+        )
+        P = sp.csr_matrix(P)[:, self.permutation]
+
+        if return_distances:
+            return P, self.inverse_permutation[neighbors], distances
+
+        return P
@@ -68,20 +68,18 @@ class ErrorLogger(Callback):
 
 
 class VerifyExaggerationError(Callback):
-    """Used to verify that the exaggeration correction implemented in
-    `gradient_descent` is correct."""
+    """Used to verify that the error reported by `gradient_descent` during
+    exaggerated optimization is the KL divergence w.r.t. the actual,
+    unexaggerated affinities."""
     def __init__(self, embedding: TSNEEmbedding) -> None:
         self.embedding = embedding
         # Keep a copy of the unexaggerated affinity matrix
-        self.P = self.embedding.affinities.P.copy()
+        self.P = self.embedding.affinities.P.tocsr().copy()
 
     def __call__(self, iteration: int, corrected_error: float, embedding: TSNEEmbedding):
         params = self.embedding.gradient_descent_params
         method = params["negative_gradient_method"]
 
-        if np.sum(embedding.affinities.P) <= 1:
-            log.warning("Are you sure you are testing an exaggerated P matrix?")
-
         if method == "fft":
             f = partial(kl_divergence.kl_divergence_approx_fft,
                         n_interpolation_points=params["n_interpolation_points"],
@@ -104,7 +102,7 @@ class ErrorApproximations(Callback):
     """Check how good the error approximations are. Of course, we use an
     approximation for P so this itself is an approximation."""
     def __init__(self, P: csr_matrix):
-        self.P = P.copy()
+        self.P = P.tocsr().copy()
         self.exact_errors = []
         self.bh_errors = []
         self.fft_errors = []
@@ -132,3 +130,33 @@ class ErrorApproximations(Callback):
         fft_diff = fft_errors - exact_errors
         print("Interpolation: mean difference %.4f (±%.4f)" % (
             np.mean(fft_diff), np.std(fft_diff)))
+
+
+class Checkpoint(Callback):
+    """Periodically save a checkpoint of the embedding.
+
+    The checkpoint is saved with :meth:`TSNEEmbedding.save_checkpoint`, so an
+    interrupted optimization can be continued by loading it with
+    :meth:`TSNEEmbedding.load_checkpoint` and calling
+    :meth:`TSNEEmbedding.resume`.
+
+    Parameters
+    ----------
+    path: str
+        The checkpoint directory. Every checkpoint replaces the previous one.
+
+    every_iters: Optional[int]
+        Save a checkpoint only every ``every_iters`` iterations. By default, a
+        checkpoint is saved every time the callbacks are invoked.
+
+    """
+
+    def __init__(self, path, every_iters=None):
+        self.path = path
+        self.every_iters = every_iters
+
+    def __call__(self, iteration, error, embedding):
+        if self.every_iters is not None and iteration % self.every_iters != 0:
+            return
+        embedding.save_checkpoint(self.path)
+        log.info("Saved checkpoint at iteration %d to `%s`." % (iteration, self.path))
@@ -9,6 +9,7 @@ cimport numpy as np
 import numpy as np
 from .quad_tree cimport QuadTree
 from ._tsne cimport (
+    sparse_index_t,
     estimate_negative_gradient_bh,
     estimate_negative_gradient_fft_1d,
     estimate_negative_gradient_fft_2d,
@@ -60,8 +61,8 @@ cpdef double kl_divergence_exact(double[:, ::1] P, double[:, ::1] embedding):
 
 
 cpdef double kl_divergence_approx_bh(
-    int[:] indices,
-    int[:] indptr,
+    sparse_index_t[:] indices,
+    sparse_index_t[:] indptr,
     double[:] P_data,
     double[:, ::1] embedding,
     double theta=0.5,
@@ -90,8 +91,8 @@ cpdef double kl_divergence_approx_bh(
 
 
 cpdef double kl_divergence_approx_fft(
-    int[:] indices,
-    int[:] indptr,
+    sparse_index_t[:] indices,
+    sparse_index_t[:] indptr,
     double[:] P_data,
     double[:, ::1] embedding,
     Py_ssize_t n_interpolation_points=3,
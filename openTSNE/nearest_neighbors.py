@@ -166,4 +166,3 @@ class Annoy(KNNIndex):
         return self.index.query(query, k=k, queue_size=1)
 
 
-class
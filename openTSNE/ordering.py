@@ -0,0 +1,108 @@
+import numpy as np
+from scipy.sparse.csgraph import reverse_cuthill_mckee as _reverse_cuthill_mckee
+
+
+def reverse_cuthill_mckee(P, embedding=None):
+    """Order points so that the affinity matrix has a small bandwidth.
+
+    Neighboring points in the affinity graph are placed close together in
+    memory, so the positive gradient accesses the embedding mostly
+    sequentially.
+
+    Parameters
+    ----------
+    P: Union[sp.csr_matrix, CompactSymmetricMatrix]
+        The symmetric affinity matrix.
+
+    embedding: np.ndarray
+        Ignored. Present for consistency with the other ordering schemes.
+
+    Returns
+    -------
+    permutation: np.ndarray
+        The new position ``i`` holds the point ``permutation[i]``.
+
+    """
+    P = P.tocsr()
+    return np.asarray(_reverse_cuthill_mckee(P, symmetric_mode=True), dtype=np.intp)
+
+
+def morton(P, embedding):
+    """Order points along a Z-order space-filling curve through the embedding.
+
+    Points close to each other in the embedding are placed close together in
+    memory. Since t-SNE places neighbors near each other, this also improves
+    the locality of the affinity matrix.
+
+    Parameters
+    ----------
+    P: sp.csr_matrix
+        Ignored. Present for consistency with the other ordering schemes.
+
+    embedding: np.ndarray
+        The embedding used to determine the point order.
+
+    Returns
+    -------
+    permutation: np.ndarray
+        The new position ``i`` holds the point ``permutation[i]``.
+
+    """
+    embedding = np.asarray(embedding, dtype=np.float64)
+    if embedding.ndim == 1:
+        embedding = embedding[:, np.newaxis]
+    n_dims = embedding.shape[1]
+
+    # Quantize every dimension to an integer grid so that the interleaved bits
+    # of all the dimensions fit into a single 64-bit code
+    n_bits = min(63 // n_dims, 21)
+    lower, upper = embedding.min(axis=0), embedding.max(axis=0)
+    extent = np.where(upper > lower, upper - lower, 1)
+    grid = ((embedding - lower) / extent * (2 ** n_bits - 1)).astype(np.uint64)
+
+    codes = np.zeros(embedding.shape[0], dtype=np.uint64)
+    for bit in range(n_bits):
+        for dim in range(n_dims):
+            codes |= ((grid[:, dim] >> np.uint64(bit)) & np.uint64(1)) << np.uint64(
+                bit * n_dims + dim
+            )
+
+    return np.argsort(codes, kind="stable")
+
+
+METHODS = {
+    "rcm": reverse_cuthill_mckee,
+    "morton": morton,
+}
+
+
+def get_permutation(method, P, embedding):
+    """Compute a point ordering using one of the supported schemes.
+
+    Parameters
+    ----------
+    method: Union[str, Callable]
+        Either ``rcm``, ``morton`` or a callable with the same signature as
+        the ordering functions in this module.
+
+    P: sp.csr_matrix
+        The symmetric affinity matrix.
+
+    embedding: np.ndarray
+        The current embedding.
+
+    Returns
+    -------
+    permutation: np.ndarray
+
+    """
+    if callable(method):
+        return np.asarray(method(P, embedding), dtype=np.intp)
+
+    if method not in METHODS:
+        raise ValueError(
+            "Unrecognized reordering scheme `%s`. Please choose one of %s."
+            % (method, ", ".join("`%s`" % m for m in METHODS))
+        )
+
+    return METHODS[method](P, embedding)
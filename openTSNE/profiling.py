@@ -0,0 +1,173 @@
+"""Timing of the individual phases of the t-SNE pipeline.
+
+The nearest neighbor search, affinity calculation and every part of the
+optimization loop report how long they took to all active profilers. A
+profiler is activated by using it as a context manager::
+
+    with Profiler() as profiler:
+        embedding = TSNE().fit(x)
+    print(profiler)
+
+or by passing ``profile=True`` to :class:`openTSNE.TSNE`, which attaches the
+profiler to the resulting embedding. When no profiler is active, timing a
+phase costs a single function call, so the instrumentation is always in
+place.
+
+Phases are named hierarchically, e.g. ``affinities.knn`` or
+``gradient.fft.convolution``. Phases run once per optimization iteration,
+like ``gradient.positive`` or ``update``, are recorded once per iteration.
+
+Active profilers are shared by all threads, so phases run in other threads,
+e.g. by :meth:`openTSNE.TSNEEmbedding.optimize_async`, are recorded as well.
+
+"""
+import threading
+from time import perf_counter
+
+_active_profilers = []
+_lock = threading.Lock()
+
+
+class Profiler:
+    """Collects the time spent in each phase of the t-SNE pipeline.
+
+    Parameters
+    ----------
+    on_record: Optional[Callable[[str, float], None]]
+        Called with the phase name and duration in seconds every time a phase
+        finishes, e.g. to export the timings to a metrics system.
+
+    Attributes
+    ----------
+    timings: Dict[str, List[float]]
+        The durations of every run of each phase, in seconds.
+
+    """
+
+    def __init__(self, on_record=None):
+        self.on_record = on_record
+        self.timings = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        with _lock:
+            _active_profilers.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        with _lock:
+            _active_profilers.remove(self)
+
+    def record(self, name, duration):
+        """Record a single run of a phase.
+
+        Parameters
+        ----------
+        name: str
+            The name of the phase.
+
+        duration: float
+            The duration of the phase in seconds.
+
+        """
+        with self._lock:
+            self.timings.setdefault(name, []).append(duration)
+        if self.on_record is not None:
+            self.on_record(name, duration)
+
+    def report(self):
+        """Summarize the recorded timings.
+
+        Returns
+        -------
+        Dict[str, Dict[str, float]]
+            For every phase, the ``total`` time, the number of times it was
+            run as ``count``, and the ``mean`` and ``max`` time of a single
+            run, all in seconds.
+
+        """
+        with self._lock:
+            timings = {name: list(durations) for name, durations in self.timings.items()}
+        return {
+            name: {
+                "total": sum(durations),
+                "count": len(durations),
+                "mean": sum(durations) / len(durations),
+                "max": max(durations),
+            }
+            for name, durations in sorted(timings.items())
+        }
+
+    def __str__(self):
+        lines = ["%-40s %10s %8s %12s" % ("Phase", "Total [s]", "Count", "Mean [ms]")]
+        for name, stats in self.report().items():
+            lines.append("%-40s %10.3f %8d %12.3f" % (
+                name, stats["total"], stats["count"], stats["mean"] * 1000))
+        return "\n".join(lines)
+
+
+class _DisabledPhase:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_disabled = _DisabledPhase()
+
+
+class _Phase:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        record(self.name, perf_counter() - self.start)
+
+
+def is_enabled():
+    """Check whether any profiler is currently active."""
+    return bool(_active_profilers)
+
+
+def phase(name):
+    """Time the enclosed block as the phase ``name``.
+
+    Parameters
+    ----------
+    name: str
+        The name of the phase.
+
+    Returns
+    -------
+    ContextManager
+
+    """
+    if not _active_profilers:
+        return _disabled
+    return _Phase(name)
+
+
+def record(name, duration):
+    """Report a phase timed elsewhere, e.g. inside a compiled kernel, to all
+    the active profilers.
+
+    Parameters
+    ----------
+    name: str
+        The name of the phase.
+
+    duration: float
+        The duration of the phase in seconds.
+
+    """
+    for profiler in list(_active_profilers):
+        profiler.record(name, duration)
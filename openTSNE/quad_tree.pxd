@@ -4,25 +4,69 @@
 # cython: cdivision=True
 # cython: language_level=3
 import numpy as np
+from libc.stdint cimport uint64_t
 
 cdef double EPSILON = np.finfo(np.float64).eps
 
-ctypedef struct Node:
-    Py_ssize_t n_dims
-    double *center
-    double length
 
-    bint is_leaf
-    Node *children
+cdef extern from "math.h":
+    double fabs(double x) nogil
 
-    double *center_of_mass
-    Py_ssize_t num_points
 
-
-cdef bint is_duplicate(Node * node, double * point, double duplicate_eps=*) nogil
+# Defined here rather than in quad_tree.pyx, so it can be inlined into the
+# gradient kernels. The default matches `DUPLICATE_EPS`
+cdef inline bint is_duplicate(
+    double * center_of_mass, double * point, Py_ssize_t n_dims, double duplicate_eps=1e-6
+) nogil:
+    cdef Py_ssize_t d
+    for d in range(n_dims):
+        if fabs(center_of_mass[d] - point[d]) >= duplicate_eps:
+            return False
+    return True
 
 
 cdef class QuadTree:
-    cdef Node root
-    cpdef void add_points(self, double[:, ::1] points)
-    cpdef void add_point(self, double[::1] point)
+    cdef readonly Py_ssize_t n_dims
+    # The number of nodes in use. The node arrays below may be larger, so that
+    # rebuilding the tree can reuse them
+    cdef readonly Py_ssize_t n_nodes
+    # Nodes are stored level by level. The nodes on level `i` are the ones
+    # between `level_offsets[i]` and `level_offsets[i + 1]`
+    cdef readonly Py_ssize_t n_levels
+    # Nodes with more than `leaf_size` points are split, unless they are at
+    # `max_depth`
+    cdef readonly Py_ssize_t leaf_size
+    cdef readonly object max_depth
+    cdef readonly Py_ssize_t[::1] level_offsets
+
+    cdef readonly double[:, ::1] center
+    cdef readonly double[::1] length
+    cdef readonly double[:, ::1] center_of_mass
+    cdef readonly Py_ssize_t[::1] num_points
+    # The children of a node are stored next to each other, starting at
+    # `first_child`, which is -1 for leaves
+    cdef readonly Py_ssize_t[::1] first_child
+    # The points of a node are `points[first_point:first_point + num_points]`
+    cdef readonly Py_ssize_t[::1] first_point
+    # Whether a leaf holds more than `leaf_size` points, all duplicates of the
+    # same point
+    cdef readonly unsigned char[::1] duplicates_only
+    # The points in the order of the leaves they belong to
+    cdef readonly double[:, ::1] points
+
+    # Workspace for sorting the points
+    cdef uint64_t[::1] keys
+    cdef uint64_t[::1] keys_tmp
+    cdef Py_ssize_t[::1] order
+    cdef Py_ssize_t[::1] order_tmp
+
+    cpdef void build(
+        self, double[:, ::1] data, Py_ssize_t num_threads=*, Py_ssize_t leaf_size=*, max_depth=*
+    ) except *
+    cdef void reset(self, Py_ssize_t n_dims) except *
+    cdef void reserve(self, Py_ssize_t n_nodes, Py_ssize_t n_used) except *
+    cdef void sort_keys(self, int n_key_bits, Py_ssize_t num_threads) except *
+    cpdef bint is_built_from(self, double[:, ::1] data)
+    cdef Py_ssize_t max_stack_size(self)
+    cpdef void add_points(self, double[:, ::1] points) except *
+    cpdef void add_point(self, double[::1] point) except *
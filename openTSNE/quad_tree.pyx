@@ -7,20 +7,31 @@
 efficiently estimating the t-SNE negative gradient. Lowers the time complexity
 from the naive O(n^2) to O(n * log(n)).
 
+The tree is built in bulk rather than by inserting points one by one. Every
+point is assigned a Morton code, obtained by interleaving the bits of its
+quantized coordinates, so that the leading ``n_dims`` bits identify the root
+child containing the point, the next ``n_dims`` bits the grandchild and so
+on. Sorting the points by their codes therefore places the points of every
+node in a contiguous range, and the children of a node split its range at
+the positions where the corresponding digit of the codes changes. This
+allows the codes, the sort, the splitting of all the nodes on one level of
+the tree and the aggregation of the centers of mass to run in parallel.
+
 Notes
 -----
 I list here several implementation details. Many of these improve efficiency.
 
   - Allocating memory is slow, especially if it has to be done millions of
     times, therefore avoid allocation whereever possible and use buffers.
-    Allocation should be done through the use of `PyMem_Malloc` as this is the
-    fastest method of allocation. Use this over `libc.stdlib.malloc` because,
-    despite requiring the GIL to allocate, it gets tracked in the Python
-    virtual environment (which is desirable) and includes some minor
-    optimizations. Also, since we need the GIL to allocate, this can warn us of
-    any needless memory allocations.
+    The tree is stored as a structure of arrays, one entry per node, instead
+    of as nodes pointing to their separately allocated children. The arrays
+    are only ever grown, so a tree object can be rebuilt on every iteration
+    of the optimization without allocating any memory at all.
 
-  - Structs do not support memoryviews, therefore pointers must be used.
+  - Nodes are stored level by level, and the children of a node are stored
+    next to each other. Building a level only needs to know how many nodes
+    the previous level split, and the nodes visited together during the
+    traversal lie close together in memory.
 
   - Prefer pointers over memoryviews where speed is essential. Memoryview
     indexing and slicing is slow compared to raw memory access. We can easily
@@ -35,143 +46,435 @@ References
 
 """
 import numpy as np
-from cpython.mem cimport PyMem_Malloc, PyMem_Free
+from cython.parallel import prange
+from libc.stdint cimport uint64_t
 
 
 cdef extern from "math.h":
-    double fabs(double x) nogil
-
-
-cdef void init_node(Node * node, Py_ssize_t n_dim, double * center, double length):
-    node.n_dims = n_dim
-    node.center = <double *>PyMem_Malloc(node.n_dims * sizeof(double))
-    node.center_of_mass = <double *>PyMem_Malloc(node.n_dims * sizeof(double))
-    if not node.center or not node.center_of_mass:
-        raise MemoryError()
-
-    cdef Py_ssize_t i
-    for i in range(node.n_dims):
-        node.center[i] = center[i]
-        node.center_of_mass[i] = 0
-
-    node.length = length
-
-    node.is_leaf = True
-    node.num_points = 0
-
-
-cdef Py_ssize_t get_child_idx_for(Node * node, double * point) nogil:
-    cdef Py_ssize_t idx = 0, d
-
-    for d in range(node.n_dims):
-        idx |= (point[d] > node.center[d]) << d
-
-    return idx
-
-
-cdef inline void update_center_of_mass(Node * node, double * point) nogil:
-    cdef Py_ssize_t d
-    for d in range(node.n_dims):
-        node.center_of_mass[d] = (node.center_of_mass[d] * node.num_points + point[d]) \
-            / (node.num_points + 1)
-    node.num_points += 1
-
-
-cdef void add_point_to(Node * node, double * point):
-    # If the node is a leaf node and empty, we"re done
-    if node.is_leaf and node.num_points == 0 or is_duplicate(node, point):
-        update_center_of_mass(node, point)
-        return
-
-    # Otherwise, we have to split the node and sink the previous, existing
-    # point into the appropriate child node
-    cdef Py_ssize_t child_index
-
-    if node.is_leaf:
-        split_node(node)
-        child_index = get_child_idx_for(node, node.center_of_mass)
-        update_center_of_mass(&node.children[child_index], node.center_of_mass)
-
-    update_center_of_mass(node, point)
-
-    # Finally, once the node is properly split, insert the new point into the
-    # corresponding child
-    child_index = get_child_idx_for(node, point)
-    add_point_to(&node.children[child_index], point)
-
-
-cdef void split_node(Node * node):
-    cdef double new_length = node.length / 2
-    cdef Py_ssize_t num_children = 1 << node.n_dims
-
-    node.is_leaf = False
-    node.children = <Node *>PyMem_Malloc(num_children * sizeof(Node))
-    if not node.children:
-        raise MemoryError()
-
+    double ldexp(double x, int exp) nogil
+
+
+cdef double DUPLICATE_EPS = 1e-6
+
+
+cdef inline uint64_t morton_code(
+    double * point, double * lower, double scale, Py_ssize_t n_dims, int n_bits
+) nogil:
+    """Interleave the bits of the quantized coordinates of a point, so that
+    every ``n_dims`` bits, starting with the most significant ones, form the
+    index of the child node containing the point on the corresponding level."""
+    cdef:
+        uint64_t code = 0, q, max_q = (<uint64_t>1 << n_bits) - 1
+        double x
+        Py_ssize_t d
+        int level
+
+    for d in range(n_dims):
+        x = (point[d] - lower[d]) * scale
+        if x <= 0:
+            q = 0
+        elif x >= max_q:
+            q = max_q
+        else:
+            q = <uint64_t>x
+        for level in range(n_bits):
+            code |= ((q >> level) & 1) << (level * n_dims + d)
+
+    return code
+
+
+cdef inline Py_ssize_t lower_bound(
+    uint64_t * keys, Py_ssize_t start, Py_ssize_t end, int shift, uint64_t mask, uint64_t digit
+) nogil:
+    """Find the first key in the range whose digit at ``shift`` is at least
+    ``digit``. The digits are sorted within the points of a single node."""
+    cdef Py_ssize_t mid
+    while start < end:
+        mid = start + (end - start) // 2
+        if ((keys[mid] >> shift) & mask) < digit:
+            start = mid + 1
+        else:
+            end = mid
+    return start
+
+
+cdef inline bint all_duplicates(
+    double * points, Py_ssize_t start, Py_ssize_t end, Py_ssize_t n_dims
+) nogil:
+    """Check whether all the points in the range are duplicates of the first
+    one. This usually stops at the second point."""
     cdef Py_ssize_t i, d
-    cdef double * new_center = <double *>PyMem_Malloc(node.n_dims * sizeof(double))
-    if not new_center:
-        raise MemoryError()
-
-    for i in range(num_children):
-        for d in range(node.n_dims):
-            if i & (1 << d):
-                new_center[d] = node.center[d] + new_length / 2
-            else:
-                new_center[d] = node.center[d] - new_length / 2
-        init_node(&node.children[i], node.n_dims, new_center, new_length)
-
-    PyMem_Free(new_center)
-
-
-cdef inline bint is_duplicate(Node * node, double * point, double duplicate_eps=1e-6) nogil:
-    cdef Py_ssize_t d
-    for d in range(node.n_dims):
-        if fabs(node.center_of_mass[d] - point[d]) >= duplicate_eps:
-            return False
+    for i in range(start + 1, end):
+        for d in range(n_dims):
+            if fabs(points[i * n_dims + d] - points[start * n_dims + d]) >= DUPLICATE_EPS:
+                return False
     return True
 
 
-cdef void delete_node(Node * node):
-    PyMem_Free(node.center)
-    PyMem_Free(node.center_of_mass)
-    if node.is_leaf:
-        return
-
-    cdef Py_ssize_t i
-    for i in range(1 << node.n_dims):
-        delete_node(&node.children[i])
-    PyMem_Free(node.children)
+cdef _grow(array, shape, Py_ssize_t n_used):
+    """Allocate a larger array, keeping the first `n_used` entries."""
+    array = np.asarray(array)
+    grown = np.empty(shape, dtype=array.dtype)
+    grown[:n_used] = array[:n_used]
+    return grown
 
 
 cdef class QuadTree:
-    def __init__(self, double[:, ::1] data):
+    """A space partitioning tree over the given points.
+
+    The tree may be rebuilt over different points with :meth:`build`, which
+    reuses the memory of the previous tree.
+
+    Parameters
+    ----------
+    data: Optional[np.ndarray]
+        The points to partition. If not given, the tree is empty until
+        :meth:`build` is called.
+
+    num_threads: int
+        The number of threads used to build the tree.
+
+    leaf_size: int
+        The largest number of points a node may hold without being split.
+
+    max_depth: Optional[int]
+        The depth below which no nodes are split, regardless of how many
+        points they hold. This bounds the size of the tree for clustered
+        points.
+
+    """
+    def __init__(self, double[:, ::1] data=None, Py_ssize_t num_threads=1,
+                 Py_ssize_t leaf_size=1, max_depth=None):
+        self.n_dims = 0
+        self.n_nodes = 0
+        self.n_levels = 0
+        self.leaf_size, self.max_depth = leaf_size, max_depth
+        self.level_offsets = np.zeros(1, dtype=np.intp)
+        self.points = np.empty((0, 0), dtype=float)
+        self.reset(0)
+        self.keys = self.keys_tmp = np.empty(0, dtype=np.uint64)
+        self.order = self.order_tmp = np.empty(0, dtype=np.intp)
+        if data is not None:
+            self.build(data, num_threads, leaf_size, max_depth)
+
+    cdef void reset(self, Py_ssize_t n_dims) except *:
+        """Drop all the nodes, e.g. when the dimensionality changes."""
+        self.n_dims = n_dims
+        self.center = np.empty((0, n_dims), dtype=float)
+        self.length = np.empty(0, dtype=float)
+        self.center_of_mass = np.empty((0, n_dims), dtype=float)
+        self.num_points = np.empty(0, dtype=np.intp)
+        self.first_child = np.empty(0, dtype=np.intp)
+        self.first_point = np.empty(0, dtype=np.intp)
+        self.duplicates_only = np.empty(0, dtype=np.uint8)
+
+    cdef void reserve(self, Py_ssize_t n_nodes, Py_ssize_t n_used) except *:
+        """Make room for `n_nodes` nodes, keeping the first `n_used` ones."""
+        cdef Py_ssize_t capacity = self.length.shape[0]
+        if n_nodes <= capacity:
+            return
+        capacity = max(n_nodes, capacity + capacity // 2)
+
+        self.center = _grow(self.center, (capacity, self.n_dims), n_used)
+        self.length = _grow(self.length, capacity, n_used)
+        self.center_of_mass = _grow(self.center_of_mass, (capacity, self.n_dims), n_used)
+        self.num_points = _grow(self.num_points, capacity, n_used)
+        self.first_child = _grow(self.first_child, capacity, n_used)
+        self.first_point = _grow(self.first_point, capacity, n_used)
+        self.duplicates_only = _grow(self.duplicates_only, capacity, n_used)
+
+    cdef void sort_keys(self, int n_key_bits, Py_ssize_t num_threads) except *:
+        """Sort the keys together with the point order using a stable LSD
+        radix sort.
+
+        Every thread counts and scatters a contiguous chunk of the keys, which
+        keeps the sort stable. Passes where all the keys share the same digit
+        are skipped, which is common for the leading digits.
+
+        """
         cdef:
-            Py_ssize_t n_dim = data.shape[1]
-            double[:] x_min = np.min(data, axis=0)
-            double[:] x_max = np.max(data, axis=0)
-
-            double[:] center = np.zeros(n_dim)
-            double length = 0
-            Py_ssize_t d
-
-        for d in range(n_dim):
-            center[d] = (x_max[d] + x_min[d]) / 2
-            if x_max[d] - x_min[d] > length:
-                length = x_max[d] - x_min[d]
+            Py_ssize_t n = self.keys.shape[0]
+            Py_ssize_t n_chunks = max(1, min(num_threads, n))
+            Py_ssize_t chunk_size = (n + n_chunks - 1) // n_chunks
+
+            uint64_t[::1] keys = self.keys, keys_tmp = self.keys_tmp
+            Py_ssize_t[::1] order = self.order, order_tmp = self.order_tmp
+            Py_ssize_t[:, ::1] offsets = np.empty((n_chunks, 256), dtype=np.intp)
+
+            Py_ssize_t t, i, b, j, bucket, total, bucket_size
+            int shift
+            bint skip_pass
+
+        for shift in range(0, n_key_bits, 8):
+            offsets[:, :] = 0
+            for t in prange(n_chunks, nogil=True, schedule="static", chunksize=1, num_threads=n_chunks):
+                for i in range(t * chunk_size, min((t + 1) * chunk_size, n)):
+                    offsets[t, (keys[i] >> shift) & 0xFF] += 1
+
+            # Turn the counts into the positions each chunk writes its keys to
+            total, skip_pass = 0, False
+            for b in range(256):
+                bucket_size = 0
+                for t in range(n_chunks):
+                    j = offsets[t, b]
+                    offsets[t, b] = total
+                    total = total + j
+                    bucket_size = bucket_size + j
+                if bucket_size == n:
+                    skip_pass = True
+            if skip_pass:
+                continue
+
+            for t in prange(n_chunks, nogil=True, schedule="static", chunksize=1, num_threads=n_chunks):
+                for i in range(t * chunk_size, min((t + 1) * chunk_size, n)):
+                    bucket = (keys[i] >> shift) & 0xFF
+                    j = offsets[t, bucket]
+                    offsets[t, bucket] = j + 1
+                    keys_tmp[j] = keys[i]
+                    order_tmp[j] = order[i]
+
+            keys, keys_tmp = keys_tmp, keys
+            order, order_tmp = order_tmp, order
+
+        self.keys, self.keys_tmp = keys, keys_tmp
+        self.order, self.order_tmp = order, order_tmp
+
+    cpdef void build(
+        self,
+        double[:, ::1] data,
+        Py_ssize_t num_threads=1,
+        Py_ssize_t leaf_size=1,
+        max_depth=None,
+    ) except *:
+        """Partition the given points, replacing the previous tree.
+
+        Parameters
+        ----------
+        data: np.ndarray
+            The points to partition.
+
+        num_threads: int
+            The number of threads used to build the tree.
+
+        leaf_size: int
+            The largest number of points a node may hold without being split.
+
+        max_depth: Optional[int]
+            The depth below which no nodes are split. By default, nodes are
+            split until they are far smaller than the duplicate tolerance.
+
+        """
+        cdef:
+            Py_ssize_t n_samples = data.shape[0]
+            Py_ssize_t n_dims = data.shape[1]
+            double[:] x_min, x_max
+            double[::1] lower = np.zeros(n_dims)
+            double length = 0, scale = 0
+            Py_ssize_t i, d
+
+        if n_dims > 16:
+            raise ValueError(
+                "Space partitioning trees support at most 16 dimensions, got %d." % n_dims
+            )
+        if leaf_size < 1:
+            raise ValueError("`leaf_size` must be at least 1, got %d." % leaf_size)
+        if max_depth is not None and max_depth < 0:
+            raise ValueError("`max_depth` must be non-negative, got %d." % max_depth)
+        if num_threads < 1:
+            num_threads = 1
+
+        # The bounding box of the root is the smallest square/cube containing
+        # all the points
+        cdef double[::1] root_center = np.zeros(n_dims)
+        if n_samples > 0:
+            x_min, x_max = np.min(data, axis=0), np.max(data, axis=0)
+            for d in range(n_dims):
+                root_center[d] = (x_max[d] + x_min[d]) / 2
+                if x_max[d] - x_min[d] > length:
+                    length = x_max[d] - x_min[d]
+
+        # Quantize the coordinates to as many bits as fit into the codes, but
+        # no more than 32, at which point nodes are far below `DUPLICATE_EPS`
+        cdef int n_bits = min(32, 64 // n_dims)
+        cdef Py_ssize_t depth_limit = n_bits
+        if max_depth is not None:
+            depth_limit = min(max_depth, n_bits)
+        self.leaf_size, self.max_depth = leaf_size, max_depth
+        if length > 0:
+            scale = ldexp(1, n_bits) / length
+        for d in range(n_dims):
+            lower[d] = root_center[d] - length / 2
+
+        if self.keys.shape[0] != n_samples:
+            self.keys = np.empty(n_samples, dtype=np.uint64)
+            self.keys_tmp = np.empty(n_samples, dtype=np.uint64)
+            self.order = np.empty(n_samples, dtype=np.intp)
+            self.order_tmp = np.empty(n_samples, dtype=np.intp)
+        if self.points.shape[0] != n_samples or self.points.shape[1] != n_dims:
+            self.points = np.empty((n_samples, n_dims), dtype=float)
 
-        self.root = Node()
-        init_node(&self.root, n_dim, &center[0], length)
-        self.add_points(data)
+        cdef:
+            uint64_t[::1] keys = self.keys
+            Py_ssize_t[::1] order = self.order
+        for i in prange(n_samples, nogil=True, schedule="static", num_threads=num_threads):
+            keys[i] = morton_code(&data[i, 0], &lower[0], scale, n_dims, n_bits)
+            order[i] = i
+
+        self.sort_keys(n_bits * n_dims, num_threads)
+
+        cdef double[:, ::1] points = self.points
+        keys, order = self.keys, self.order
+        for i in prange(n_samples, nogil=True, schedule="static", num_threads=num_threads):
+            for d in range(n_dims):
+                points[i, d] = data[order[i], d]
+
+        # Most trees need about twice as many nodes as there are points
+        if n_dims != self.n_dims:
+            self.reset(n_dims)
+        self.reserve(max(2 * n_samples, 1), 0)
+        self.center[0, :] = root_center
+        self.length[0] = length
+        self.num_points[0] = n_samples
+        self.first_point[0] = 0
 
-    cpdef void add_points(self, double[:, ::1] points):
-        cdef Py_ssize_t i
-        for i in range(points.shape[0]):
-            add_point_to(&self.root, &points[i, 0])
+        cdef:
+            Py_ssize_t n_children = 1 << n_dims
+            uint64_t mask = n_children - 1
+            list level_offsets = [0, 1]
+            Py_ssize_t level, level_start, level_end, n_nodes = 1
+            Py_ssize_t node, child, c, start, end
+            int shift
+
+            double[:, ::1] center
+            double[::1] lengths
+            double[:, ::1] center_of_mass
+            Py_ssize_t[::1] num_points, first_child, first_point
+            unsigned char[::1] duplicates_only
+
+        # Build the tree top-down, one level at a time. Nodes containing at
+        # most `leaf_size` points, only duplicates or ending up on the last
+        # level become leaves, all others are split
+        for level in range(depth_limit + 1):
+            level_start, level_end = level_offsets[level], level_offsets[level + 1]
+            center, lengths, center_of_mass = self.center, self.length, self.center_of_mass
+            num_points, first_child, first_point = self.num_points, self.first_child, self.first_point
+            duplicates_only = self.duplicates_only
+
+            # Mark the nodes to split and compute the centers of mass of leaves
+            for node in prange(level_start, level_end, nogil=True, schedule="guided",
+                               num_threads=num_threads):
+                start = first_point[node]
+                end = start + num_points[node]
+                duplicates_only[node] = end - start > leaf_size and all_duplicates(
+                    &points[0, 0], start, end, n_dims
+                )
+                if end - start > leaf_size and level < depth_limit and not duplicates_only[node]:
+                    first_child[node] = 0
+                else:
+                    first_child[node] = -1
+                    for d in range(n_dims):
+                        center_of_mass[node, d] = 0
+                    for c in range(start, end):
+                        for d in range(n_dims):
+                            center_of_mass[node, d] += points[c, d]
+                    if end > start:
+                        for d in range(n_dims):
+                            center_of_mass[node, d] /= end - start
+
+            for node in range(level_start, level_end):
+                if first_child[node] == 0:
+                    first_child[node] = n_nodes
+                    n_nodes = n_nodes + n_children
+            if n_nodes == level_end:
+                break
+            level_offsets.append(n_nodes)
+
+            self.reserve(n_nodes, level_end)
+            center, lengths, center_of_mass = self.center, self.length, self.center_of_mass
+            num_points, first_child, first_point = self.num_points, self.first_child, self.first_point
+
+            # Create the children of the split nodes and distribute the points
+            shift = (n_bits - 1 - level) * n_dims
+            for node in prange(level_start, level_end, nogil=True, schedule="guided",
+                               num_threads=num_threads):
+                if first_child[node] < 0:
+                    continue
+                start = first_point[node]
+                end = start + num_points[node]
+                for c in range(n_children):
+                    child = first_child[node] + c
+                    lengths[child] = lengths[node] / 2
+                    for d in range(n_dims):
+                        if c & (1 << d):
+                            center[child, d] = center[node, d] + lengths[node] / 4
+                        else:
+                            center[child, d] = center[node, d] - lengths[node] / 4
+                    first_point[child] = lower_bound(&keys[0], start, end, shift, mask, <uint64_t>c)
+                    if c > 0:
+                        num_points[child - 1] = first_point[child] - first_point[child - 1]
+                num_points[first_child[node] + n_children - 1] = \
+                    end - first_point[first_child[node] + n_children - 1]
+
+        self.n_nodes = n_nodes
+        self.n_levels = len(level_offsets) - 1
+        self.level_offsets = np.array(level_offsets, dtype=np.intp)
+
+        # Aggregate the centers of mass bottom-up, one level at a time
+        for level in range(self.n_levels - 2, -1, -1):
+            level_start, level_end = level_offsets[level], level_offsets[level + 1]
+            for node in prange(level_start, level_end, nogil=True, schedule="guided",
+                               num_threads=num_threads):
+                if first_child[node] < 0:
+                    continue
+                for d in range(n_dims):
+                    center_of_mass[node, d] = 0
+                for child in range(first_child[node], first_child[node] + n_children):
+                    for d in range(n_dims):
+                        center_of_mass[node, d] += center_of_mass[child, d] * num_points[child]
+                for d in range(n_dims):
+                    center_of_mass[node, d] /= num_points[node]
+
+    cpdef bint is_built_from(self, double[:, ::1] data):
+        """Check whether the tree partitions exactly the given points, e.g. to
+        decide whether a cached tree can be reused.
+
+        Parameters
+        ----------
+        data: np.ndarray
+
+        Returns
+        -------
+        bool
+
+        """
+        cdef:
+            Py_ssize_t i, d
+            Py_ssize_t[::1] order = self.order
 
-    cpdef void add_point(self, double[::1] point):
-        add_point_to(&self.root, &point[0])
+        if self.n_nodes == 0 or data.shape[0] != self.points.shape[0] \
+                or data.shape[1] != self.points.shape[1]:
+            return False
 
-    def __dealloc__(self):
-        delete_node(&self.root)
+        with nogil:
+            for i in range(data.shape[0]):
+                for d in range(data.shape[1]):
+                    if self.points[i, d] != data[order[i], d]:
+                        return False
+        return True
+
+    cdef Py_ssize_t max_stack_size(self):
+        """The most nodes a depth-first traversal of the tree has to keep on
+        its stack at once."""
+        return max(self.n_levels - 1, 0) * ((1 << self.n_dims) - 1) + 1
+
+    cpdef void add_points(self, double[:, ::1] points) except *:
+        """Add points to the tree. This rebuilds the whole tree."""
+        self.build(
+            np.vstack((self.points, points)) if self.n_nodes else points,
+            leaf_size=self.leaf_size,
+            max_depth=self.max_depth,
+        )
+
+    cpdef void add_point(self, double[::1] point) except *:
+        """Add a single point to the tree. This rebuilds the whole tree."""
+        self.add_points(np.asarray(point)[np.newaxis, :])
@@ -0,0 +1,225 @@
+"""Schedules for the accuracy of the tree approximations during optimization.
+
+The ``theta`` and ``dual_tree_theta`` parameters of the optimizer may be given
+as schedules instead of numbers. A schedule is a callable, which is given the
+current iteration and the total number of iterations of the optimization call
+and returns the value to use for that iteration, e.g.::
+
+    embedding.optimize(750, theta=Piecewise([(0, 0.8), (500, 0.5)]))
+
+Coarse approximations are usually good enough early on, when the points move
+a lot between iterations, while more accurate ones only matter close to
+convergence. Every call to :meth:`openTSNE.TSNEEmbedding.optimize`, i.e. every
+phase of the optimization, starts counting iterations from zero.
+
+:class:`AdaptiveTheta` instead adjusts the value during optimization, so that
+the approximation error of the repulsive forces stays close to a target.
+
+"""
+import numpy as np
+from sklearn.utils import check_random_state
+
+from . import _tsne
+
+
+class Schedule:
+    """Base class for parameter schedules."""
+
+    def __call__(self, iteration, n_iter):
+        """Get the value of the parameter.
+
+        Parameters
+        ----------
+        iteration: int
+            The current iteration, counted from the start of the optimization
+            call.
+
+        n_iter: int
+            The number of iterations of the optimization call.
+
+        Returns
+        -------
+        float
+
+        """
+
+
+class Piecewise(Schedule):
+    """A piecewise constant schedule.
+
+    Parameters
+    ----------
+    values: List[Tuple[int, float]]
+        Pairs of the iteration from which on a value is used and the value.
+        Before the first of these iterations, the first value is used.
+
+    """
+
+    def __init__(self, values):
+        if len(values) == 0:
+            raise ValueError("`values` must contain at least one value.")
+        self.values = sorted(values)
+
+    def __call__(self, iteration, n_iter):
+        value = self.values[0][1]
+        for start, start_value in self.values:
+            if start > iteration:
+                break
+            value = start_value
+        return value
+
+
+class Linear(Schedule):
+    """Change the value linearly over each optimization call.
+
+    Parameters
+    ----------
+    start: float
+        The value in the first iteration.
+
+    end: float
+        The value in the last iteration.
+
+    """
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+
+    def __call__(self, iteration, n_iter):
+        if n_iter <= 1:
+            return self.end
+        return self.start + (self.end - self.start) * iteration / (n_iter - 1)
+
+
+class AdaptiveTheta(Schedule):
+    """Adjust the accuracy of the tree approximation to a target error.
+
+    Every ``every_iters`` iterations, the repulsive forces on a few randomly
+    chosen points are computed both with the current approximation and
+    exactly, reusing the tree built for the gradient. The relative error of
+    the approximation of the single-tree method grows roughly quadratically
+    with ``theta``, and that of the dual-tree method cubically, so the value
+    is scaled by the corresponding root of the ratio between the target and
+    the measured error.
+
+    The exact forces on each of the ``n_samples`` points take time linear in
+    the number of points, and the dual-tree approximation can only be
+    computed for all the points at once, so measurements should be kept
+    small and rare for large data sets. The schedule keeps its value between
+    optimization calls, so it can be shared by all the phases of the
+    optimization.
+
+    Parameters
+    ----------
+    target_error: float
+        The target relative error of the repulsive forces.
+
+    theta: float
+        The initial value.
+
+    min_theta: float
+        The smallest value to use.
+
+    max_theta: float
+        The largest value to use.
+
+    every_iters: int
+        How many iterations should pass between each time the error is
+        measured.
+
+    n_samples: int
+        The number of points on which to measure the error.
+
+    random_state: Union[int, RandomState]
+        The random state used to choose the points.
+
+    Attributes
+    ----------
+    errors: List[Tuple[int, float, float]]
+        The iterations at which the error was measured, the values used and
+        the measured errors.
+
+    """
+
+    def __init__(self, target_error=0.01, theta=0.5, min_theta=0.1, max_theta=1.2,
+                 every_iters=25, n_samples=100, random_state=None):
+        if not 0 < min_theta <= max_theta:
+            raise ValueError("`min_theta` must be positive and at most `max_theta`.")
+        self.target_error = target_error
+        self.theta = float(np.clip(theta, min_theta, max_theta))
+        self.min_theta = min_theta
+        self.max_theta = max_theta
+        self.every_iters = every_iters
+        self.n_samples = n_samples
+        self.random_state = check_random_state(random_state)
+        self.errors = []
+
+    def __call__(self, iteration, n_iter):
+        return self.theta
+
+    def adapt(self, iteration, tree, points, dof=1, dual_tree=False, n_jobs=1):
+        """Measure the error of the approximation and adjust the value.
+
+        Parameters
+        ----------
+        iteration: int
+            The current iteration.
+
+        tree: QuadTree
+            The tree of the points exerting the repulsive forces.
+
+        points: np.ndarray
+            The points the tree was built from.
+
+        dof: float
+            Degrees of freedom of the Student's t-distribution.
+
+        dual_tree: bool
+            Whether the value is used for the dual-tree approximation.
+
+        n_jobs: int
+            The number of threads to use.
+
+        """
+        if iteration % self.every_iters != 0 or tree.n_nodes == 0:
+            return
+
+        points = np.ascontiguousarray(points, dtype=np.float64)
+        indices = self.random_state.choice(
+            points.shape[0], min(self.n_samples, points.shape[0]), replace=False
+        )
+        sample = np.ascontiguousarray(points[indices])
+
+        # The forces on every point are normalized by their own sum of q_ij,
+        # so the error doesn't depend on how the gradient is normalized
+        exact = np.zeros_like(sample)
+        _tsne.estimate_negative_gradient_bh(
+            tree, sample, exact, theta=0, dof=dof, num_threads=n_jobs,
+            pairwise_normalization=False,
+        )
+        if dual_tree:
+            approximate = np.zeros_like(points)
+            _tsne.estimate_negative_gradient_bh_dual(
+                tree, points, approximate, theta=self.theta, dof=dof,
+                num_threads=n_jobs, pairwise_normalization=False,
+            )
+            approximate = approximate[indices]
+        else:
+            approximate = np.zeros_like(sample)
+            _tsne.estimate_negative_gradient_bh(
+                tree, sample, approximate, theta=self.theta, dof=dof,
+                num_threads=n_jobs, pairwise_normalization=False,
+            )
+
+        norm = np.linalg.norm(exact)
+        if norm == 0:
+            return
+        error = np.linalg.norm(approximate - exact) / norm
+        self.errors.append((iteration, self.theta, error))
+
+        # Don't overreact to a single noisy measurement
+        order = 3 if dual_tree else 2
+        factor = (self.target_error / max(error, 1e-12)) ** (1 / order)
+        factor = np.clip(factor, 2 / 3, 3 / 2)
+        self.theta = float(np.clip(self.theta * factor, self.min_theta, self.max_theta))
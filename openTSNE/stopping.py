@@ -0,0 +1,149 @@
+"""Stopping rules for ending an optimization phase once it has converged.
+
+The optimizer evaluates the KL divergence every ``stopping_rule_every_iters``
+iterations and passes it to the stopping rule. The rules only look at the
+relative change of the error between evaluations, so checking them is
+essentially free, apart from evaluating the error itself.
+
+"""
+
+
+class StoppingRule:
+    """Base class for stopping rules.
+
+    Attributes
+    ----------
+    errors: List[Tuple[int, float]]
+        The iteration numbers and errors seen during the current optimization.
+
+    """
+
+    def __init__(self):
+        self.errors = []
+
+    def optimization_about_to_start(self):
+        """This is called at the beginning of the optimization procedure."""
+        self.errors = []
+
+    def improvement_rate(self, index=-1):
+        """The mean relative decrease of the error per iteration between the
+        error at ``index`` and the one evaluated before it.
+
+        Parameters
+        ----------
+        index: int
+            The index of the error in :attr:`errors`.
+
+        Returns
+        -------
+        Optional[float]
+            None if there are not enough errors recorded.
+
+        """
+        if index < 0:
+            index += len(self.errors)
+        if index < 1 or index >= len(self.errors):
+            return None
+        prev_iteration, prev_error = self.errors[index - 1]
+        iteration, error = self.errors[index]
+        return (prev_error - error) / abs(prev_error) / (iteration - prev_iteration)
+
+    def __call__(self, iteration, error, embedding=None):
+        """Record the current error and decide whether to stop.
+
+        Stopping rules share the signature of callbacks, so they may also be
+        used to interrupt an optimization as a callback.
+
+        Parameters
+        ----------
+        iteration: int
+            The current iteration number.
+
+        error: float
+            The current KL divergence of the embedding.
+
+        embedding: np.ndarray
+            The current embedding.
+
+        Returns
+        -------
+        bool
+            Whether the optimization has converged and should be stopped.
+
+        """
+        self.errors.append((iteration, error))
+        return self.should_stop()
+
+    def should_stop(self):
+        """Decide whether to stop, given the errors seen so far in
+        ``self.errors``, a list of ``(iteration, error)`` pairs.
+
+        Returns
+        -------
+        bool
+
+        """
+
+
+class ImprovementRatePeak(StoppingRule):
+    """Stop once the rate of improvement of the error has peaked.
+
+    This is meant for the early exaggeration phase [1]_. After the initial
+    rapid decrease, the error improves more slowly while the clusters form,
+    and then stalls once they have separated. We stop when the relative rate
+    of improvement passes a local maximum or the error stops decreasing
+    altogether. The rate is typically noisy over the first few iterations,
+    so the phase is never stopped before ``min_iter`` iterations.
+
+    Parameters
+    ----------
+    min_iter: int
+        The minimum number of iterations to run.
+
+    References
+    ----------
+    .. [1] Belkina, Anna C., et al. "Automated optimized parameters for
+       T-distributed stochastic neighbor embedding improve visualization and
+       analysis of large datasets." Nature communications 10.1 (2019): 1-12.
+
+    """
+
+    def __init__(self, min_iter=100):
+        super().__init__()
+        self.min_iter = min_iter
+
+    def should_stop(self):
+        rate = self.improvement_rate()
+        if rate is None or self.errors[-1][0] < self.min_iter:
+            return False
+        if rate <= 0:
+            return True
+
+        prev_rate, prev_prev_rate = self.improvement_rate(-2), self.improvement_rate(-3)
+        if prev_prev_rate is None:
+            return False
+        return prev_prev_rate < prev_rate > rate
+
+
+class RelativeImprovementBelow(StoppingRule):
+    """Stop once the error improves by less than a given relative tolerance per
+    iteration.
+
+    This is meant for the main optimization phase, where the error decreases
+    monotonically and more and more slowly.
+
+    Parameters
+    ----------
+    tol: float
+        The minimum relative decrease of the error per iteration required to
+        continue the optimization.
+
+    """
+
+    def __init__(self, tol=5e-5):
+        super().__init__()
+        self.tol = tol
+
+    def should_stop(self):
+        rate = self.improvement_rate()
+        return rate is not None and rate < self.tol
@@ -1,15 +1,34 @@
+import copy
+import hashlib
 import inspect
 import logging
 import multiprocessing
+import os
+import pickle
+import shutil
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+from functools import partial
 from collections import Iterable
 from types import SimpleNamespace
 
 import numpy as np
+import scipy.sparse as sp
 from sklearn.base import BaseEstimator
+from sklearn.utils import check_random_state
 
 from . import _tsne
 from . import initialization as initialization_scheme
-from .affinity import Affinities, PerplexityBasedNN
+from . import ordering
+from . import profiling
+from . import stopping
+from .affinity import (
+    Affinities,
+    CompactSymmetricMatrix,
+    PerplexityBasedNN,
+    PermutedAffinities,
+)
 from .quad_tree import QuadTree
 
 EPSILON = np.finfo(np.float64).eps
@@ -32,21 +51,115 @@ def _check_callbacks(callbacks):
     return callbacks
 
 
-def _handle_nice_params(optim_params: dict) -> None:
+def _accepts_parameter(func, name):
+    """Check whether a callable accepts a keyword argument called `name`."""
+    try:
+        parameters = inspect.signature(func).parameters
+    except (TypeError, ValueError):
+        return False
+    return name in parameters or any(
+        p.kind == inspect.Parameter.VAR_KEYWORD for p in parameters.values()
+    )
+
+
+def _auto_learning_rate(n_samples, exaggeration=None):
+    # The learning rate has to grow with the number of points, otherwise the
+    # optimization of large data sets slows to a crawl. Dividing by the
+    # exaggeration keeps the product of the two constant, which avoids
+    # oscillations during early exaggeration (Belkina et al., 2019)
+    if exaggeration is None:
+        exaggeration = 1
+    return max(n_samples / exaggeration, 50)
+
+
+def _auto_early_exaggeration(n_samples, learning_rate):
+    # With a learning rate of N / exaggeration, the standard exaggeration
+    # works well for any data set size. With a fixed learning rate, pick the
+    # exaggeration so that its product with the learning rate stays close to
+    # N / 10, as suggested by the analysis of early exaggeration by Linderman
+    # and Steinerberger (2019)
+    if learning_rate == "auto":
+        return 12
+    return float(np.clip(n_samples / (10 * learning_rate), 12, 32))
+
+
+def _auto_negative_gradient_method(n_samples, n_dims, dof=1, n_reference_samples=None):
+    # Summing over all pairs is fastest for small data sets, where the trees
+    # and interpolation grids don't pay off. With a reference embedding, every
+    # new point interacts with every reference point. Interpolation is only
+    # implemented for up to two dimensions and the Cauchy kernel, and its
+    # fixed grid overhead only pays off for large data sets. The tree of a
+    # reference embedding is built only once, so few new points are best
+    # added with Barnes-Hut
+    n_pairs = n_samples * (n_samples if n_reference_samples is None else n_reference_samples)
+    # One dimensional embeddings with the Cauchy kernel have a dedicated exact
+    # method, which is slower than interpolation only by a small factor
+    if n_pairs <= 2000 ** 2 or (n_dims == 1 and dof == 1):
+        return "exact"
+    if n_dims <= 2 and dof == 1 and n_samples >= 10000:
+        return "fft"
+    return "bh"
+
+
+def _handle_nice_params(embedding: np.ndarray, optim_params: dict,
+                        reference_embedding: np.ndarray = None) -> None:
     """Convert the user friendly params into something the optimizer can
     understand."""
+    # Handle the learning rate, which may depend on the number of points
+    learning_rate = optim_params.get("learning_rate")
+    if isinstance(learning_rate, str):
+        if learning_rate != "auto":
+            raise ValueError(
+                "Unrecognized learning rate `%s`. Please provide a number or "
+                "`auto`." % learning_rate
+            )
+        optim_params["learning_rate"] = _auto_learning_rate(
+            embedding.shape[-2], optim_params.get("exaggeration")
+        )
+
+    # Randomized gradient methods draw from the random state of the embedding,
+    # unless one is given explicitly
+    if optim_params.get("random_state") is None:
+        optim_params["random_state"] = getattr(embedding, "random_state", None)
+
     # Handle callbacks
     optim_params["callbacks"] = _check_callbacks(optim_params.get("callbacks"))
     optim_params["use_callbacks"] = optim_params["callbacks"] is not None
 
     # Handle negative gradient method
     negative_gradient_method = optim_params.pop("negative_gradient_method")
+    # The method is chosen anew for every optimization call, e.g. adding
+    # points to an embedding may use a different method than creating it
+    if negative_gradient_method == "auto":
+        n_samples, n_dims = (embedding.shape[0], 1) if embedding.ndim == 1 \
+            else embedding.shape[-2:]
+        negative_gradient_method = _auto_negative_gradient_method(
+            n_samples, n_dims, dof=optim_params.get("dof", 1),
+            n_reference_samples=None if reference_embedding is None
+            else reference_embedding.shape[0],
+        )
+        log.info(
+            "Using the `%s` negative gradient method for %d points in %d "
+            "dimensions." % (negative_gradient_method, n_samples, n_dims)
+        )
     if callable(negative_gradient_method):
         negative_gradient_method = negative_gradient_method
     elif negative_gradient_method in {"bh", "BH", "barnes-hut"}:
         negative_gradient_method = kl_divergence_bh
+    elif negative_gradient_method in {"bh-dual", "dual-tree"}:
+        n_dims = 1 if embedding.ndim == 1 else embedding.shape[-1]
+        if n_dims > 3:
+            raise ValueError(
+                "The dual-tree approximation supports embeddings with at most "
+                "3 dimensions, got %d. Please use `bh` instead." % n_dims
+            )
+        negative_gradient_method = kl_divergence_bh_dual
     elif negative_gradient_method in {"fft", "FFT", "interpolation"}:
         negative_gradient_method = kl_divergence_fft
+    elif negative_gradient_method in {"sampling", "negative-sampling"}:
+        negative_gradient_method = kl_divergence_sampled
+    elif negative_gradient_method == "exact":
+        negative_gradient_method = kl_divergence_all_pairs
     else:
         raise ValueError("Unrecognized gradient method. Please choose one of "
                          "the supported methods or provide a valid callback.")
@@ -95,6 +208,44 @@ init_checks = SimpleNamespace(
 )
 
 
+@contextmanager
+def _replace_directory(path):
+    """Write the new contents of a directory into a temporary directory, which
+    replaces the original only once it has been written completely."""
+    tmp_path, old_path = path + ".tmp", path + ".old"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    yield tmp_path
+
+    if os.path.exists(path):
+        shutil.rmtree(old_path, ignore_errors=True)
+        os.replace(path, old_path)
+    os.replace(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+def _existing_directory(path):
+    # We may have been interrupted while replacing the directory
+    if not os.path.exists(path) and os.path.exists(path + ".old"):
+        return path + ".old"
+    return path
+
+
+class _PermutedCallback:
+    """Pass the embedding to a callback with its points in the original order."""
+
+    def __init__(self, callback, inverse_permutation):
+        self.callback = callback
+        self.inverse_permutation = inverse_permutation
+
+    def optimization_about_to_start(self):
+        getattr(self.callback, "optimization_about_to_start", lambda: ...)()
+
+    def __call__(self, iteration, error, embedding):
+        return self.callback(iteration, error, embedding.permute(self.inverse_permutation))
+
+
 class OptimizationInterrupt(InterruptedError):
     """Optimization was interrupted by a callback.
 
@@ -115,6 +266,120 @@ class OptimizationInterrupt(InterruptedError):
         self.final_embedding = final_embedding
 
 
+class OptimizationHandle:
+    """A handle to an optimization running in a background thread.
+
+    Handles are returned by :meth:`TSNEEmbedding.optimize_async`. The numeric
+    kernels release the GIL, so the calling thread, e.g. the event loop of a
+    user interface, stays responsive while the embedding is optimized.
+
+    Attributes
+    ----------
+    future: concurrent.futures.Future
+        Resolves to the optimized embedding once the optimization finishes or
+        is cancelled, or holds the exception raised during optimization.
+
+    """
+
+    def __init__(self, embedding, snapshot_every_iters=1):
+        self.future = Future()
+        self.future.set_running_or_notify_cancel()
+        self.snapshot_every_iters = snapshot_every_iters
+
+        self._cancelled = threading.Event()
+        self._unpaused = threading.Event()
+        self._unpaused.set()
+
+        # The optimizer writes into the back buffer and then swaps it with
+        # the front one, so readers always see a complete snapshot
+        self._lock = threading.Lock()
+        self._buffers = [np.array(embedding), np.array(embedding)]
+        self._front = 0
+        self._iteration = 0
+
+    def _run(self, optimize, **params):
+        try:
+            embedding = optimize(step_callback=self._step_callback, **params)
+            self._publish(embedding.optimizer.progress["iteration"], embedding)
+            self.future.set_result(embedding)
+        except BaseException as ex:
+            self.future.set_exception(ex)
+
+    def _step_callback(self, iteration, embedding):
+        if iteration % self.snapshot_every_iters == 0:
+            self._publish(iteration, embedding)
+        # Paused optimizations simply block the worker thread here
+        self._unpaused.wait()
+        return self._cancelled.is_set()
+
+    def _publish(self, iteration, embedding):
+        back = 1 - self._front
+        np.copyto(self._buffers[back], embedding)
+        with self._lock:
+            self._front, self._iteration = back, iteration
+
+    def snapshot(self):
+        """Get the latest published point positions without copying them.
+
+        The returned array is read-only and is overwritten once the snapshot
+        after the next one is published, so copy it if it needs to be kept.
+
+        Returns
+        -------
+        int
+            The number of iterations completed at the time of the snapshot.
+        np.ndarray
+            The point positions.
+
+        """
+        with self._lock:
+            snapshot = self._buffers[self._front].view()
+            iteration = self._iteration
+        snapshot.flags.writeable = False
+        return iteration, snapshot
+
+    def pause(self):
+        """Pause the optimization after the current iteration."""
+        self._unpaused.clear()
+
+    def resume(self):
+        """Continue a paused optimization."""
+        self._unpaused.set()
+
+    @property
+    def paused(self):
+        return not self._unpaused.is_set()
+
+    def cancel(self):
+        """Stop the optimization after the current iteration.
+
+        The future then resolves to the partially optimized embedding, which
+        can be continued later with :meth:`TSNEEmbedding.resume`.
+
+        """
+        self._cancelled.set()
+        self._unpaused.set()
+
+    def done(self):
+        """Whether the optimization has finished or was cancelled."""
+        return self.future.done()
+
+    def result(self, timeout=None):
+        """Wait for the optimization to finish and return the embedding.
+
+        Parameters
+        ----------
+        timeout: Optional[float]
+            The maximum number of seconds to wait.
+
+        Returns
+        -------
+        TSNEEmbedding
+
+        """
+        return self.future.result(timeout)
+
+
 class PartialTSNEEmbedding(np.ndarray):
     """A partial t-SNE embedding.
 
@@ -138,11 +403,15 @@ class PartialTSNEEmbedding(np.ndarray):
         data point :math:`n` to each data point in the existing embedding
         :math:`m`.
 
-    learning_rate: float
+    learning_rate: Union[str, float]
         The learning rate for t-SNE optimization. Typical values range between
         100 to 1000. Setting the learning rate too low or too high may result in
         the points forming a "ball". This is also known as the crowding problem.
 
+        If ``auto``, the learning rate is set to :math:`\\max(N / \\alpha,
+        50)`, where :math:`N` is the number of points and :math:`\\alpha`
+        the exaggeration.
+
     exaggeration: float
         The exaggeration factor is used to increase the attractive forces of
         nearby points, producing more compact clusters.
@@ -155,15 +424,29 @@ class PartialTSNEEmbedding(np.ndarray):
         Specifies the negative gradient approximation method to use. For smaller
         data sets, the Barnes-Hut approximation is appropriate and can be set
         using one of the following aliases: ``bh``, ``BH`` or ``barnes-hut``.
+        The dual-tree variant, ``bh-dual`` or ``dual-tree``, shares the work
+        between nearby points and is considerably faster, especially for
+        embeddings in more than two dimensions, where FFT is unavailable.
         For larger data sets, the FFT accelerated interpolation method is more
         appropriate and can be set using one of the following aliases: ``fft``,
-        ``FFT`` or ``ìnterpolation``.
-
-    theta: float
+        ``FFT`` or ``ìnterpolation``. For quick previews of very large data
+        sets, the repulsive forces can be estimated from a few randomly
+        sampled points with ``sampling`` or ``negative-sampling``. For up to
+        a few thousand points, computing the forces exactly with ``exact`` is
+        usually fastest. With ``auto``, one of ``exact``, ``bh`` and ``fft``
+        is chosen for every optimization call, depending on the number of
+        points, the number of dimensions and ``dof``. The forces within one
+        dimensional embeddings with ``dof=1`` are computed exactly in time
+        close to linear in the number of points, so ``auto`` always uses
+        ``exact`` for them.
+
+    theta: Union[float, Callable[[int, int], float]]
         This is the trade-off parameter between speed and accuracy of the tree
         approximation method. Typical values range from 0.2 to 0.8. The value 0
         indicates that no approximation is to be made and produces exact results
-        also producing longer runtime.
+        also producing longer runtime. May also be a schedule, e.g. from
+        :mod:`openTSNE.schedules`, which is given the iteration and the number
+        of iterations and returns the value to use.
 
     n_interpolation_points: int
         Only used when ``negative_gradient_method="fft"`` or its other aliases.
@@ -196,10 +479,12 @@ class PartialTSNEEmbedding(np.ndarray):
         How many iterations should pass between each time the callbacks are
         invoked.
 
-    optimizer: gradient_descent
+    optimizer: Union[str, Optimizer]
         Optionally, an existing optimizer can be used for optimization. This is
         useful for keeping momentum gains between different calls to
-        :func:`optimize`.
+        :func:`optimize`. The name of one of the built-in optimizers
+        ``gradient_descent``, ``adaptive_momentum`` or ``adam`` is also
+        accepted.
 
     Attributes
     ----------
@@ -218,12 +503,7 @@ class PartialTSNEEmbedding(np.ndarray):
         obj.P = P
         obj.gradient_descent_params = gradient_descent_params
 
-        if optimizer is None:
-            optimizer = gradient_descent()
-        elif not isinstance(optimizer, gradient_descent):
-            raise TypeError("`optimizer` must be an instance of `%s`, but got `%s`." % (
-                gradient_descent.__class__.__name__, type(optimizer)))
-        obj.optimizer = optimizer
+        obj.optimizer = _check_optimizer(optimizer)
 
         obj.kl_divergence = None
 
@@ -238,12 +518,16 @@ class PartialTSNEEmbedding(np.ndarray):
         n_iter: int
             The number of optimization iterations.
 
-        learning_rate: float
+        learning_rate: Union[str, float]
             The learning rate for t-SNE optimization. Typical values range
             between 100 to 1000. Setting the learning rate too low or too high
             may result in the points forming a "ball". This is also known as the
             crowding problem.
 
+            If ``auto``, the learning rate is set to :math:`\\max(N / \\alpha,
+            50)`, where :math:`N` is the number of points and :math:`\\alpha`
+            the exaggeration.
+
         exaggeration: float
             The exaggeration factor is used to increase the attractive forces of
             nearby points, producing more compact clusters.
@@ -259,12 +543,24 @@ class PartialTSNEEmbedding(np.ndarray):
             ``barnes-hut``. For larger data sets, the FFT accelerated
             interpolation method is more appropriate and can be set using one of
             the following aliases: ``fft``, ``FFT`` or ``ìnterpolation``.
-
-        theta: float
+            For quick previews of very large data sets, the repulsive forces
+            can be estimated from a few randomly sampled points with
+            ``sampling`` or ``negative-sampling``. For up to a few thousand
+            points, computing the forces exactly with ``exact`` is usually
+            fastest. With ``auto``, one of ``exact``, ``bh`` and ``fft`` is
+            chosen for every optimization call, depending on the number of
+            points, the number of dimensions and ``dof``. The forces within one
+            dimensional embeddings with ``dof=1`` are computed exactly in time
+            close to linear in the number of points, so ``auto`` always uses
+            ``exact`` for them.
+
+        theta: Union[float, Callable[[int, int], float]]
             This is the trade-off parameter between speed and accuracy of the
             tree approximation method. Typical values range from 0.2 to 0.8. The
             value 0 indicates that no approximation is to be made and produces
-            exact results also producing longer runtime.
+            exact results also producing longer runtime. May also be a schedule,
+            e.g. from :mod:`openTSNE.schedules`, which is given the iteration
+            and the number of iterations and returns the value to use.
 
         n_interpolation_points: int
             Only used when ``negative_gradient_method="fft"`` or its other
@@ -336,7 +632,7 @@ class PartialTSNEEmbedding(np.ndarray):
         # over the defaults specified in the TSNE object
         optim_params = dict(self.gradient_descent_params)
         optim_params.update(gradient_descent_params)
-        _handle_nice_params(optim_params)
+        _handle_nice_params(embedding, optim_params, self.reference_embedding)
         optim_params["n_iter"] = n_iter
 
         try:
@@ -375,11 +671,15 @@ class TSNEEmbedding(np.ndarray):
         points to the points in the existing embedding. The affinity index also
         contains the affinity matrix :math:`P` used during optimization.
 
-    learning_rate: float
+    learning_rate: Union[str, float]
         The learning rate for t-SNE optimization. Typical values range between
         100 to 1000. Setting the learning rate too low or too high may result in
         the points forming a "ball". This is also known as the crowding problem.
 
+        If ``auto``, the learning rate is set to :math:`\\max(N / \\alpha,
+        50)`, where :math:`N` is the number of points and :math:`\\alpha`
+        the exaggeration.
+
     exaggeration: float
         The exaggeration factor is used to increase the attractive forces of
         nearby points, producing more compact clusters.
@@ -392,15 +692,29 @@ class TSNEEmbedding(np.ndarray):
         Specifies the negative gradient approximation method to use. For smaller
         data sets, the Barnes-Hut approximation is appropriate and can be set
         using one of the following aliases: ``bh``, ``BH`` or ``barnes-hut``.
+        The dual-tree variant, ``bh-dual`` or ``dual-tree``, shares the work
+        between nearby points and is considerably faster, especially for
+        embeddings in more than two dimensions, where FFT is unavailable.
         For larger data sets, the FFT accelerated interpolation method is more
         appropriate and can be set using one of the following aliases: ``fft``,
-        ``FFT`` or ``ìnterpolation``.
-
-    theta: float
+        ``FFT`` or ``ìnterpolation``. For quick previews of very large data
+        sets, the repulsive forces can be estimated from a few randomly
+        sampled points with ``sampling`` or ``negative-sampling``. For up to
+        a few thousand points, computing the forces exactly with ``exact`` is
+        usually fastest. With ``auto``, one of ``exact``, ``bh`` and ``fft``
+        is chosen for every optimization call, depending on the number of
+        points, the number of dimensions and ``dof``. The forces within one
+        dimensional embeddings with ``dof=1`` are computed exactly in time
+        close to linear in the number of points, so ``auto`` always uses
+        ``exact`` for them.
+
+    theta: Union[float, Callable[[int, int], float]]
         This is the trade-off parameter between speed and accuracy of the tree
         approximation method. Typical values range from 0.2 to 0.8. The value 0
         indicates that no approximation is to be made and produces exact results
-        also producing longer runtime.
+        also producing longer runtime. May also be a schedule, e.g. from
+        :mod:`openTSNE.schedules`, which is given the iteration and the number
+        of iterations and returns the value to use.
 
     n_interpolation_points: int
         Only used when ``negative_gradient_method="fft"`` or its other aliases.
@@ -433,10 +747,12 @@ class TSNEEmbedding(np.ndarray):
         How many iterations should pass between each time the callbacks are
         invoked.
 
-    optimizer: gradient_descent
+    optimizer: Union[str, Optimizer]
         Optionally, an existing optimizer can be used for optimization. This is
         useful for keeping momentum gains between different calls to
-        :func:`optimize`.
+        :func:`optimize`. The name of one of the built-in optimizers
+        ``gradient_descent``, ``adaptive_momentum`` or ``adam`` is also
+        accepted.
 
     Attributes
     ----------
@@ -455,14 +771,11 @@ class TSNEEmbedding(np.ndarray):
         obj.gradient_descent_params = gradient_descent_params  # type: dict
         obj.random_state = random_state
 
-        if optimizer is None:
-            optimizer = gradient_descent()
-        elif not isinstance(optimizer, gradient_descent):
-            raise TypeError("`optimizer` must be an instance of `%s`, but got `%s`." % (
-                gradient_descent.__class__.__name__, type(optimizer)))
-        obj.optimizer = optimizer
+        obj.optimizer = _check_optimizer(optimizer)
 
         obj.kl_divergence = None
+        # Set by `TSNE.fit` when profiling is enabled
+        obj.profiler = None
 
         return obj
 
@@ -477,12 +790,16 @@ class TSNEEmbedding(np.ndarray):
         n_iter: int
             The number of optimization iterations.
 
-        learning_rate: float
+        learning_rate: Union[str, float]
             The learning rate for t-SNE optimization. Typical values range
             between 100 to 1000. Setting the learning rate too low or too high
             may result in the points forming a "ball". This is also known as the
             crowding problem.
 
+            If ``auto``, the learning rate is set to :math:`\\max(N / \\alpha,
+            50)`, where :math:`N` is the number of points and :math:`\\alpha`
+            the exaggeration.
+
         exaggeration: float
             The exaggeration factor is used to increase the attractive forces of
             nearby points, producing more compact clusters.
@@ -498,12 +815,24 @@ class TSNEEmbedding(np.ndarray):
             ``barnes-hut``. For larger data sets, the FFT accelerated
             interpolation method is more appropriate and can be set using one of
             the following aliases: ``fft``, ``FFT`` or ``ìnterpolation``.
-
-        theta: float
+            For quick previews of very large data sets, the repulsive forces
+            can be estimated from a few randomly sampled points with
+            ``sampling`` or ``negative-sampling``. For up to a few thousand
+            points, computing the forces exactly with ``exact`` is usually
+            fastest. With ``auto``, one of ``exact``, ``bh`` and ``fft`` is
+            chosen for every optimization call, depending on the number of
+            points, the number of dimensions and ``dof``. The forces within one
+            dimensional embeddings with ``dof=1`` are computed exactly in time
+            close to linear in the number of points, so ``auto`` always uses
+            ``exact`` for them.
+
+        theta: Union[float, Callable[[int, int], float]]
             This is the trade-off parameter between speed and accuracy of the
             tree approximation method. Typical values range from 0.2 to 0.8. The
             value 0 indicates that no approximation is to be made and produces
-            exact results also producing longer runtime.
+            exact results also producing longer runtime. May also be a schedule,
+            e.g. from :mod:`openTSNE.schedules`, which is given the iteration
+            and the number of iterations and returns the value to use.
 
         n_interpolation_points: int
             Only used when ``negative_gradient_method="fft"`` or its other
@@ -587,7 +916,7 @@ class TSNEEmbedding(np.ndarray):
         # over the defaults specified in the TSNE object
         optim_params = dict(self.gradient_descent_params)
         optim_params.update(gradient_descent_params)
-        _handle_nice_params(optim_params)
+        _handle_nice_params(embedding, optim_params)
         optim_params["n_iter"] = n_iter
 
         try:
@@ -607,6 +936,345 @@ class TSNEEmbedding(np.ndarray):
 
         return embedding
 
+    def permute(self, permutation):
+        """Reorder the points in the embedding.
+
+        The affinity matrix and the optimizer state are reordered along with
+        the points, so optimization can continue as before. Reordering points
+        so that neighbors lie close together in memory can substantially
+        speed up optimization on large data sets. Permuting with the inverse
+        permutation restores the original affinities.
+
+        Parameters
+        ----------
+        permutation: np.ndarray
+            The new position ``i`` holds the point ``permutation[i]``.
+
+        Returns
+        -------
+        TSNEEmbedding
+            A reordered copy of the embedding.
+
+        """
+        permutation = np.asarray(permutation, dtype=np.intp)
+        init_checks.num_samples(permutation.shape[0], self.shape[0])
+
+        # Compose with any previous reordering, so we always refer to the
+        # original affinities, which can be restored on the way back
+        affinities = self.affinities
+        point_order = permutation
+        if isinstance(affinities, PermutedAffinities):
+            point_order = affinities.permutation[permutation]
+            affinities = affinities.affinities
+        if not np.array_equal(point_order, np.arange(point_order.shape[0])):
+            affinities = PermutedAffinities(affinities, point_order)
+
+        optimizer = self.optimizer.permute(permutation)
+
+        embedding = TSNEEmbedding(
+            np.asarray(self)[permutation],
+            affinities,
+            random_state=self.random_state,
+            optimizer=optimizer,
+            **self.gradient_descent_params,
+        )
+        embedding.kl_divergence = self.kl_divergence
+
+        return embedding
+
+    def resume(self, inplace=False, propagate_exception=False,
+               **gradient_descent_params):
+        """Continue an interrupted optimization, e.g. after loading a checkpoint.
+
+        The optimization is continued from the last completed iteration with
+        the learning rate, momentum and exaggeration it was started with, and
+        with the random number generator in the state it was in then. Any
+        phases that were still to come are run afterwards, e.g. the standard
+        phase when :meth:`TSNE.fit` was interrupted during early
+        exaggeration, so the result is the same as without the interruption.
+
+        Parameters
+        ----------
+        inplace: bool
+            Whether or not to create a copy of the embedding or to perform
+            updates inplace.
+
+        propagate_exception: bool
+            The optimization process can be interrupted using callbacks. This
+            flag indicates whether we should propagate that exception or to
+            simply stop optimization and return the resulting embedding.
+
+        **gradient_descent_params: dict
+            Any parameters accepted by :meth:`optimize`, used for the current
+            call and the phases still to come. Callbacks and the stopping rule
+            of the current call are not stored in checkpoints and have to be
+            passed here again. Stopping rules start over, without the errors
+            they had seen before the interruption.
+
+        Returns
+        -------
+        TSNEEmbedding
+            An optimized t-SNE embedding.
+
+        Raises
+        ------
+        RuntimeError
+            If the embedding has never been optimized.
+
+        """
+        progress = self.optimizer.progress
+        if progress is None:
+            raise RuntimeError("The embedding has not been optimized yet.")
+
+        optim_params = {
+            "learning_rate": progress["learning_rate"],
+            "momentum": progress["momentum"],
+            "exaggeration": progress["exaggeration"],
+        }
+        optim_params.update(gradient_descent_params)
+
+        embedding = self.optimize(
+            progress["n_iter"], inplace=inplace,
+            propagate_exception=propagate_exception, resume=True,
+            **optim_params,
+        )
+
+        # Every phase is removed before it starts, so the ones left over are
+        # still to come
+        optimizer = embedding.optimizer
+        while optimizer.phases and \
+                optimizer.progress["iteration"] == optimizer.progress["n_iter"]:
+            phase = optimizer.phases.pop(0)
+            embedding = embedding.optimize(
+                inplace=True, propagate_exception=propagate_exception,
+                **dict(phase, **gradient_descent_params),
+            )
+
+        return embedding
+
+    def optimize_async(self, n_iter, inplace=False, snapshot_every_iters=1,
+                       **gradient_descent_params):
+        """Run the optimization in a background thread.
+
+        This returns immediately with a handle, through which the optimization
+        can be paused, resumed or cancelled, and which publishes snapshots of
+        the point positions as the optimization progresses, e.g. for drawing
+        the embedding in an interactive application.
+
+        Parameters
+        ----------
+        n_iter: int
+            The number of iterations to run.
+
+        inplace: bool
+            Whether or not to create a copy of the embedding or to perform
+            updates inplace. The embedding should not be accessed from other
+            threads during inplace optimization; use snapshots instead.
+
+        snapshot_every_iters: int
+            How many iterations should pass between each published snapshot.
+
+        **gradient_descent_params: dict
+            Any parameters accepted by :meth:`optimize`.
+
+        Returns
+        -------
+        OptimizationHandle
+
+        """
+        handle = OptimizationHandle(self, snapshot_every_iters=snapshot_every_iters)
+        worker = threading.Thread(
+            target=handle._run,
+            kwargs=dict(
+                optimize=self.optimize,
+                n_iter=n_iter,
+                inplace=inplace,
+                propagate_exception=False,
+                **gradient_descent_params,
+            ),
+            daemon=True,
+        )
+        worker.start()
+
+        return handle
+
+    def save_checkpoint(self, path):
+        """Save everything needed to resume the optimization into a directory.
+
+        The checkpoint contains the point positions, the optimizer state
+        including the gains, momentum and progress of the current call, the
+        state of its random number generator and the phases still to come,
+        e.g. the standard phase during the early exaggeration of
+        :meth:`TSNE.fit`, the optimization parameters and the random state.
+        The affinity matrix does not change during optimization, so it is only
+        written when it differs from the one already saved into ``path``,
+        which is checked using a hash of its contents. It is stored as plain
+        ``.npy`` files, so it can be memory-mapped when loading.
+
+        Checkpoints are meant to be saved repeatedly into the same directory,
+        e.g. using :class:`openTSNE.callbacks.Checkpoint`. The previous
+        checkpoint is only replaced once the new one has been fully written,
+        so an interruption while saving never leaves a broken checkpoint.
+
+        Callbacks and the stopping rule of the current call, along with any
+        state they keep, e.g. the errors a stopping rule has seen so far, are
+        not saved and have to be passed to :meth:`resume` again. The
+        optimization parameters and phases are pickled, so schedules have to
+        be picklable, e.g. the ones from :mod:`openTSNE.schedules`, but not
+        lambdas. The affinities are saved as a plain affinity matrix, so
+        embedding new points via :meth:`transform` is not possible after
+        loading.
+
+        Parameters
+        ----------
+        path: str
+            The checkpoint directory.
+
+        Raises
+        ------
+        ValueError
+            If any of the optimization parameters cannot be pickled.
+
+        """
+        os.makedirs(path, exist_ok=True)
+
+        affinities, permutation = self.affinities, None
+        if isinstance(affinities, PermutedAffinities):
+            affinities, permutation = affinities.affinities, affinities.permutation
+        P = affinities.P
+        digest = hashlib.sha1()
+        for name in ("data", "indices", "indptr"):
+            array = np.ascontiguousarray(getattr(P, name))
+            digest.update(array.dtype.str.encode())
+            digest.update(array)
+        P_info = {
+            "shape": P.shape,
+            "nnz": P.nnz,
+            "compact": isinstance(P, CompactSymmetricMatrix),
+            "digest": digest.hexdigest(),
+        }
+
+        # Fail before writing anything, so the previous checkpoint is kept
+        params = {k: v for k, v in self.gradient_descent_params.items() if k != "callbacks"}
+        phase_params = [
+            (name, value) for phase in self.optimizer.phases for name, value in phase.items()
+        ]
+        for name, value in list(params.items()) + phase_params:
+            try:
+                pickle.dumps(value)
+            except Exception as e:
+                raise ValueError(
+                    "The optimization parameter `%s` cannot be saved into a "
+                    "checkpoint, since it cannot be pickled (%s). Please use a "
+                    "picklable value, e.g. a schedule from `openTSNE.schedules` "
+                    "or a module-level function instead of a lambda." % (name, e)
+                ) from e
+
+        # Write the affinities only if they differ from the saved ones
+        affinities_path = os.path.join(path, "affinities")
+        saved_info = None
+        if os.path.exists(os.path.join(affinities_path, "info.pkl")):
+            with open(os.path.join(affinities_path, "info.pkl"), "rb") as f:
+                saved_info = pickle.load(f)
+        if saved_info != P_info:
+            with _replace_directory(affinities_path) as tmp_path:
+                for name in ("data", "indices", "indptr"):
+                    np.save(os.path.join(tmp_path, name + ".npy"), getattr(P, name))
+                with open(os.path.join(tmp_path, "info.pkl"), "wb") as f:
+                    pickle.dump(P_info, f)
+
+        # Per-point state is stored in `.npy` files, everything else is pickled
+        optimizer = copy.copy(self.optimizer)
+        optimizer._buffers = {}
+        for name in optimizer._state:
+            setattr(optimizer, name, None)
+
+        with _replace_directory(os.path.join(path, "state")) as tmp_path:
+            np.save(os.path.join(tmp_path, "embedding.npy"), np.asarray(self))
+            if permutation is not None:
+                np.save(os.path.join(tmp_path, "permutation.npy"), permutation)
+            for name in optimizer._state:
+                value = getattr(self.optimizer, name)
+                if value is not None:
+                    np.save(os.path.join(tmp_path, "optimizer_%s.npy" % name), value)
+
+            with open(os.path.join(tmp_path, "checkpoint.pkl"), "wb") as f:
+                pickle.dump({
+                    "optimizer": optimizer,
+                    "gradient_descent_params": params,
+                    "random_state": self.random_state,
+                    "kl_divergence": self.kl_divergence,
+                }, f)
+
+    @classmethod
+    def load_checkpoint(cls, path, mmap_mode="c", **gradient_descent_params):
+        """Load an embedding saved with :meth:`save_checkpoint`.
+
+        Use :meth:`resume` to continue an interrupted optimization.
+
+        Parameters
+        ----------
+        path: str
+            The checkpoint directory.
+
+        mmap_mode: Optional[str]
+            The memory-map mode used for the affinity matrix, see
+            :func:`numpy.load`. The default copy-on-write mode avoids loading
+            the full matrix into memory. Use ``None`` to load it into memory.
+
+        **gradient_descent_params: dict
+            Optimization parameters overriding the saved ones, e.g. callbacks.
+
+        Returns
+        -------
+        TSNEEmbedding
+
+        """
+        affinities_path = _existing_directory(os.path.join(path, "affinities"))
+        with open(os.path.join(affinities_path, "info.pkl"), "rb") as f:
+            P_info = pickle.load(f)
+        P = sp.csr_matrix(
+            tuple(
+                np.load(os.path.join(affinities_path, name + ".npy"), mmap_mode=mmap_mode)
+                for name in ("data", "indices", "indptr")
+            ),
+            shape=P_info["shape"],
+            copy=False,
+        )
+        if P_info["compact"]:
+            P = CompactSymmetricMatrix.from_upper_triangle(P)
+        affinities = Affinities()
+        affinities.P = P
+
+        state_path = _existing_directory(os.path.join(path, "state"))
+        with open(os.path.join(state_path, "checkpoint.pkl"), "rb") as f:
+            checkpoint = pickle.load(f)
+
+        if os.path.exists(os.path.join(state_path, "permutation.npy")):
+            affinities = PermutedAffinities(
+                affinities, np.load(os.path.join(state_path, "permutation.npy"))
+            )
+
+        optimizer = checkpoint["optimizer"]
+        for name in optimizer._state:
+            filename = os.path.join(state_path, "optimizer_%s.npy" % name)
+            if os.path.exists(filename):
+                setattr(optimizer, name, np.load(filename))
+
+        params = checkpoint["gradient_descent_params"]
+        params.update(gradient_descent_params)
+
+        embedding = TSNEEmbedding(
+            np.load(os.path.join(state_path, "embedding.npy")),
+            affinities,
+            random_state=checkpoint["random_state"],
+            optimizer=optimizer,
+            **params,
+        )
+        embedding.kl_divergence = checkpoint["kl_divergence"]
+
+        return embedding
+
     def transform(self, X, perplexity=5, initialization="median", k=25,
                   learning_rate=100, n_iter=100, exaggeration=2, momentum=0,
                   max_grad_norm=0.05):
@@ -642,12 +1310,16 @@ class TSNEEmbedding(np.ndarray):
             because perplexity affects optimization while this only affects the
             initial point positions.
 
-        learning_rate: float
+        learning_rate: Union[str, float]
             The learning rate for t-SNE optimization. Typical values range
             between 100 to 1000. Setting the learning rate too low or too high
             may result in the points forming a "ball". This is also known as the
             crowding problem.
 
+            If ``auto``, the learning rate is set to :math:`\\max(N / \\alpha,
+            50)`, where :math:`N` is the number of points and :math:`\\alpha`
+            the exaggeration.
+
         n_iter: int
             The number of iterations to run in the normal optimization regime.
             Typically, the number of iterations needed when adding new data
@@ -773,88 +1445,321 @@ class TSNEEmbedding(np.ndarray):
         )
 
 
-class TSNE(BaseEstimator):
-    """t-Distributed Stochastic Neighbor Embedding.
+class BatchedTSNEEmbedding(np.ndarray):
+    """A batch of t-SNE embeddings of the same data, optimized together.
 
-    Please see the :ref:`parameter-guide` for more information.
+    The embeddings are stacked into an array of shape :math:`B \\times N
+    \\times d`. Every embedding is optimized exactly as it would be on its own
+    and has its own optimizer state, which is useful e.g. to assess the
+    stability of the embedding over different initializations, or to compare
+    learning rates.
+
+    Only the attractive forces are batched: the affinity matrix is traversed
+    once per iteration for the whole batch, which saves memory traffic when
+    P is large. The repulsive forces depend on the geometry of each
+    embedding, i.e. on its own tree or interpolation grid, so they are still
+    computed for one embedding after another, each with a separate kernel
+    call. Since the repulsive forces usually dominate the running time, the
+    batch is not much faster than optimizing the embeddings separately.
 
     Parameters
     ----------
-    n_components: int
-        The dimension of the embedding space. This deafults to 2 for easy
-        visualization, but sometimes 1 is used for t-SNE heatmaps. t-SNE is
-        not designed to embed into higher dimension and please note that
-        acceleration schemes break down and are not fully implemented.
+    embeddings: np.ndarray
+        The initial point positions of all the embeddings, stacked into an
+        array of shape :math:`B \\times N \\times d`.
 
-    perplexity: float
-        Perplexity can be thought of as the continuous :math:`k` number of
-        nearest neighbors, for which t-SNE will attempt to preserve distances.
+    affinities: Affinities
+        The affinities shared by all the embeddings. Affinities stored as a
+        :class:`~openTSNE.affinity.CompactSymmetricMatrix` are not supported.
 
-    learning_rate: float
-        The learning rate for t-SNE optimization. Typical values range between
-        100 to 1000. Setting the learning rate too low or too high may
-        result in the points forming a "ball". This is also known as the
-        crowding problem.
+    random_state: Union[int, RandomState]
+        The random state parameter follows the convention used in scikit-learn.
+        If the value is an int, random_state is the seed used by the random
+        number generator. If the value is a RandomState instance, then it will
+        be used as the random number generator. If the value is None, the random
+        number generator is the RandomState instance used by `np.random`.
 
-    early_exaggeration_iter: int
-        The number of iterations to run in the *early exaggeration* phase.
+    optimizer: Union[str, Optimizer]
+        The optimizer to use. Every embedding is optimized with its own copy.
 
-    early_exaggeration: float
-        The exaggeration factor to use during the *early exaggeration* phase.
-        Typical values range from 12 to 32.
+    **gradient_descent_params: dict
+        The same optimization parameters as for :class:`TSNEEmbedding`. The
+        ``learning_rate`` and ``momentum`` can also be given as arrays with a
+        value for every embedding. Callbacks receive the whole batch and an
+        array with the KL divergence of every embedding.
 
-    n_iter: int
-        The number of iterations to run in the normal optimization regime.
+    Attributes
+    ----------
+    kl_divergence: np.ndarray
+        The KL divergence of every embedding.
 
-    exaggeration: float
-        The exaggeration factor to use during the normal optimization phase.
-        This can be used to form more densely packed clusters and is useful
-        for large data sets.
+    """
 
-    theta: float
-        Only used when ``negative_gradient_method="bh"`` or its other aliases.
-        This is the trade-off parameter between speed and accuracy of the tree
-        approximation method. Typical values range from 0.2 to 0.8. The value 0
-        indicates that no approximation is to be made and produces exact results
-        also producing longer runtime.
+    def __new__(cls, embeddings, affinities, random_state=None, optimizer=None,
+                **gradient_descent_params):
+        embeddings = np.asarray(embeddings, dtype=np.float64, order="C")
+        if embeddings.ndim != 3:
+            raise ValueError(
+                "The embeddings must be stacked into a three dimensional array, "
+                "but got an array with %d dimensions." % embeddings.ndim
+            )
+        init_checks.num_samples(embeddings.shape[1], affinities.P.shape[0])
 
-    n_interpolation_points: int
-        Only used when ``negative_gradient_method="fft"`` or its other aliases.
-        The number of interpolation points to use within each grid cell for
-        interpolation based t-SNE. It is highly recommended leaving this value
-        at the default 3.
+        obj = embeddings.view(BatchedTSNEEmbedding)
 
-    min_num_intervals: int
-        Only used when ``negative_gradient_method="fft"`` or its other aliases.
-        The minimum number of grid cells to use, regardless of the
-        ``ints_in_interval`` parameter. Higher values provide more accurate
-        gradient estimations.
+        obj.affinities = affinities  # type: Affinities
+        obj.gradient_descent_params = gradient_descent_params  # type: dict
+        obj.random_state = random_state
 
-    ints_in_interval: float
-        Only used when ``negative_gradient_method="fft"`` or its other aliases.
-        Indicates how large a grid cell should be e.g. a value of 3 indicates a
-        grid side length of 3. Lower values provide more accurate gradient
-        estimations.
+        if not isinstance(optimizer, _BatchOptimizer):
+            optimizer = _check_optimizer(optimizer)
+            optimizer = _BatchOptimizer(
+                [optimizer.copy() for _ in range(embeddings.shape[0])]
+            )
+        obj.optimizer = optimizer
 
-    initialization: Union[np.ndarray, str]
-        The initial point positions to be used in the embedding space. Can be a
-        precomputed numpy array, ``pca`` or ``random``. Please note that when
-        passing in a precomputed positions, it is highly recommended that the
-        point positions have small variance (var(Y) < 0.0001), otherwise you may
-        get poor embeddings.
+        obj.kl_divergence = None
 
-    metric: str
-        The metric to be used to compute affinities between points in the
-        original space.
+        return obj
 
-    metric_params: dict
-        Additional keyword arguments for the metric function.
+    def optimize(self, n_iter, inplace=False, propagate_exception=False,
+                 **gradient_descent_params):
+        """Run optmization on all the embeddings for a given number of steps.
 
-    initial_momentum: float
-        The momentum to use during the *early exaggeration* phase.
+        Parameters
+        ----------
+        n_iter: int
+            The number of optimization iterations.
 
-    final_momentum: float
-        The momentum to use during the normal optimization phase.
+        inplace: bool
+            Whether or not to create a copy of the embeddings or to perform
+            updates inplace.
+
+        propagate_exception: bool
+            The optimization process can be interrupted using callbacks. This
+            flag indicates whether we should propagate that exception or to
+            simply stop optimization and return the resulting embeddings.
+
+        **gradient_descent_params: dict
+            Any parameters accepted by :meth:`TSNEEmbedding.optimize`, except
+            for stopping rules, since every embedding converges at its own
+            pace.
+
+        Returns
+        -------
+        BatchedTSNEEmbedding
+            The optimized t-SNE embeddings.
+
+        Raises
+        ------
+        OptimizationInterrupt
+            If a callback stops the optimization and the ``propagate_exception``
+            flag is set, then an exception is raised.
+
+        ValueError
+            If a stopping rule is given.
+
+        """
+        # Typically we want to return a new embedding and keep the old one intact
+        if inplace:
+            embedding = self
+        else:
+            embedding = BatchedTSNEEmbedding(
+                np.copy(self),
+                self.affinities,
+                random_state=self.random_state,
+                optimizer=self.optimizer.copy(),
+                **self.gradient_descent_params,
+            )
+
+        # If optimization parameters were passed to this funciton, prefer those
+        # over the defaults specified in the TSNE object
+        optim_params = dict(self.gradient_descent_params)
+        optim_params.update(gradient_descent_params)
+        # Stopping rules follow a single error, while the batch has an error
+        # for every embedding
+        if optim_params.get("stopping_rule") is not None:
+            raise ValueError(
+                "Stopping rules are not supported for batches of embeddings."
+            )
+        _handle_nice_params(embedding, optim_params)
+        optim_params["n_iter"] = n_iter
+
+        try:
+            # Run gradient descent with the embedding optimizer so gains are
+            # properly updated and kept
+            error, embedding = embedding.optimizer(
+                embedding=embedding, P=self.affinities.P, **optim_params
+            )
+
+        except OptimizationInterrupt as ex:
+            log.info("Optimization was interrupted with callback.")
+            if propagate_exception:
+                raise ex
+            error, embedding = ex.error, ex.final_embedding
+
+        embedding.kl_divergence = error
+
+        return embedding
+
+    def unstack(self):
+        """Split the batch into separate embeddings.
+
+        Returns
+        -------
+        List[TSNEEmbedding]
+            The embeddings, each with its own copy of the optimizer state.
+
+        """
+        embeddings = []
+        for i, optimizer in enumerate(self.optimizer.optimizers):
+            embedding = TSNEEmbedding(
+                np.array(self[i]),
+                self.affinities,
+                random_state=self.random_state,
+                optimizer=optimizer.copy(),
+                **self.gradient_descent_params,
+            )
+            if self.kl_divergence is not None:
+                embedding.kl_divergence = self.kl_divergence[i]
+            embeddings.append(embedding)
+
+        return embeddings
+
+
+class TSNE(BaseEstimator):
+    """t-Distributed Stochastic Neighbor Embedding.
+
+    Please see the :ref:`parameter-guide` for more information.
+
+    Parameters
+    ----------
+    n_components: int
+        The dimension of the embedding space. This deafults to 2 for easy
+        visualization, but sometimes 1 is used for t-SNE heatmaps. t-SNE is
+        not designed to embed into higher dimension and please note that
+        acceleration schemes break down and are not fully implemented.
+
+    perplexity: float
+        Perplexity can be thought of as the continuous :math:`k` number of
+        nearest neighbors, for which t-SNE will attempt to preserve distances.
+
+    learning_rate: Union[str, float]
+        The learning rate for t-SNE optimization. Typical values range between
+        100 to 1000. Setting the learning rate too low or too high may
+        result in the points forming a "ball". This is also known as the
+        crowding problem.
+
+        If ``auto``, the learning rate is set to :math:`\\max(N / \\alpha,
+        50)`, where :math:`N` is the number of points and :math:`\\alpha`
+        the exaggeration [1]_.
+
+    early_exaggeration_iter: int
+        The number of iterations to run in the *early exaggeration* phase.
+
+    early_exaggeration: Union[str, float]
+        The exaggeration factor to use during the *early exaggeration* phase.
+        Typical values range from 12 to 32. If ``auto``, the exaggeration is
+        12 when the learning rate is also ``auto``. Otherwise it is chosen so
+        that its product with the learning rate is close to :math:`N / 10`
+        [2]_, within the typical range.
+
+    n_iter: int
+        The number of iterations to run in the normal optimization regime.
+
+    exaggeration: float
+        The exaggeration factor to use during the normal optimization phase.
+        This can be used to form more densely packed clusters and is useful
+        for large data sets.
+
+    theta: Union[float, Callable[[int, int], float]]
+        Only used when ``negative_gradient_method="bh"`` or its other aliases.
+        This is the trade-off parameter between speed and accuracy of the tree
+        approximation method. Typical values range from 0.2 to 0.8. The value 0
+        indicates that no approximation is to be made and produces exact results
+        also producing longer runtime. May also be a schedule, e.g. from
+        :mod:`openTSNE.schedules`, which is given the iteration and the number
+        of iterations and returns the value to use.
+
+    dual_tree_theta: Union[float, Callable[[int, int], float]]
+        Only used when ``negative_gradient_method="bh-dual"`` or its other
+        aliases. The trade-off parameter between speed and accuracy of the
+        dual-tree approximation. Two nodes of the tree interact as a whole when
+        the sum of their radii is smaller than ``dual_tree_theta`` times the
+        distance between them. The default is about as accurate as ``theta=0.5``
+        with the single-tree method, and considerably faster. The value 0
+        produces exact results. May also be a schedule, e.g. from
+        :mod:`openTSNE.schedules`, which is given the iteration and the number
+        of iterations and returns the value to use.
+
+    leaf_size: Optional[int]
+        Only used when ``negative_gradient_method="bh"``, ``"bh-dual"`` or
+        their aliases. The maximum number of points in a leaf of the
+        space-partitioning tree. Larger leaves make for smaller trees that are
+        faster to build, but leave more interactions to be summed over exactly.
+        Leaves containing only duplicates of the same point may hold more
+        points. By default, leaves hold a single point for ``"bh"`` and 32
+        points for ``"bh-dual"``, which relies on neighboring leaves
+        interacting exactly.
+
+    max_tree_depth: Optional[int]
+        Only used when ``negative_gradient_method="bh"``, ``"bh-dual"`` or
+        their aliases. Nodes at this depth of the space-partitioning tree are
+        not split any further, which bounds the size of the tree for heavily
+        clustered embeddings. By default, the depth is limited only by the precision of
+        the tree's point ordering.
+
+    n_interpolation_points: int
+        Only used when ``negative_gradient_method="fft"`` or its other aliases.
+        The number of interpolation points to use within each grid cell for
+        interpolation based t-SNE. It is highly recommended leaving this value
+        at the default 3.
+
+    min_num_intervals: int
+        Only used when ``negative_gradient_method="fft"`` or its other aliases.
+        The minimum number of grid cells to use, regardless of the
+        ``ints_in_interval`` parameter. Higher values provide more accurate
+        gradient estimations.
+
+    ints_in_interval: float
+        Only used when ``negative_gradient_method="fft"`` or its other aliases.
+        Indicates how large a grid cell should be e.g. a value of 3 indicates a
+        grid side length of 3. Lower values provide more accurate gradient
+        estimations.
+
+    n_negative_samples: int
+        Only used when ``negative_gradient_method="sampling"``. The number of
+        points sampled to estimate the repulsive forces acting on each point.
+        The forces of the nearest neighbors are always computed exactly.
+        Values between 5 and 10 are usually enough for a quick preview. The
+        estimates are noisy, so a lower learning rate often gives cleaner
+        embeddings.
+
+    negative_sampling_batch_size: int
+        Only used when ``negative_gradient_method="sampling"``. The number of
+        consecutive points sharing the same negative samples. Sharing samples
+        is more cache friendly, but the forces on nearby points become
+        correlated.
+
+    initialization: Union[np.ndarray, str]
+        The initial point positions to be used in the embedding space. Can be a
+        precomputed numpy array, ``pca`` or ``random``. Please note that when
+        passing in a precomputed positions, it is highly recommended that the
+        point positions have small variance (var(Y) < 0.0001), otherwise you may
+        get poor embeddings.
+
+    metric: str
+        The metric to be used to compute affinities between points in the
+        original space.
+
+    metric_params: dict
+        Additional keyword arguments for the metric function.
+
+    initial_momentum: float
+        The momentum to use during the *early exaggeration* phase.
+
+    final_momentum: float
+        The momentum to use during the normal optimization phase.
 
     min_grad_norm: float
         If the gradient norm is below this threshold, the optimization will
@@ -881,9 +1786,21 @@ class TSNE(BaseEstimator):
         Specifies the negative gradient approximation method to use. For smaller
         data sets, the Barnes-Hut approximation is appropriate and can be set
         using one of the following aliases: ``bh``, ``BH`` or ``barnes-hut``.
+        The dual-tree variant, ``bh-dual`` or ``dual-tree``, shares the work
+        between nearby points and is considerably faster, especially for
+        embeddings in more than two dimensions, where FFT is unavailable.
         For larger data sets, the FFT accelerated interpolation method is more
         appropriate and can be set using one of the following aliases: ``fft``,
-        ``FFT`` or ``ìnterpolation``.
+        ``FFT`` or ``ìnterpolation``. For quick previews of very large data
+        sets, the repulsive forces can be estimated from a few randomly
+        sampled points with ``sampling`` or ``negative-sampling``. For up to
+        a few thousand points, computing the forces exactly with ``exact`` is
+        usually fastest. With ``auto``, one of ``exact``, ``bh`` and ``fft``
+        is chosen for every optimization call, depending on the number of
+        points, the number of dimensions and ``dof``. The forces within one
+        dimensional embeddings with ``dof=1`` are computed exactly in time
+        close to linear in the number of points, so ``auto`` always uses
+        ``exact`` for them.
 
     callbacks: Union[Callable, List[Callable]]
         Callbacks, which will be run every ``callbacks_every_iters`` iterations.
@@ -898,6 +1815,56 @@ class TSNE(BaseEstimator):
         be used as the random number generator. If the value is None, the random
         number generator is the RandomState instance used by `np.random`.
 
+    reorder: Optional[Union[str, Callable]]
+        Reorder the points during optimization to improve memory locality,
+        which can speed up optimization of large data sets. Can be ``rcm``,
+        which applies the reverse Cuthill-McKee ordering to the affinity
+        matrix, or ``morton``, which orders points along a space-filling curve
+        through the initial embedding. The returned embedding is always in the
+        original order.
+
+    compact_affinities: bool
+        Store the symmetric affinity matrix as a
+        :class:`~openTSNE.affinity.CompactSymmetricMatrix`, which keeps every
+        edge only once. This halves the memory needed for the affinities and
+        speeds up the computation of the attractive forces.
+
+    optimizer: Union[str, Optimizer]
+        The optimizer used to minimize the t-SNE objective. Can be
+        ``gradient_descent``, which uses momentum and gains, its variant
+        ``adaptive_momentum`` with an automatic momentum schedule, which
+        usually needs fewer iterations, or ``adam``. An :class:`Optimizer`
+        instance may also be given, a copy of which is used for every fit.
+
+    auto_stop: Union[bool, float]
+        End each optimization phase early once it has converged. The KL
+        divergence is then evaluated every 10 iterations, and
+        ``early_exaggeration_iter`` and ``n_iter`` become the maximum number
+        of iterations. The early exaggeration phase ends once the rate of
+        improvement of the KL divergence has peaked, and the main phase once
+        the KL divergence improves by less than a relative tolerance per
+        iteration. If a number is given, it is used as this tolerance,
+        otherwise it is ``5e-5``. See :mod:`openTSNE.stopping`.
+
+    profile: Union[bool, Profiler]
+        Record the time spent in each phase of the pipeline, from the nearest
+        neighbor search to the individual parts of every optimization
+        iteration. The :class:`~openTSNE.profiling.Profiler` is attached to
+        the embedding returned by :meth:`fit` as ``embedding.profiler``. A
+        profiler may also be passed in directly, e.g. to export the timings
+        with its ``on_record`` hook. See :mod:`openTSNE.profiling`.
+
+
+    References
+    ----------
+    .. [1] Belkina, Anna C., et al. "Automated optimized parameters for
+       T-distributed stochastic neighbor embedding improve visualization and
+       analysis of large datasets." Nature communications 10.1 (2019): 1-12.
+
+    .. [2] Linderman, George C., and Stefan Steinerberger. "Clustering with
+       t-SNE, provably." SIAM Journal on Mathematics of Data Science 1.2
+       (2019): 313-332.
+
     """
 
     def __init__(
@@ -910,9 +1877,14 @@ class TSNE(BaseEstimator):
         n_iter=750,
         exaggeration=None,
         theta=0.5,
+        dual_tree_theta=0.5,
+        leaf_size=None,
+        max_tree_depth=None,
         n_interpolation_points=3,
         min_num_intervals=10,
         ints_in_interval=1,
+        n_negative_samples=5,
+        negative_sampling_batch_size=1,
         initialization="pca",
         metric="euclidean",
         metric_params=None,
@@ -926,6 +1898,11 @@ class TSNE(BaseEstimator):
         callbacks=None,
         callbacks_every_iters=50,
         random_state=None,
+        reorder=None,
+        compact_affinities=False,
+        optimizer="gradient_descent",
+        auto_stop=False,
+        profile=False,
     ):
         self.n_components = n_components
         self.perplexity = perplexity
@@ -935,9 +1912,14 @@ class TSNE(BaseEstimator):
         self.n_iter = n_iter
         self.exaggeration = exaggeration
         self.theta = theta
+        self.dual_tree_theta = dual_tree_theta
+        self.leaf_size = leaf_size
+        self.max_tree_depth = max_tree_depth
         self.n_interpolation_points = n_interpolation_points
         self.min_num_intervals = min_num_intervals
         self.ints_in_interval = ints_in_interval
+        self.n_negative_samples = n_negative_samples
+        self.negative_sampling_batch_size = negative_sampling_batch_size
 
         # Check if the number of components match the initialization dimension
         if isinstance(initialization, np.ndarray):
@@ -958,6 +1940,11 @@ class TSNE(BaseEstimator):
         self.callbacks_every_iters = callbacks_every_iters
 
         self.random_state = random_state
+        self.reorder = reorder
+        self.compact_affinities = compact_affinities
+        self.optimizer = optimizer
+        self.auto_stop = auto_stop
+        self.profile = profile
 
     def fit(self, X):
         """Fit a t-SNE embedding for a given data set.
@@ -976,33 +1963,92 @@ class TSNE(BaseEstimator):
             A fully optimized t-SNE embedding.
 
         """
+        if self.profile is False or self.profile is None:
+            return self._fit(X)
+
+        profiler = self.profile
+        if not isinstance(profiler, profiling.Profiler):
+            profiler = profiling.Profiler()
+        with profiler:
+            embedding = self._fit(X)
+        embedding.profiler = profiler
+
+        return embedding
+
+    def _fit(self, X):
         embedding = self.prepare_initial(X)
 
+        optim_params = {}
+        inverse_permutation = None
+        if self.reorder is not None:
+            with profiling.phase("reordering"):
+                permutation = ordering.get_permutation(
+                    self.reorder, embedding.affinities.P, embedding
+                )
+                embedding = embedding.permute(permutation)
+            inverse_permutation = np.argsort(permutation)
+
+            # Callbacks should see the points in their original order
+            callbacks = _check_callbacks(self.callbacks)
+            if callbacks is not None:
+                optim_params["callbacks"] = [
+                    _PermutedCallback(callback, inverse_permutation)
+                    for callback in callbacks
+                ]
+
+        early_exaggeration_stop, final_stop = {}, {}
+        if self.auto_stop is not False:
+            tol = 5e-5 if self.auto_stop is True else self.auto_stop
+            early_exaggeration_stop["stopping_rule"] = stopping.ImprovementRatePeak()
+            final_stop["stopping_rule"] = stopping.RelativeImprovementBelow(tol)
+
+        early_exaggeration = self.early_exaggeration
+        if early_exaggeration == "auto":
+            early_exaggeration = _auto_early_exaggeration(
+                embedding.shape[0], self.learning_rate
+            )
+
+        # Restore actual affinity probabilities and increase momentum to get
+        # final, optimized embedding
+        standard_phase = dict(
+            n_iter=self.n_iter,
+            exaggeration=self.exaggeration,
+            momentum=self.final_momentum,
+            **final_stop,
+        )
+
         try:
             # Early exaggeration with lower momentum to allow points to find more
-            # easily move around and find their neighbors
+            # easily move around and find their neighbors. The optimizer keeps
+            # the phase still to come, so an interrupted fit can be completed
+            # with `resume`
+            embedding.optimizer.phases = [standard_phase]
             embedding.optimize(
                 n_iter=self.early_exaggeration_iter,
-                exaggeration=self.early_exaggeration,
+                exaggeration=early_exaggeration,
                 momentum=self.initial_momentum,
                 inplace=True,
                 propagate_exception=True,
+                **early_exaggeration_stop,
+                **optim_params,
             )
 
-            # Restore actual affinity probabilities and increase momentum to get
-            # final, optimized embedding
+            embedding.optimizer.phases = []
             embedding.optimize(
-                n_iter=self.n_iter,
-                exaggeration=self.exaggeration,
-                momentum=self.final_momentum,
                 inplace=True,
                 propagate_exception=True,
+                **standard_phase,
+                **optim_params,
             )
 
         except OptimizationInterrupt as ex:
             log.info("Optimization was interrupted with callback.")
             embedding = ex.final_embedding
 
+        # Restore the original point order
+        if inverse_permutation is not None:
+            embedding = embedding.permute(inverse_permutation)
+
         return embedding
 
     def prepare_initial(self, X):
@@ -1035,27 +2081,32 @@ class TSNE(BaseEstimator):
                 )
 
         elif self.initialization == "pca":
-            embedding = initialization_scheme.pca(
-                X, self.n_components, random_state=self.random_state
-            )
+            with profiling.phase("initialization"):
+                embedding = initialization_scheme.pca(
+                    X, self.n_components, random_state=self.random_state
+                )
         elif self.initialization == "random":
-            embedding = initialization_scheme.random(
-                X, self.n_components, random_state=self.random_state
-            )
+            with profiling.phase("initialization"):
+                embedding = initialization_scheme.random(
+                    X, self.n_components, random_state=self.random_state
+                )
         else:
             raise ValueError(
                 f"Unrecognized initialization scheme `{self.initialization}`."
             )
 
-        affinities = PerplexityBasedNN(
-            X,
-            self.perplexity,
-            method=self.neighbors_method,
-            metric=self.metric,
-            metric_params=self.metric_params,
-            n_jobs=self.n_jobs,
-            random_state=self.random_state,
-        )
+        with profiling.phase("affinities"):
+            affinities = PerplexityBasedNN(
+                X,
+                self.perplexity,
+                method=self.neighbors_method,
+                metric=self.metric,
+                metric_params=self.metric_params,
+                n_jobs=self.n_jobs,
+                random_state=self.random_state,
+            )
+        if self.compact_affinities:
+            affinities.P = CompactSymmetricMatrix(affinities.P)
 
         gradient_descent_params = {
             # Degrees of freedom of the Student's t-distribution. The
@@ -1069,10 +2120,16 @@ class TSNE(BaseEstimator):
 
             # Barnes-Hut params
             "theta": self.theta,
+            "dual_tree_theta": self.dual_tree_theta,
+            "leaf_size": self.leaf_size,
+            "max_tree_depth": self.max_tree_depth,
             # Interpolation params
             "n_interpolation_points": self.n_interpolation_points,
             "min_num_intervals": self.min_num_intervals,
             "ints_in_interval": self.ints_in_interval,
+            # Negative sampling params
+            "n_negative_samples": self.n_negative_samples,
+            "negative_sampling_batch_size": self.negative_sampling_batch_size,
 
             "min_grad_norm": self.min_grad_norm,
             "max_grad_norm": self.max_grad_norm,
@@ -1083,73 +2140,183 @@ class TSNE(BaseEstimator):
             "callbacks_every_iters": self.callbacks_every_iters,
         }
 
+        # Every embedding needs its own optimizer state
+        optimizer = self.optimizer
+        if isinstance(optimizer, Optimizer):
+            optimizer = optimizer.copy()
+
         return TSNEEmbedding(
             embedding,
             affinities=affinities,
             random_state=self.random_state,
+            optimizer=optimizer,
             **gradient_descent_params,
         )
 
 
-def kl_divergence_bh(embedding, P, dof, bh_params, reference_embedding=None,
-                     should_eval_error=False, n_jobs=1, **_):
-    gradient = np.zeros_like(embedding, dtype=np.float64, order="C")
+def _estimate_positive_gradient(P, embedding, reference_embedding, gradient,
+                                dof, exaggeration=1, n_jobs=1,
+                                should_eval_error=False):
+    # Symmetric affinities storing each edge once apply the force to both
+    # endpoints, which only makes sense when optimizing against ourselves
+    if isinstance(P, CompactSymmetricMatrix):
+        if reference_embedding is not embedding:
+            raise ValueError(
+                "`%s` affinities can not be used to embed points into an "
+                "existing embedding." % CompactSymmetricMatrix.__name__
+            )
+        return _tsne.estimate_positive_gradient_nn_symmetric(
+            P.indices, P.indptr, P.data, embedding, gradient, dof,
+            num_threads=n_jobs, should_eval_error=should_eval_error,
+            exaggeration=exaggeration,
+        )
+
+    return _tsne.estimate_positive_gradient_nn(
+        P.indices, P.indptr, P.data, embedding, reference_embedding, gradient,
+        dof, num_threads=n_jobs, should_eval_error=should_eval_error,
+        exaggeration=exaggeration,
+    )
+
+
+def _gradient_buffer(embedding, gradient=None):
+    # Reuse the buffer provided by the optimizer to avoid allocating a new
+    # array every iteration
+    if gradient is None or gradient.shape != embedding.shape:
+        return np.zeros_like(embedding, dtype=np.float64, order="C")
+    gradient.fill(0)
+    return gradient
+
+
+def _scheduled(value, iteration, n_iter):
+    """Get the value of a parameter that may be given as a schedule."""
+    return value(iteration, n_iter) if callable(value) else value
+
+
+def _tree_params(bh_params, dual_tree=False):
+    """Get the parameters of the space partitioning tree for a tree method.
+
+    The single-tree traversal is fastest with a point in every leaf, while
+    the dual-tree traversal sums over neighboring leaves exactly and needs
+    larger leaves to amortize its interactions between nodes.
+
+    """
+    leaf_size = bh_params.get("leaf_size")
+    if leaf_size is None:
+        leaf_size = 32 if dual_tree else 1
+    return {"leaf_size": leaf_size, "max_depth": bh_params.get("max_tree_depth")}
+
+
+def _reference_tree(reference_embedding, n_jobs=1, leaf_size=1, max_depth=None):
+    """Get the space partitioning tree of a reference embedding.
 
+    The reference embedding does not change while new points are optimized
+    with respect to it, so its tree needs to be built only once. The tree is
+    also cached on reference :class:`TSNEEmbedding` objects, so repeated calls
+    to :meth:`TSNEEmbedding.transform` can reuse it. A cached tree is only
+    reused if the reference embedding has not changed since it was built.
+
+    """
+    reference = np.ascontiguousarray(reference_embedding, dtype=np.float64)
+    tree = getattr(reference_embedding, "_quad_tree", None)
+    if tree is None or tree.leaf_size != leaf_size or tree.max_depth != max_depth \
+            or not tree.is_built_from(reference):
+        with profiling.phase("gradient.bh.quad_tree"):
+            tree = QuadTree(
+                reference, num_threads=n_jobs, leaf_size=leaf_size, max_depth=max_depth
+            )
+        if isinstance(reference_embedding, TSNEEmbedding):
+            reference_embedding._quad_tree = tree
+    return tree
+
+
+def _reference_interval_tree(reference_embedding):
+    """Get the tree of a one dimensional reference embedding, used by the
+    exact method with the Cauchy kernel. Like the trees returned by
+    :func:`_reference_tree`, it is cached on reference :class:`TSNEEmbedding`
+    objects and only reused if the reference embedding has not changed."""
+    reference = np.ascontiguousarray(reference_embedding, dtype=np.float64).ravel()
+    tree = getattr(reference_embedding, "_interval_tree", None)
+    if tree is None or not tree.is_built_from(reference):
+        with profiling.phase("gradient.exact.interval_tree"):
+            tree = _tsne.interval_tree(reference)
+        if isinstance(reference_embedding, TSNEEmbedding):
+            reference_embedding._interval_tree = tree
+    return tree
+
+
+def _negative_gradient_bh(embedding, gradient, dof, bh_params,
+                          reference_embedding=None, n_jobs=1, tree=None,
+                          reference_tree=None, dual_tree=False):
     # In the event that we wish to embed new points into an existing embedding
     # using simple optimization, we compute optimize the new embedding points
     # w.r.t. the existing embedding. Otherwise, we want to optimize the
     # embedding w.r.t. itself. We've also got to make sure that the points'
     # interactions don't interfere with each other
     pairwise_normalization = reference_embedding is None
-    if reference_embedding is None:
-        reference_embedding = embedding
+    tree_params = _tree_params(bh_params, dual_tree=dual_tree)
+    bh_params = dict(bh_params)
+    bh_params.pop("leaf_size", None)
+    bh_params.pop("max_tree_depth", None)
+    # Each traversal has its own accuracy parameter
+    dual_tree_theta = bh_params.pop("dual_tree_theta", None)
+    if dual_tree:
+        bh_params.pop("theta", None)
+        if dual_tree_theta is not None:
+            bh_params["theta"] = dual_tree_theta
+
+    # The dual-tree traversal needs a tree of the optimized points even when
+    # they are repelled by a reference embedding. A tree from a previous
+    # iteration is rebuilt in place to reuse its memory
+    if reference_embedding is None or dual_tree:
+        with profiling.phase("gradient.bh.quad_tree"):
+            if tree is None:
+                tree = QuadTree()
+            tree.build(embedding, num_threads=n_jobs, **tree_params)
+    if reference_embedding is not None and reference_tree is None:
+        reference_tree = _reference_tree(reference_embedding, n_jobs=n_jobs, **tree_params)
 
     # Compute negative gradient
-    tree = QuadTree(reference_embedding)
-    sum_Q = _tsne.estimate_negative_gradient_bh(
-        tree, embedding, gradient, **bh_params, dof=dof, num_threads=n_jobs,
-        pairwise_normalization=pairwise_normalization,
-    )
-    del tree
-
-    # Compute positive gradient
-    sum_P, kl_divergence_ = _tsne.estimate_positive_gradient_nn(
-        P.indices, P.indptr, P.data, embedding, reference_embedding, gradient,
-        dof, num_threads=n_jobs, should_eval_error=should_eval_error,
-    )
-
-    gradient *= 2 * (dof + 1) / dof
-    # Computing positive gradients summed up only unnormalized q_ijs, so we
-    # have to include normalziation term separately
-    if should_eval_error:
-        kl_divergence_ += sum_P * np.log(sum_Q + EPSILON)
+    with profiling.phase("gradient.bh.traversal"):
+        if dual_tree:
+            sum_Q = _tsne.estimate_negative_gradient_bh_dual(
+                tree, embedding, gradient, **bh_params, dof=dof, num_threads=n_jobs,
+                pairwise_normalization=pairwise_normalization,
+                reference_tree=reference_tree if reference_embedding is not None else None,
+            )
+        else:
+            sum_Q = _tsne.estimate_negative_gradient_bh(
+                reference_tree if reference_embedding is not None else tree,
+                embedding, gradient, **bh_params, dof=dof, num_threads=n_jobs,
+                pairwise_normalization=pairwise_normalization,
+            )
 
-    return kl_divergence_, gradient
+    return sum_Q
 
 
-def kl_divergence_fft(embedding, P, dof, fft_params, reference_embedding=None,
-                      should_eval_error=False, n_jobs=1, **_):
-    gradient = np.zeros_like(embedding, dtype=np.float64, order="C")
+def _negative_gradient_fft(embedding, gradient, dof, fft_params,
+                           reference_embedding=None, n_jobs=1):
+    # The kernels time their interpolation and convolution steps themselves
+    timings = {} if profiling.is_enabled() else None
 
-    # Compute negative gradient.
     if embedding.ndim == 1 or embedding.shape[1] == 1:
         if reference_embedding is not None:
             sum_Q = _tsne.estimate_negative_gradient_fft_1d_with_reference(
                 embedding.ravel(), reference_embedding.ravel(), gradient.ravel(),
-                **fft_params,
+                **fft_params, timings=timings,
             )
         else:
             sum_Q = _tsne.estimate_negative_gradient_fft_1d(
-                embedding.ravel(), gradient.ravel(), **fft_params,
+                embedding.ravel(), gradient.ravel(), **fft_params, timings=timings,
             )
     elif embedding.shape[1] == 2:
         if reference_embedding is not None:
             sum_Q = _tsne.estimate_negative_gradient_fft_2d_with_reference(
                 embedding, reference_embedding, gradient, **fft_params,
+                timings=timings,
             )
         else:
             sum_Q = _tsne.estimate_negative_gradient_fft_2d(
-                embedding, gradient, **fft_params,
+                embedding, gradient, **fft_params, timings=timings,
             )
     else:
         raise RuntimeError(
@@ -1157,40 +2324,309 @@ def kl_divergence_fft(embedding, P, dof, fft_params, reference_embedding=None,
             "unsupported (and generally a bad idea)"
         )
 
-    # The positive gradient function needs a reference embedding always
+    if timings is not None:
+        for step, duration in timings.items():
+            profiling.record("gradient.fft." + step, duration)
+
+    return sum_Q
+
+
+def _negative_gradient_sampled(embedding, gradient, P, dof, sampling_params,
+                               reference_embedding=None, n_jobs=1):
+    pairwise_normalization = reference_embedding is None
+    if reference_embedding is None:
+        reference_embedding = embedding
+
+    # The repulsive forces of the nearest neighbors are computed exactly,
+    # which requires each of them to be listed in its row of P. Compact
+    # matrices only store half of the edges, so we fall back to sampling
+    if isinstance(P, CompactSymmetricMatrix):
+        indices = indptr = np.empty(0, dtype=np.int32)
+    else:
+        # P may be shared or read-only, so it is never sorted in place. The
+        # optimizer passes in a sorted copy, so this only copies P when the
+        # gradient is computed directly
+        if not P.has_sorted_indices:
+            P = P.sorted_indices()
+        indices, indptr = P.indices, P.indptr
+
+    # Draw a fresh seed every iteration, so the samples change between
+    # iterations and their errors average out over the optimization
+    random_state = sampling_params["random_state"]
+    seed = random_state.randint(np.iinfo(np.int64).max)
+
+    if embedding.ndim == 1:
+        embedding = embedding.reshape(-1, 1)
+        reference_embedding = reference_embedding.reshape(-1, 1)
+        gradient = gradient.reshape(-1, 1)
+
+    with profiling.phase("gradient.sampling"):
+        return _tsne.estimate_negative_gradient_sampled(
+            indices, indptr, embedding, reference_embedding, gradient,
+            n_negative_samples=sampling_params["n_negative_samples"],
+            batch_size=sampling_params["batch_size"],
+            seed=seed, dof=dof, num_threads=n_jobs,
+            pairwise_normalization=pairwise_normalization,
+        )
+
+
+def _negative_gradient_exact(embedding, gradient, dof, reference_embedding=None,
+                             n_jobs=1, reference_tree=None, thread_gradient=None):
+    pairwise_normalization = reference_embedding is None
     if reference_embedding is None:
         reference_embedding = embedding
 
-    # Compute positive gradient
-    sum_P, kl_divergence_ = _tsne.estimate_positive_gradient_nn(
-        P.indices, P.indptr, P.data, embedding, reference_embedding, gradient,
-        dof, num_threads=n_jobs, should_eval_error=should_eval_error,
-    )
+    # The forces within one dimensional embeddings with the Cauchy kernel are
+    # computed with series expansions, accurate to a relative error of about
+    # 1e-12, instead of summing over all pairs of points. The tree of a
+    # reference embedding is built only once
+    if (embedding.ndim == 1 or embedding.shape[1] == 1) and dof == 1:
+        if not pairwise_normalization and reference_tree is None:
+            reference_tree = _reference_interval_tree(reference_embedding)
+        with profiling.phase("gradient.exact"):
+            return _tsne.estimate_negative_gradient_exact_1d(
+                embedding.ravel(), reference_embedding.ravel(), gradient.ravel(),
+                num_threads=n_jobs, pairwise_normalization=pairwise_normalization,
+                reference_tree=None if pairwise_normalization else reference_tree,
+            )
+
+    if embedding.ndim == 1:
+        embedding = embedding.reshape(-1, 1)
+        reference_embedding = reference_embedding.reshape(-1, 1)
+        gradient = gradient.reshape(-1, 1)
+
+    with profiling.phase("gradient.exact"):
+        return _tsne.estimate_negative_gradient_exact(
+            embedding, reference_embedding, gradient, dof=dof, num_threads=n_jobs,
+            pairwise_normalization=pairwise_normalization,
+            thread_gradient=thread_gradient,
+        )
+
+
+def _kl_divergence(negative_gradient, embedding, P, dof, reference_embedding,
+                   should_eval_error, n_jobs, gradient, exaggeration,
+                   batch_points=None):
+    gradient = _gradient_buffer(embedding, gradient)
+
+    # A batch of embeddings of the same affinities. The attractive forces are
+    # computed in a single pass over P, but the repulsive forces depend on
+    # the tree or interpolation grid of each embedding, so they are computed
+    # with a separate kernel call for each of them
+    if embedding.ndim == 3:
+        if reference_embedding is not None:
+            raise ValueError(
+                "Batched embeddings can not be optimized w.r.t. a reference "
+                "embedding."
+            )
+        if isinstance(P, CompactSymmetricMatrix):
+            raise ValueError(
+                "Batched embeddings do not support `%s` affinities."
+                % CompactSymmetricMatrix.__name__
+            )
+        sum_Q = np.array([
+            negative_gradient(embedding[i], gradient[i], n_jobs=n_jobs)
+            for i in range(embedding.shape[0])
+        ])
+        with profiling.phase("gradient.positive"):
+            sum_P, kl_divergence_ = _tsne.estimate_positive_gradient_nn_batched(
+                P.indices, P.indptr, P.data, embedding, gradient, dof,
+                num_threads=n_jobs, should_eval_error=should_eval_error,
+                exaggeration=exaggeration, points=batch_points,
+            )
+
+    else:
+        sum_Q = negative_gradient(
+            embedding, gradient, reference_embedding=reference_embedding,
+            n_jobs=n_jobs,
+        )
+
+        # The positive gradient function needs a reference embedding always
+        if reference_embedding is None:
+            reference_embedding = embedding
+
+        with profiling.phase("gradient.positive"):
+            sum_P, kl_divergence_ = _estimate_positive_gradient(
+                P, embedding, reference_embedding, gradient, dof,
+                exaggeration=exaggeration, n_jobs=n_jobs,
+                should_eval_error=should_eval_error,
+            )
 
     gradient *= 2 * (dof + 1) / dof
+    # Computing positive gradients summed up only unnormalized q_ijs, so we
+    # have to include normalziation term separately
     if should_eval_error:
         kl_divergence_ += sum_P * np.log(sum_Q + EPSILON)
 
     return kl_divergence_, gradient
 
 
-class gradient_descent:
+def kl_divergence_bh(embedding, P, dof, bh_params, reference_embedding=None,
+                     should_eval_error=False, n_jobs=1, gradient=None,
+                     exaggeration=1, tree=None, reference_tree=None,
+                     batch_points=None, **_):
+    negative_gradient = partial(
+        _negative_gradient_bh, dof=dof, bh_params=bh_params, tree=tree,
+        reference_tree=reference_tree,
+    )
+    return _kl_divergence(
+        negative_gradient, embedding, P, dof, reference_embedding,
+        should_eval_error, n_jobs, gradient, exaggeration, batch_points,
+    )
+
+
+def kl_divergence_bh_dual(embedding, P, dof, bh_params, reference_embedding=None,
+                          should_eval_error=False, n_jobs=1, gradient=None,
+                          exaggeration=1, tree=None, reference_tree=None,
+                          batch_points=None, **_):
+    negative_gradient = partial(
+        _negative_gradient_bh, dof=dof, bh_params=bh_params, tree=tree,
+        reference_tree=reference_tree, dual_tree=True,
+    )
+    return _kl_divergence(
+        negative_gradient, embedding, P, dof, reference_embedding,
+        should_eval_error, n_jobs, gradient, exaggeration, batch_points,
+    )
+
+
+def kl_divergence_fft(embedding, P, dof, fft_params, reference_embedding=None,
+                      should_eval_error=False, n_jobs=1, gradient=None,
+                      exaggeration=1, batch_points=None, **_):
+    negative_gradient = partial(_negative_gradient_fft, dof=dof, fft_params=fft_params)
+    return _kl_divergence(
+        negative_gradient, embedding, P, dof, reference_embedding,
+        should_eval_error, n_jobs, gradient, exaggeration, batch_points,
+    )
+
+
+def kl_divergence_sampled(embedding, P, dof, sampling_params,
+                          reference_embedding=None, should_eval_error=False,
+                          n_jobs=1, gradient=None, exaggeration=1,
+                          batch_points=None, **_):
+    negative_gradient = partial(
+        _negative_gradient_sampled, P=P, dof=dof, sampling_params=sampling_params
+    )
+    return _kl_divergence(
+        negative_gradient, embedding, P, dof, reference_embedding,
+        should_eval_error, n_jobs, gradient, exaggeration, batch_points,
+    )
+
+
+def kl_divergence_all_pairs(embedding, P, dof, reference_embedding=None,
+                            should_eval_error=False, n_jobs=1, gradient=None,
+                            exaggeration=1, reference_tree=None,
+                            thread_gradient=None, batch_points=None, **_):
+    negative_gradient = partial(
+        _negative_gradient_exact, dof=dof, reference_tree=reference_tree,
+        thread_gradient=thread_gradient,
+    )
+    return _kl_divergence(
+        negative_gradient, embedding, P, dof, reference_embedding,
+        should_eval_error, n_jobs, gradient, exaggeration, batch_points,
+    )
+
+
+class Optimizer:
+    """Base class for the optimizers minimizing the t-SNE objective.
+
+    Optimizers keep their per-point state, e.g. the gains or moment estimates,
+    between calls, so optimization can be continued where it left off. The
+    optimization loop, error evaluation and callbacks are shared; subclasses
+    list the names of their per-point state arrays in ``_state`` and implement
+    :meth:`_step`, which moves the points given the current gradient.
+
+    Attributes
+    ----------
+    progress: Optional[dict]
+        The progress of the current or last call, containing the number of
+        completed ``iteration`` out of ``n_iter`` and the ``learning_rate``,
+        ``momentum`` and ``exaggeration`` it was called with. An interrupted
+        call can be continued by calling the optimizer again with the same
+        ``n_iter`` and ``resume=True``. The ``random_state`` entry holds the
+        state of the random number generator at the start of the next
+        iteration, so the continued call draws the same random numbers as if
+        it had never been interrupted.
+
+    phases: List[dict]
+        The optimization calls to run after the current one, given as the
+        parameters of :meth:`TSNEEmbedding.optimize`, e.g. the standard phase
+        of :meth:`TSNE.fit` while in early exaggeration. They are run by
+        :meth:`TSNEEmbedding.resume` once the current call is completed.
+
+    """
+
+    # Names of the attributes holding per-point optimizer state
+    _state = ()
+
     def __init__(self):
-        self.gains = None
+        for name in self._state:
+            setattr(self, name, None)
+        self.progress = None
+        self.phases = []
+        # Scratch buffers reused between iterations and calls
+        self._buffers = {}
+
+    def _buffer(self, name, shape):
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.shape != shape:
+            buffer = np.zeros(shape, dtype=np.float64)
+            self._buffers[name] = buffer
+        return buffer
 
     def copy(self):
-        optimizer = self.__class__()
-        if self.gains is not None:
-            optimizer.gains = np.copy(self.gains)
+        optimizer = copy.copy(self)
+        for name in self._state:
+            value = getattr(self, name)
+            if value is not None:
+                setattr(optimizer, name, np.copy(value))
+        if self.progress is not None:
+            optimizer.progress = dict(self.progress)
+        optimizer.phases = [dict(phase) for phase in self.phases]
+        optimizer._buffers = {}
+        return optimizer
+
+    def permute(self, permutation):
+        """Get a copy of the optimizer with the per-point state reordered.
+
+        Parameters
+        ----------
+        permutation: np.ndarray
+            The new position ``i`` holds the point ``permutation[i]``.
+
+        Returns
+        -------
+        Optimizer
+
+        """
+        optimizer = self.copy()
+        for name in self._state:
+            value = getattr(optimizer, name)
+            if value is not None:
+                setattr(optimizer, name, value[permutation])
         return optimizer
 
+    def _reset(self, embedding, resume=False):
+        """Prepare the optimizer state before the first iteration of a call.
+        When resuming an interrupted call, the state should be kept as is."""
+
+    def _step(self, embedding, gradient, learning_rate, momentum, min_gain,
+              max_grad_norm, should_center, n_jobs):
+        """Update the embedding in place and return the gradient norm."""
+
     def __call__(self, embedding, P, n_iter, objective_function, learning_rate=200,
                  momentum=0.5, exaggeration=None, dof=1, min_gain=0.01,
                  min_grad_norm=1e-8, max_grad_norm=None, theta=0.5,
-                 n_interpolation_points=3, min_num_intervals=10, ints_in_interval=1,
-                 reference_embedding=None, n_jobs=1,
-                 use_callbacks=False, callbacks=None, callbacks_every_iters=50):
-        """Perform batch gradient descent with momentum and gains.
+                 dual_tree_theta=0.5, leaf_size=None, max_tree_depth=None,
+                 n_interpolation_points=3,
+                 min_num_intervals=10, ints_in_interval=1,
+                 n_negative_samples=5, negative_sampling_batch_size=1,
+                 random_state=None, reference_embedding=None, n_jobs=1,
+                 use_callbacks=False, callbacks=None, callbacks_every_iters=50,
+                 stopping_rule=None, stopping_rule_every_iters=10, resume=False,
+                 step_callback=None):
+        """Run the optimization.
+
+        Not every optimizer makes use of all the parameters, e.g. ones
+        with their own step size ignore ``learning_rate`` and ``momentum``.
 
         Parameters
         ----------
@@ -1225,7 +2661,8 @@ class gradient_descent:
             Degrees of freedom of the Student's t-distribution.
 
         min_gain: float
-            Minimum individual gain for each parameter.
+            Minimum individual gain for each parameter. Only used by optimizers
+            with gains.
 
         min_grad_norm: float
             If the gradient norm is below this threshold, the optimization will
@@ -1239,11 +2676,31 @@ class gradient_descent:
             the embedding, causing the interpolation method to compute a very
             large grid, and leads to worse results.
 
-        theta: float
+        theta: Union[float, Callable[[int, int], float]]
             This is the trade-off parameter between speed and accuracy of the
             tree approximation method. Typical values range from 0.2 to 0.8. The
             value 0 indicates that no approximation is to be made and produces
-            exact results also producing longer runtime.
+            exact results also producing longer runtime. May also be a schedule,
+            e.g. from :mod:`openTSNE.schedules`, which is given the iteration
+            and the number of iterations and returns the value to use.
+
+        dual_tree_theta: Union[float, Callable[[int, int], float]]
+            The trade-off parameter between speed and accuracy of the dual-tree
+            approximation. Two nodes of the tree interact as a whole when the
+            sum of their radii is smaller than ``dual_tree_theta`` times the
+            distance between them. May also be a schedule, e.g. from
+            :mod:`openTSNE.schedules`, which is given the iteration and the
+            number of iterations and returns the value to use.
+
+        leaf_size: Optional[int]
+            The maximum number of points in a leaf of the space-partitioning
+            tree. Larger leaves make for smaller trees that are faster to build,
+            but leave more interactions to be summed over exactly. By default,
+            1 for ``"bh"`` and 32 for ``"bh-dual"``.
+
+        max_tree_depth: Optional[int]
+            The maximum depth of the space-partitioning tree. By default, the
+            depth is limited only by the precision of the tree's point ordering.
 
         n_interpolation_points: int
             Only used when ``negative_gradient_method="fft"`` or its other
@@ -1263,6 +2720,19 @@ class gradient_descent:
             indicates a grid side length of 3. Lower values provide more
             accurate gradient estimations.
 
+        n_negative_samples: int
+            Only used when ``negative_gradient_method="sampling"``. The number
+            of points sampled to estimate the repulsive forces acting on each
+            point.
+
+        negative_sampling_batch_size: int
+            Only used when ``negative_gradient_method="sampling"``. The number
+            of consecutive points sharing the same negative samples.
+
+        random_state: Union[int, RandomState]
+            The random state used to draw the negative samples when
+            ``negative_gradient_method="sampling"``.
+
         reference_embedding: np.ndarray
             If we are adding points to an existing embedding, we have to compute
             the gradients and errors w.r.t. the existing embedding.
@@ -1282,6 +2752,29 @@ class gradient_descent:
             How many iterations should pass between each time the callbacks are
             invoked.
 
+        stopping_rule: Callable[[int, float, np.ndarray] -> bool]
+            Optionally, a stopping rule e.g. from :mod:`openTSNE.stopping`,
+            which is given the KL divergence every ``stopping_rule_every_iters``
+            iterations. If it returns ``True``, the optimization has converged
+            and is ended early. Unlike callbacks, this does not raise an
+            :class:`OptimizationInterrupt`.
+
+        stopping_rule_every_iters: int
+            How many iterations should pass between each time the stopping rule
+            is checked.
+
+        resume: bool
+            Continue an interrupted call from the iteration recorded in
+            :attr:`progress` instead of starting from scratch, keeping the
+            momentum.
+
+        step_callback: Callable[[int, np.ndarray] -> bool]
+            Optionally, a function called after every update with the number of
+            completed iterations and the embedding. Unlike callbacks, this does
+            not evaluate the error, so it is cheap enough to run every
+            iteration. If it returns ``True``, the optimization is interrupted
+            with an :class:`OptimizationInterrupt` and may later be resumed.
+
         Returns
         -------
         float
@@ -1304,81 +2797,193 @@ class gradient_descent:
                 "`reference_embedding` must be an instance of `np.ndarray`. Got " \
                 "`%s` instead" % type(reference_embedding)
 
-        update = np.zeros_like(embedding)
-        if self.gains is None:
-            self.gains = np.ones_like(embedding)
+        start_iter = 0
+        if resume and self.progress is not None and self.progress["n_iter"] == n_iter:
+            start_iter = self.progress["iteration"]
+        # A continued call draws the random numbers an uninterrupted one would
+        if start_iter > 0 and self.progress.get("random_state") is not None:
+            random_state = np.random.RandomState()
+            random_state.set_state(self.progress["random_state"])
+        else:
+            random_state = check_random_state(random_state)
+        self._reset(embedding, resume=start_iter > 0)
+        self.progress = {
+            "iteration": start_iter,
+            "n_iter": n_iter,
+            "learning_rate": learning_rate,
+            "momentum": momentum,
+            "exaggeration": exaggeration,
+            "random_state": random_state.get_state(),
+        }
+
+        # Built-in objectives write the gradient into a buffer we provide
+        objective_params = {}
+        if _accepts_parameter(objective_function, "gradient"):
+            objective_params["gradient"] = self._buffer("gradient", embedding.shape)
+        # Batches of embeddings keep the points of all the embeddings together
+        if embedding.ndim == 3 and _accepts_parameter(objective_function, "batch_points"):
+            n_batch, n_samples, n_dims = embedding.shape
+            objective_params["batch_points"] = self._buffer(
+                "batch_points", (n_samples, n_batch, n_dims)
+            )
+        if _accepts_parameter(objective_function, "tree"):
+            if "tree" not in self._buffers:
+                self._buffers["tree"] = QuadTree()
+            objective_params["tree"] = self._buffers["tree"]
+        # Either accuracy parameter may be a schedule, which is evaluated
+        # anew every iteration
+        dual_tree = objective_function is kl_divergence_bh_dual
+        theta_schedule = dual_tree_theta if dual_tree else theta
+        bh_params = {"theta": _scheduled(theta, start_iter, n_iter),
+                     "dual_tree_theta": _scheduled(dual_tree_theta, start_iter, n_iter),
+                     "leaf_size": leaf_size, "max_tree_depth": max_tree_depth}
+        # The reference embedding stays fixed, so its tree is built only once.
+        # The exact method only needs one for one dimensional embeddings with
+        # the Cauchy kernel
+        if objective_function is kl_divergence_all_pairs:
+            n_dims = 1 if embedding.ndim == 1 else embedding.shape[-1]
+            if reference_embedding is not None and n_dims == 1 and dof == 1:
+                objective_params["reference_tree"] = _reference_interval_tree(
+                    reference_embedding
+                )
+            # The threads accumulate the forces between all pairs of points
+            # in separate buffers, which are kept between iterations
+            elif reference_embedding is None and (n_dims > 1 or dof != 1):
+                n_samples = embedding.shape[-2] if embedding.ndim > 1 else embedding.shape[0]
+                objective_params["thread_gradient"] = self._buffer(
+                    "thread_gradient", (max(n_jobs, 1), n_samples, n_dims)
+                )
+        elif reference_embedding is not None and \
+                _accepts_parameter(objective_function, "reference_tree"):
+            objective_params["reference_tree"] = _reference_tree(
+                reference_embedding, n_jobs=n_jobs,
+                **_tree_params(bh_params, dual_tree=dual_tree),
+            )
 
-        bh_params = {"theta": theta}
         fft_params = {"n_interpolation_points": n_interpolation_points,
                       "min_num_intervals": min_num_intervals,
                       "ints_in_interval": ints_in_interval}
-
-        # Lie about the P values for bigger attraction forces
+        if _accepts_parameter(objective_function, "sampling_params"):
+            objective_params["sampling_params"] = {
+                "n_negative_samples": n_negative_samples,
+                "batch_size": negative_sampling_batch_size,
+                "random_state": random_state,
+            }
+
+        # Lie about the P values for bigger attraction forces. Built-in
+        # objectives scale the attractive forces directly, so `P` is never
+        # modified and can be safely shared. Other objectives get an
+        # exaggerated copy of `P` and their error is corrected afterwards
         if exaggeration is None:
             exaggeration = 1
 
-        if exaggeration != 1:
-            P *= exaggeration
+        exaggerated_P, correct_error = P, False
+        if _accepts_parameter(objective_function, "exaggeration"):
+            objective_params["exaggeration"] = exaggeration
+        elif exaggeration != 1:
+            exaggerated_P, correct_error = P * exaggeration, True
+
+        # Negative sampling needs the neighbors in every row of P sorted. A
+        # sorted copy is made once, instead of sorting the shared P in place
+        if objective_function is kl_divergence_sampled and sp.issparse(exaggerated_P) \
+                and not exaggerated_P.has_sorted_indices:
+            exaggerated_P = exaggerated_P.sorted_indices()
 
         # Notify the callbacks that the optimization is about to start
         if isinstance(callbacks, Iterable):
             for callback in callbacks:
                 # Only call function if present on object
                 getattr(callback, "optimization_about_to_start", lambda: ...)()
+        if stopping_rule is not None:
+            getattr(stopping_rule, "optimization_about_to_start", lambda: ...)()
 
-        for iteration in range(n_iter):
+        for iteration in range(start_iter, n_iter):
             should_call_callback = use_callbacks and (iteration + 1) % callbacks_every_iters == 0
-            should_eval_error = should_call_callback
-
-            error, gradient = objective_function(
-                embedding, P, dof=dof, bh_params=bh_params, fft_params=fft_params,
-                reference_embedding=reference_embedding, n_jobs=n_jobs,
-                should_eval_error=should_eval_error,
-            )
-
-            # Clip gradients to avoid points shooting off. This can be an issue
-            # when applying transform and points are initialized so that the new
-            # points overlap with the reference points, leading to large
-            # gradients
-            if max_grad_norm is not None:
-                norm = np.linalg.norm(gradient, axis=1)
-                coeff = max_grad_norm / (norm + 1e-6)
-                mask = coeff < 1
-                gradient[mask] *= coeff[mask, None]
+            should_check_stop = stopping_rule is not None and \
+                iteration % stopping_rule_every_iters == 0
+            should_eval_error = should_call_callback or should_check_stop
+
+            bh_params["theta"] = _scheduled(theta, iteration, n_iter)
+            bh_params["dual_tree_theta"] = _scheduled(dual_tree_theta, iteration, n_iter)
+
+            with profiling.phase("gradient"):
+                error, gradient = objective_function(
+                    embedding, exaggerated_P, dof=dof, bh_params=bh_params,
+                    fft_params=fft_params, reference_embedding=reference_embedding,
+                    n_jobs=n_jobs, should_eval_error=should_eval_error,
+                    **objective_params,
+                )
 
             # Correct the KL divergence w.r.t. the exaggeration if needed
-            if should_eval_error and exaggeration != 1:
+            if should_eval_error and correct_error:
                 error = error / exaggeration - np.log(exaggeration)
 
             if should_call_callback:
                 # Continue only if all the callbacks say so
-                should_stop = any((bool(c(iteration + 1, error, embedding)) for c in callbacks))
+                with profiling.phase("callbacks"):
+                    should_stop = any((bool(c(iteration + 1, error, embedding)) for c in callbacks))
                 if should_stop:
-                    # Make sure to un-exaggerate P so it's not corrupted in future runs
-                    if exaggeration != 1:
-                        P /= exaggeration
                     raise OptimizationInterrupt(error=error, final_embedding=embedding)
 
-            # Update the embedding using the gradient
-            grad_direction_flipped = np.sign(update) != np.sign(gradient)
-            grad_direction_same = np.invert(grad_direction_flipped)
-            self.gains[grad_direction_flipped] += 0.2
-            self.gains[grad_direction_same] = self.gains[grad_direction_same] * 0.8 + min_gain
-            update = momentum * update - learning_rate * self.gains * gradient
-            embedding += update
+            # Adaptive schedules measure the approximation error on the tree
+            # the gradient was just computed with. This only changes the value
+            # for the next iteration, so it is done after the callbacks, which
+            # may interrupt the optimization and have this iteration repeated
+            if hasattr(theta_schedule, "adapt") and \
+                    objective_function in (kl_divergence_bh, kl_divergence_bh_dual):
+                if reference_embedding is None:
+                    tree, points = objective_params.get("tree"), embedding
+                else:
+                    tree, points = objective_params.get("reference_tree"), reference_embedding
+                if tree is not None:
+                    with profiling.phase("gradient.bh.adapt_theta"):
+                        theta_schedule.adapt(
+                            iteration, tree, points, dof=dof, dual_tree=dual_tree,
+                            n_jobs=n_jobs,
+                        )
+
+            # The error is computed before updating, so it corresponds to the
+            # embedding after `iteration` updates
+            if should_check_stop and stopping_rule(iteration, error, embedding):
+                log.info("Optimization converged after %d iterations." % iteration)
+                break
 
+            # Update the embedding using the gradient. Gradients are clipped to
+            # avoid points shooting off. This can be an issue when applying
+            # transform and points are initialized so that the new points
+            # overlap with the reference points, leading to large gradients.
             # Zero-mean the embedding only if we're not adding new data points,
             # otherwise this will reset point positions
-            if reference_embedding is None:
-                embedding -= np.mean(embedding, axis=0)
+            with profiling.phase("update"):
+                grad_norm = self._step(
+                    embedding,
+                    np.ascontiguousarray(gradient, dtype=np.float64),
+                    learning_rate=learning_rate,
+                    momentum=momentum,
+                    min_gain=min_gain,
+                    max_grad_norm=np.inf if max_grad_norm is None else max_grad_norm,
+                    should_center=reference_embedding is None,
+                    n_jobs=n_jobs,
+                )
+
+            self.progress["iteration"] = iteration + 1
+            self.progress["random_state"] = random_state.get_state()
+
+            if step_callback is not None and step_callback(iteration + 1, embedding):
+                error, _ = objective_function(
+                    embedding, P, dof=dof, bh_params=bh_params, fft_params=fft_params,
+                    reference_embedding=reference_embedding, n_jobs=n_jobs,
+                    should_eval_error=True, **objective_params,
+                )
+                raise OptimizationInterrupt(error=error, final_embedding=embedding)
 
-            if np.linalg.norm(gradient) < min_grad_norm:
+            if grad_norm < min_grad_norm:
                 log.info("Gradient norm eps reached. Finished.")
                 break
 
-        # Make sure to un-exaggerate P so it's not corrupted in future runs
-        if exaggeration != 1:
-            P /= exaggeration
+        # Stopping early means the optimization has converged, so there is
+        # nothing left to resume
+        self.progress["iteration"] = n_iter
 
         # The error from the loop is the one for the previous, non-updated
         # embedding. We need to return the error for the actual final embedding, so
@@ -1386,7 +2991,215 @@ class gradient_descent:
         error, _ = objective_function(
             embedding, P, dof=dof, bh_params=bh_params, fft_params=fft_params,
             reference_embedding=reference_embedding, n_jobs=n_jobs,
-            should_eval_error=True,
+            should_eval_error=True, **objective_params,
         )
 
         return error, embedding
+
+
+class gradient_descent(Optimizer):
+    """Batch gradient descent with momentum and gains."""
+
+    _state = ("gains", "update")
+
+    def _reset(self, embedding, resume=False):
+        # The momentum is reset on every call, but the gains are kept
+        if self.update is None or self.update.shape != embedding.shape:
+            self.update = np.zeros_like(embedding)
+        elif not resume:
+            self.update.fill(0)
+        if self.gains is None:
+            self.gains = np.ones_like(embedding)
+
+    def _step(self, embedding, gradient, learning_rate, momentum, min_gain,
+              max_grad_norm, should_center, n_jobs):
+        return _tsne.update_embedding(
+            embedding,
+            gradient,
+            self.update,
+            self.gains,
+            learning_rate=learning_rate,
+            momentum=momentum,
+            min_gain=min_gain,
+            max_grad_norm=max_grad_norm,
+            should_center=should_center,
+            num_threads=n_jobs,
+        )
+
+
+class adaptive_momentum(gradient_descent):
+    """Gradient descent with gains and an automatic momentum schedule.
+
+    Instead of using a fixed momentum, the momentum grows as :math:`1 - 3 /
+    (k + 5)` over the iterations :math:`k` since the last restart, up to
+    ``max_momentum``. Whenever the gradient points against the previous
+    update, i.e. the last step overshot, the schedule is restarted [1]_. This
+    allows much higher momentum than the fixed schedule and often reaches
+    the same error in considerably fewer iterations. The ``momentum`` passed
+    to the optimizer is ignored.
+
+    Parameters
+    ----------
+    max_momentum: float
+        The upper bound for the momentum.
+
+    References
+    ----------
+    .. [1] O’Donoghue, Brendan, and Emmanuel Candes. "Adaptive restart for
+       accelerated gradient schemes." Foundations of computational mathematics
+       15.3 (2015): 715-732.
+
+    """
+
+    def __init__(self, max_momentum=0.95):
+        super().__init__()
+        self.max_momentum = max_momentum
+
+    def _reset(self, embedding, resume=False):
+        super()._reset(embedding, resume)
+        if not resume:
+            self.n_restart_iter = 0
+
+    def _step(self, embedding, gradient, learning_rate, momentum, min_gain,
+              max_grad_norm, should_center, n_jobs):
+        if np.vdot(gradient, self.update) > 0:
+            self.n_restart_iter = 0
+        momentum = min(self.max_momentum, 1 - 3 / (self.n_restart_iter + 5))
+        self.n_restart_iter += 1
+
+        return super()._step(
+            embedding, gradient, learning_rate, momentum, min_gain,
+            max_grad_norm, should_center, n_jobs,
+        )
+
+
+class adam(Optimizer):
+    """The Adam optimizer [1]_.
+
+    Adam normalizes the step for every coordinate by a running estimate of
+    the gradient magnitude, so its steps are measured in embedding units and
+    are not comparable with the learning rates used for gradient descent. The
+    ``learning_rate`` and ``momentum`` passed to the optimizer are therefore
+    ignored in favour of the parameters given here. The moment estimates are
+    kept between calls.
+
+    Parameters
+    ----------
+    learning_rate: float
+        The step size.
+
+    beta1: float
+        The decay rate of the first moment estimate.
+
+    beta2: float
+        The decay rate of the second moment estimate.
+
+    epsilon: float
+        Added to the denominator for numerical stability.
+
+    References
+    ----------
+    .. [1] Kingma, Diederik P., and Jimmy Ba. "Adam: A method for stochastic
+       optimization." arXiv preprint arXiv:1412.6980 (2014).
+
+    """
+
+    _state = ("first_moment", "second_moment")
+
+    def __init__(self, learning_rate=1, beta1=0.9, beta2=0.999, epsilon=1e-8):
+        super().__init__()
+        self.learning_rate = learning_rate
+        self.beta1 = beta1
+        self.beta2 = beta2
+        self.epsilon = epsilon
+        self.n_steps = 0
+
+    def _reset(self, embedding, resume=False):
+        if self.first_moment is None:
+            self.first_moment = np.zeros_like(embedding)
+            self.second_moment = np.zeros_like(embedding)
+            self.n_steps = 0
+
+    def _step(self, embedding, gradient, learning_rate, momentum, min_gain,
+              max_grad_norm, should_center, n_jobs):
+        self.n_steps += 1
+        return _tsne.update_embedding_adam(
+            embedding,
+            gradient,
+            self.first_moment,
+            self.second_moment,
+            learning_rate=self.learning_rate,
+            beta1=self.beta1,
+            beta2=self.beta2,
+            epsilon=self.epsilon,
+            step=self.n_steps,
+            max_grad_norm=max_grad_norm,
+            should_center=should_center,
+            num_threads=n_jobs,
+        )
+
+
+class _BatchOptimizer(Optimizer):
+    """Optimize a batch of embeddings, where every embedding has its own
+    optimizer. The learning rate and momentum may be given for every embedding
+    separately."""
+
+    def __init__(self, optimizers):
+        super().__init__()
+        self.optimizers = optimizers
+
+    def copy(self):
+        optimizer = super().copy()
+        optimizer.optimizers = [o.copy() for o in self.optimizers]
+        return optimizer
+
+    def permute(self, permutation):
+        optimizer = super().permute(permutation)
+        optimizer.optimizers = [o.permute(permutation) for o in self.optimizers]
+        return optimizer
+
+    def _reset(self, embedding, resume=False):
+        for optimizer, member in zip(self.optimizers, np.asarray(embedding)):
+            optimizer._reset(member, resume)
+
+    def _step(self, embedding, gradient, learning_rate, momentum, **step_params):
+        n_embeddings = len(self.optimizers)
+        learning_rate = np.broadcast_to(learning_rate, (n_embeddings,))
+        momentum = np.broadcast_to(momentum, (n_embeddings,))
+
+        embedding = np.asarray(embedding)
+        grad_norms = [
+            optimizer._step(
+                embedding[i], gradient[i], learning_rate=learning_rate[i],
+                momentum=momentum[i], **step_params,
+            )
+            for i, optimizer in enumerate(self.optimizers)
+        ]
+        # Stop only once all the embeddings have converged
+        return max(grad_norms)
+
+
+OPTIMIZERS = {
+    "gradient_descent": gradient_descent,
+    "adaptive_momentum": adaptive_momentum,
+    "adam": adam,
+}
+
+
+def _check_optimizer(optimizer):
+    if optimizer is None:
+        return gradient_descent()
+
+    if isinstance(optimizer, str):
+        if optimizer not in OPTIMIZERS:
+            raise ValueError(
+                "Unrecognized optimizer `%s`. Please choose one of %s."
+                % (optimizer, ", ".join("`%s`" % o for o in OPTIMIZERS))
+            )
+        return OPTIMIZERS[optimizer]()
+
+    if not isinstance(optimizer, Optimizer):
+        raise TypeError("`optimizer` must be an instance of `%s`, but got `%s`." % (
+            Optimizer.__name__, type(optimizer)))
+
+    return optimizer
@@ -1,14 +1,14 @@
-from openTSNE.quad_tree cimport QuadTree, Node
+from openTSNE.quad_tree cimport QuadTree
 import numpy as np
 
 
 def print_tree(QuadTree tree):
-    _print_tree(&tree.root)
+    _print_tree(tree, 0)
 
 
-cdef _print_tree(Node * node, name=None, indent=0):
+cdef _print_tree(QuadTree tree, Py_ssize_t node, name=None, indent=0):
     """Print the quad tree in a readable textual format."""
-    if not node.num_points:
+    if not tree.num_points[node]:
         return
 
     directions = {0: 'SW', 1: 'NW', 2: 'SE', 3: 'NE'}
@@ -16,14 +16,14 @@ cdef _print_tree(Node * node, name=None, indent=0):
     # Print the correct indentation
     print('\t' * indent + '%s: %s (%d) %s' % (
         'Root' if name is None else name,
-        ['', '[+]'][not node.is_leaf],
-        node.num_points,
-        _str_point(<double [:node.n_dims]>node.center_of_mass),
+        ['', '[+]'][tree.first_child[node] >= 0],
+        tree.num_points[node],
+        _str_point(tree.center_of_mass[node]),
     ))
 
-    if not node.is_leaf:
-        for sector in range(1 << node.n_dims):
-            _print_tree(&node.children[sector], directions[sector], indent + 1)
+    if tree.first_child[node] >= 0:
+        for sector in range(1 << tree.n_dims):
+            _print_tree(tree, tree.first_child[node] + sector, directions[sector], indent + 1)
 
 
 def _str_point(double[:] point):
@@ -34,10 +34,10 @@ def plot_tree(QuadTree tree, data):
     assert isinstance(data, np.ndarray), '`data` must be np.ndarray'
     if not data.dtype == np.float64:
         data = data.astype(np.float64)
-    _plot_tree(&tree.root, data)
+    _plot_tree(tree, data)
 
 
-cdef _plot_tree(Node * root, double[:, :] data):
+cdef _plot_tree(QuadTree tree, double[:, :] data):
     import matplotlib.pyplot as plt
 
     fig = plt.figure(figsize=(8, 8))
@@ -46,7 +46,7 @@ cdef _plot_tree(Node * root, double[:, :] data):
 
     centers = []
 
-    _add_patch(ax, root, centers)
+    _add_patch(ax, tree, 0, centers)
     centers = list(zip(*centers))
     xs = [p[0] for p in data]
     ys = [p[1] for p in data]
@@ -58,15 +58,15 @@ cdef _plot_tree(Node * root, double[:, :] data):
     plt.show()
 
 
-cdef _add_patch(ax, Node * node, centers):
+cdef _add_patch(ax, QuadTree tree, Py_ssize_t node, centers):
     import matplotlib.patches as patches
-    min_bounds = np.asarray(<double [:node.n_dims]>node.center) - node.length / 2
+    min_bounds = np.asarray(tree.center[node]) - tree.length[node] / 2
     ax.add_patch(patches.Rectangle(
-        min_bounds, node.length, node.length, fill=False
+        min_bounds, tree.length[node], tree.length[node], fill=False
     ))
-    if not node.is_leaf:
-        for i in range(1 << node.n_dims):
-            _add_patch(ax, &node.children[i], centers)
+    if tree.first_child[node] >= 0:
+        for i in range(1 << tree.n_dims):
+            _add_patch(ax, tree, tree.first_child[node] + i, centers)
 
-    if node.num_points > 0:
-        centers.append([node.center_of_mass[0], node.center_of_mass[1]])
+    if tree.num_points[node] > 0:
+        centers.append([tree.center_of_mass[node, 0], tree.center_of_mass[node, 1]])
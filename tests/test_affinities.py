@@ -3,6 +3,7 @@ import unittest
 from functools import partial
 
 import numpy as np
+import scipy.sparse as sp
 from sklearn import datasets
 from sklearn.model_selection import train_test_split
 
@@ -152,3 +153,222 @@ class TestAffinityMatrixCorrectness(unittest.TestCase):
                 err_msg=method_name,
             )
 
+
+class TestPrecomputedNeighbors(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.x = np.random.RandomState(0).normal(0, 1, (91, 4))
+        cls.knn_index, cls.neighbors, cls.distances = affinity.build_knn_index(
+            cls.x, "exact", 45, "euclidean"
+        )
+
+    def test_from_neighbors_matches_computed_neighbors(self):
+        aff = PerplexityBasedNN(self.x, perplexity=15)
+        precomputed = affinity.PerplexityBasedNN.from_neighbors(
+            self.neighbors, self.distances, perplexity=15
+        )
+        np.testing.assert_allclose(precomputed.P.toarray(), aff.P.toarray())
+
+        # Lowering the perplexity should work as with computed neighbors
+        aff.set_perplexity(10)
+        precomputed.set_perplexity(10)
+        np.testing.assert_allclose(precomputed.P.toarray(), aff.P.toarray())
+
+    def test_from_distance_graph_with_fixed_number_of_neighbors(self):
+        n_samples, k_neighbors = self.neighbors.shape
+        graph = sp.csr_matrix(
+            (
+                self.distances.ravel(),
+                self.neighbors.ravel(),
+                np.arange(0, n_samples * k_neighbors + 1, k_neighbors),
+            ),
+            shape=(n_samples, n_samples),
+        )
+        aff = affinity.PerplexityBasedNN.from_neighbors(
+            self.neighbors, self.distances, perplexity=15
+        )
+        precomputed = affinity.PerplexityBasedNN.from_distance_graph(
+            graph, perplexity=15
+        )
+        np.testing.assert_allclose(precomputed.P.toarray(), aff.P.toarray())
+
+    def test_from_distance_graph_with_variable_number_of_neighbors(self):
+        n_samples = self.neighbors.shape[0]
+        rows, cols, data = [], [], []
+        for i in range(n_samples):
+            k = 20 + i % 25
+            rows.extend([i] * k)
+            cols.extend(self.neighbors[i, :k])
+            data.extend(self.distances[i, :k])
+        graph = sp.csr_matrix((data, (rows, cols)), shape=(n_samples, n_samples))
+
+        aff = affinity.PerplexityBasedNN.from_distance_graph(graph, perplexity=5)
+        self.assertAlmostEqual(np.sum(aff.P), 1)
+        np.testing.assert_allclose(aff.P.toarray(), aff.P.T.toarray())
+        # Every row has more than the 15 neighbors needed, so only those are used
+        expected = affinity.PerplexityBasedNN.from_neighbors(
+            self.neighbors[:, :15], self.distances[:, :15], perplexity=5
+        )
+        np.testing.assert_allclose(aff.P.toarray(), expected.P.toarray())
+
+        # The conditional probabilities of each point must fit the perplexity
+        conditional_P = affinity.joint_probabilities_graph(
+            graph, [5], symmetrize=False, normalization="point-wise"
+        ).tocsr()
+        for i in range(n_samples):
+            p = conditional_P.data[conditional_P.indptr[i]:conditional_P.indptr[i + 1]]
+            entropy = -np.sum(p[p > 0] * np.log(p[p > 0]))
+            self.assertAlmostEqual(np.exp(entropy), 5, places=3)
+
+        with self.assertRaises(RuntimeError):
+            aff.set_perplexity(3)
+
+    def test_from_distance_graph_keeps_nearest_neighbors_in_each_row(self):
+        random_state = np.random.RandomState(0)
+        n_samples = self.neighbors.shape[0]
+        rows, cols, data = [], [], []
+        for i in range(n_samples):
+            # Some rows are shorter than the 15 neighbors needed
+            k = 10 + i % 30
+            # The entries of each row are stored in no particular order
+            order = random_state.permutation(k)
+            rows.extend([i] * k)
+            cols.extend(self.neighbors[i, order])
+            data.extend(self.distances[i, order])
+        graph = sp.csr_matrix((data, (rows, cols)), shape=(n_samples, n_samples))
+
+        with self.assertLogs(affinity.log, level="WARNING"):
+            aff = affinity.PerplexityBasedNN.from_distance_graph(graph, perplexity=5)
+
+        rows, cols, data = [], [], []
+        for i in range(n_samples):
+            k = min(10 + i % 30, 15)
+            rows.extend([i] * k)
+            cols.extend(self.neighbors[i, :k])
+            data.extend(self.distances[i, :k])
+        nearest = sp.csr_matrix((data, (rows, cols)), shape=(n_samples, n_samples))
+        expected = affinity.joint_probabilities_graph(nearest, [5])
+        np.testing.assert_allclose(aff.P.toarray(), expected.toarray())
+
+    def test_to_new_requires_knn_index(self):
+        aff = affinity.PerplexityBasedNN.from_neighbors(
+            self.neighbors, self.distances, perplexity=15
+        )
+        with self.assertRaises(RuntimeError):
+            aff.to_new(self.x[:5])
+
+        # Attaching an index afterwards enables adding new points
+        aff.knn_index = self.knn_index
+        P = aff.to_new(self.x[:5])
+        np.testing.assert_allclose(np.asarray(P.sum(axis=1)).ravel(), np.ones(5))
+
+
+class TestSymmetrize(unittest.TestCase):
+    def test_matches_scipy(self):
+        random_state = np.random.RandomState(0)
+        n_samples, k_neighbors = 300, 15
+        # Rows in neighbor order, like the kNN graphs
+        indices = np.array([
+            random_state.choice(n_samples, k_neighbors, replace=False)
+            for _ in range(n_samples)
+        ]).ravel()
+        data = random_state.uniform(0.1, 1, indices.shape[0])
+        # Explicit zeros and entries cancelling out are left out, and
+        # duplicates are summed up, like scipy does
+        data[::7] = 0
+        indices[:2], data[:2] = [1, 1], [0.5, 0.25]
+        indices[k_neighbors:k_neighbors + 2] = [0, 2]
+        data[k_neighbors] = -0.75
+        indptr = np.arange(0, indices.shape[0] + 1, k_neighbors)
+
+        for index_dtype in (np.int32, np.int64):
+            P = sp.csr_matrix(
+                (data, indices.astype(index_dtype), indptr.astype(index_dtype)),
+                shape=(n_samples, n_samples),
+            )
+            expected = ((P + P.T) / 2).tocsr()
+            expected.sort_indices()
+            self.assertFalse(expected[0, 1] or expected[1, 0])
+
+            for n_jobs in (1, 4):
+                symmetric = affinity._symmetrize(P, n_jobs=n_jobs)
+                self.assertTrue(symmetric.has_sorted_indices)
+                np.testing.assert_array_equal(symmetric.indptr, expected.indptr)
+                np.testing.assert_array_equal(symmetric.indices, expected.indices)
+                np.testing.assert_allclose(symmetric.data, expected.data, rtol=1e-15)
+
+    def test_long_rows(self):
+        # Rows longer than the insertion sort cutoff, in adversarial orders
+        n = 200
+        for columns in (np.arange(n)[::-1], np.zeros(n, dtype=int),
+                        np.r_[np.arange(0, n, 2), np.arange(1, n, 2)[::-1]]):
+            P = sp.csr_matrix(
+                (np.arange(1, n + 1, dtype=float), columns, np.r_[0, np.full(n, n)]),
+                shape=(n, n),
+            )
+            expected = ((P + P.T) / 2).toarray()
+            np.testing.assert_allclose(affinity._symmetrize(P).toarray(), expected)
+
+    def test_rejects_rectangular_matrices(self):
+        with self.assertRaises(ValueError):
+            affinity._symmetrize(sp.random(5, 6, density=0.5, format="csr"))
+
+
+class TestCompactSymmetricMatrix(unittest.TestCase):
+    def test_stores_each_edge_once(self):
+        x = np.random.RandomState(0).normal(0, 1, (91, 4))
+        P = PerplexityBasedNN(x, perplexity=10).P
+        compact = affinity.CompactSymmetricMatrix(P)
+
+        self.assertEqual(compact.nnz, P.nnz)
+        self.assertEqual(len(compact.data), (P.nnz + P.diagonal().astype(bool).sum()) // 2)
+        np.testing.assert_allclose(compact.toarray(), P.toarray())
+        self.assertAlmostEqual(compact.sum(), P.sum())
+
+        compact *= 4
+        np.testing.assert_allclose(compact.toarray(), 4 * P.toarray())
+
+
+class TestFixedSigmaKernels(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.x = np.random.RandomState(0).normal(0, 1, (91, 4))
+        _, cls.neighbors, cls.distances = affinity.build_knn_index(
+            cls.x, "exact", 15, "euclidean"
+        )
+
+    def _reference_P(self, conditional_P):
+        n_samples, k = self.neighbors.shape
+        conditional_P = conditional_P / conditional_P.sum(axis=1)[:, np.newaxis]
+        P = sp.csr_matrix(
+            (conditional_P.ravel(), self.neighbors.ravel(),
+             np.arange(0, n_samples * k + 1, k)),
+            shape=(n_samples, n_samples),
+        )
+        P = (P + P.T) / 2
+        return P / P.sum()
+
+    def test_gaussian_kernel(self):
+        aff = FixedSigmaNN(self.x, sigma=0.5, k=15)
+        expected = self._reference_P(np.exp(-self.distances ** 2 / (2 * 0.5 ** 2)))
+        np.testing.assert_allclose(aff.P.toarray(), expected.toarray())
+
+    def test_adaptive_kernel(self):
+        aff = FixedSigmaNN(self.x, sigma=0.5, k=15, kernel="adaptive")
+        sigmas = 0.5 * self.distances[:, -1:]
+        expected = self._reference_P(np.exp(-self.distances ** 2 / (2 * sigmas ** 2)))
+        np.testing.assert_allclose(aff.P.toarray(), expected.toarray())
+
+    def test_uniform_kernel(self):
+        aff = FixedSigmaNN(self.x, k=15, kernel="uniform")
+        expected = self._reference_P(np.ones_like(self.distances))
+        np.testing.assert_allclose(aff.P.toarray(), expected.toarray())
+
+        P = aff.to_new(self.x[:5])
+        np.testing.assert_allclose(P.data, 1 / 15)
+
+    def test_gaussian_kernel_requires_sigma(self):
+        with self.assertRaises(ValueError):
+            FixedSigmaNN(self.x, k=15)
+        with self.assertRaises(ValueError):
+            FixedSigmaNN(self.x, sigma=1, k=15, kernel="epanechnikov")
@@ -1,4 +1,8 @@
+import concurrent.futures
 import inspect
+import os
+import tempfile
+import threading
 import logging
 import unittest
 from functools import wraps, partial
@@ -10,10 +14,18 @@ from sklearn import datasets
 from sklearn.model_selection import train_test_split
 
 import openTSNE
-from openTSNE import affinity, initialization
+from openTSNE import _tsne, affinity, initialization, kl_divergence, ordering, profiling
+from openTSNE import schedules, stopping
 from openTSNE.affinity import PerplexityBasedNN
 from openTSNE.nearest_neighbors import NNDescent
-from openTSNE.tsne import kl_divergence_bh, kl_divergence_fft
+from openTSNE.quad_tree import QuadTree
+from openTSNE.tsne import (
+    kl_divergence_bh,
+    kl_divergence_bh_dual,
+    kl_divergence_all_pairs,
+    kl_divergence_fft,
+    Optimizer,
+)
 
 np.random.seed(42)
 affinity.log.setLevel(logging.ERROR)
@@ -81,12 +93,20 @@ class TestTSNEParameterFlow(unittest.TestCase):
     """est that the optimization parameters get properly propagated."""
 
     grad_descent_params = {
-        "negative_gradient_method": [kl_divergence_bh, kl_divergence_fft],
+        "negative_gradient_method": [
+            kl_divergence_bh, kl_divergence_bh_dual, kl_divergence_all_pairs,
+            kl_divergence_fft,
+        ],
         "learning_rate": [1, 10, 100],
         "theta": [0.2, 0.5, 0.8],
+        "dual_tree_theta": [0.2, 0.4],
+        "leaf_size": [1, 8],
+        "max_tree_depth": [None, 10],
         "n_interpolation_points": [3, 5],
         "min_num_intervals": [10, 20, 30],
         "ints_in_interval": [1, 2, 5],
+        "n_negative_samples": [5, 10],
+        "negative_sampling_batch_size": [1, 16],
         "min_grad_norm": [0.01, 0.1],
         "max_grad_norm": [None, 0.5, 1],
         "n_jobs": [1, 2, 4],
@@ -747,3 +767,1426 @@ class TestAffinityIntegration(unittest.TestCase):
 
         with self.assertRaises(TypeError):
             embedding.transform(self.x_test)
+
+
+class TestSparseIndexTypes(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        random_state = np.random.RandomState(42)
+        cls.x = random_state.randn(100, 4)
+        cls.embedding = random_state.randn(100, 2)
+
+    def test_gradients_same_for_32_and_64_bit_indices(self):
+        aff = PerplexityBasedNN(self.x, 10, method="exact")
+        P32 = aff.P.copy()
+        P32.indices = P32.indices.astype(np.int32)
+        P32.indptr = P32.indptr.astype(np.int32)
+        P64 = aff.P.copy()
+        P64.indices = P64.indices.astype(np.int64)
+        P64.indptr = P64.indptr.astype(np.int64)
+
+        for objective in (kl_divergence_bh, kl_divergence_fft):
+            params = dict(dof=1, bh_params={}, fft_params={}, should_eval_error=True)
+            error32, gradient32 = objective(self.embedding, P32, **params)
+            error64, gradient64 = objective(self.embedding, P64, **params)
+
+            self.assertAlmostEqual(error32, error64)
+            np.testing.assert_array_almost_equal(gradient32, gradient64)
+
+
+class TestReordering(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        random_state = np.random.RandomState(42)
+        cls.x = random_state.randn(100, 4)
+        cls.init = random_state.normal(0, 1e-2, (100, 2))
+
+    def test_permuted_gradients_match(self):
+        aff = PerplexityBasedNN(self.x, 10, method="exact")
+        embedding = openTSNE.TSNEEmbedding(self.init, aff)
+        permutation = ordering.reverse_cuthill_mckee(aff.P)
+        permuted = embedding.permute(permutation)
+
+        params = dict(dof=1, bh_params={}, fft_params={}, should_eval_error=True)
+        for objective in (kl_divergence_bh, kl_divergence_fft):
+            error, gradient = objective(np.array(embedding), aff.P, **params)
+            permuted_error, permuted_gradient = objective(
+                np.array(permuted), permuted.affinities.P, **params
+            )
+            self.assertAlmostEqual(error, permuted_error)
+            np.testing.assert_allclose(permuted_gradient, gradient[permutation])
+
+    def test_permuting_back_restores_affinities(self):
+        aff = PerplexityBasedNN(self.x, 10, method="exact")
+        embedding = openTSNE.TSNEEmbedding(self.init, aff, negative_gradient_method="bh")
+        embedding.optimize(5, inplace=True)
+
+        permutation = ordering.morton(aff.P, embedding)
+        permuted = embedding.permute(permutation)
+        np.testing.assert_array_equal(permuted.optimizer.gains,
+                                      embedding.optimizer.gains[permutation])
+
+        restored = permuted.permute(np.argsort(permutation))
+        self.assertIs(restored.affinities, aff)
+        np.testing.assert_array_equal(restored, embedding)
+        np.testing.assert_array_equal(restored.optimizer.gains,
+                                      embedding.optimizer.gains)
+
+    def test_to_new_refers_to_reordered_points(self):
+        aff = PerplexityBasedNN(self.x, 10, method="exact")
+        permutation = ordering.reverse_cuthill_mckee(aff.P)
+        permuted = affinity.PermutedAffinities(aff, permutation)
+
+        P, neighbors, _ = aff.to_new(self.x[:5], return_distances=True)
+        permuted_P, permuted_neighbors, _ = permuted.to_new(
+            self.x[:5], return_distances=True
+        )
+        np.testing.assert_array_equal(permutation[permuted_neighbors], neighbors)
+        np.testing.assert_allclose(
+            permuted_P.toarray(), P.toarray()[:, permutation]
+        )
+
+    def test_fit_returns_embedding_in_original_order(self):
+        for reorder in ("rcm", "morton"):
+            embedding = TSNE(
+                perplexity=10, initialization=self.init, n_iter=5,
+                early_exaggeration_iter=5, random_state=0,
+            ).fit(self.x)
+            reordered = TSNE(
+                perplexity=10, initialization=self.init, n_iter=5,
+                early_exaggeration_iter=5, random_state=0, reorder=reorder,
+            ).fit(self.x)
+
+            # The order of floating point summation changes, so the results
+            # aren't exactly equal
+            self.assertNotIsInstance(reordered.affinities, affinity.PermutedAffinities)
+            np.testing.assert_allclose(reordered, embedding, atol=1e-6)
+
+
+class TestCompactSymmetricAffinities(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        random_state = np.random.RandomState(42)
+        cls.x = random_state.randn(100, 4)
+        cls.embedding = random_state.randn(100, 2)
+
+    def test_gradients_match_full_affinity_matrix(self):
+        P = PerplexityBasedNN(self.x, 10, method="exact").P
+        compact_P = affinity.CompactSymmetricMatrix(P)
+
+        for n_jobs in (1, 4):
+            for dof in (1, 0.5):
+                params = dict(dof=dof, bh_params={}, fft_params={},
+                              should_eval_error=True, n_jobs=n_jobs)
+                for objective in (kl_divergence_bh, kl_divergence_fft):
+                    error, gradient = objective(self.embedding, P, **params)
+                    compact_error, compact_gradient = objective(
+                        self.embedding, compact_P, **params
+                    )
+                    self.assertAlmostEqual(error, compact_error)
+                    np.testing.assert_allclose(compact_gradient, gradient)
+
+    def test_fit_with_compact_affinities(self):
+        embedding = TSNE(
+            perplexity=10, n_iter=5, early_exaggeration_iter=5,
+            random_state=0, compact_affinities=True,
+        ).fit(self.x)
+        self.assertIsInstance(
+            embedding.affinities.P, affinity.CompactSymmetricMatrix
+        )
+        self.assertAlmostEqual(np.sum(embedding.affinities.P), 1)
+        # New points are still embedded using the full affinities
+        embedding.transform(self.x[:5], n_iter=5)
+
+
+class TestUpdateKernel(unittest.TestCase):
+    def test_matches_numpy_update(self):
+        random_state = np.random.RandomState(0)
+        for max_grad_norm in (None, 0.5):
+            embedding = random_state.randn(200, 2)
+            gradient = random_state.randn(200, 2)
+            update = random_state.randn(200, 2)
+            gains = random_state.uniform(0.5, 1.5, (200, 2))
+            # Make sure zero signs are handled the same way as `np.sign`
+            update[:10] = 0
+            gradient[5:15] = 0
+
+            kernel_args = [np.copy(a) for a in (embedding, gradient, update, gains)]
+            grad_norm = _tsne.update_embedding(
+                *kernel_args, learning_rate=200, momentum=0.5, min_gain=0.01,
+                max_grad_norm=np.inf if max_grad_norm is None else max_grad_norm,
+                should_center=True, num_threads=2,
+            )
+
+            if max_grad_norm is not None:
+                norm = np.linalg.norm(gradient, axis=1)
+                coeff = max_grad_norm / (norm + 1e-6)
+                mask = coeff < 1
+                gradient[mask] *= coeff[mask, None]
+            flipped = np.sign(update) != np.sign(gradient)
+            gains[flipped] += 0.2
+            gains[~flipped] = gains[~flipped] * 0.8 + 0.01
+            update = 0.5 * update - 200 * gains * gradient
+            embedding += update
+            embedding -= np.mean(embedding, axis=0)
+
+            for expected, actual in zip((embedding, gradient, update, gains), kernel_args):
+                np.testing.assert_allclose(actual, expected, atol=1e-12)
+            self.assertAlmostEqual(grad_norm, np.linalg.norm(gradient))
+
+    def test_optimizer_reuses_buffers(self):
+        x = np.random.RandomState(0).randn(100, 4)
+        embedding = TSNE(perplexity=10).prepare_initial(x)
+        embedding.optimize(5, inplace=True)
+        gradient = embedding.optimizer._buffers["gradient"]
+        embedding.optimize(5, inplace=True)
+        self.assertIs(embedding.optimizer._buffers["gradient"], gradient)
+
+
+class TestExaggeration(unittest.TestCase):
+    def test_affinity_matrix_is_not_modified(self):
+        x = np.random.RandomState(0).randn(100, 4)
+        for method in ("bh", "fft"):
+            embedding = TSNE(perplexity=10, negative_gradient_method=method).prepare_initial(x)
+            P = embedding.affinities.P
+            original_data = P.data.copy()
+            # Exaggeration must work on read-only, e.g. memory-mapped, affinities
+            P.data.flags.writeable = False
+
+            embedding.optimize(10, exaggeration=12, inplace=True)
+            np.testing.assert_array_equal(P.data, original_data)
+
+    def test_exaggeration_scales_attractive_forces(self):
+        random_state = np.random.RandomState(0)
+        x, embedding = random_state.randn(100, 4), random_state.randn(100, 2)
+        P = PerplexityBasedNN(x, 10, method="exact").P
+
+        params = dict(dof=1, bh_params={}, fft_params={}, should_eval_error=True)
+        for objective in (kl_divergence_bh, kl_divergence_fft):
+            error, gradient = objective(embedding, P, **params)
+            exaggerated_error, exaggerated_gradient = objective(
+                embedding, P, exaggeration=4, **params
+            )
+            _, expected_gradient = objective(embedding, P * 4, **params)
+
+            # The error is always computed w.r.t. the actual affinities
+            self.assertAlmostEqual(exaggerated_error, error)
+            np.testing.assert_allclose(exaggerated_gradient, expected_gradient)
+
+
+class TestOptimizers(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.x = np.random.RandomState(0).randn(100, 4)
+
+    def test_builtin_optimizers_reduce_error(self):
+        for optimizer in ("gradient_descent", "adaptive_momentum", "adam"):
+            embedding = TSNE(perplexity=10, optimizer=optimizer).prepare_initial(self.x)
+            embedding1 = embedding.optimize(5)
+            embedding2 = embedding1.optimize(50)
+            self.assertLess(embedding2.kl_divergence, embedding1.kl_divergence, optimizer)
+
+    def test_custom_optimizer(self):
+        class plain_gradient_descent(Optimizer):
+            def _step(self, embedding, gradient, learning_rate, **_):
+                embedding -= learning_rate * gradient
+                return np.linalg.norm(gradient)
+
+        optimizer = plain_gradient_descent()
+        embedding = TSNE(perplexity=10, optimizer=optimizer).prepare_initial(self.x)
+        self.assertIsInstance(embedding.optimizer, plain_gradient_descent)
+        # Every embedding gets its own copy of the optimizer
+        self.assertIsNot(embedding.optimizer, optimizer)
+
+        embedding1 = embedding.optimize(5)
+        embedding2 = embedding1.optimize(50)
+        self.assertLess(embedding2.kl_divergence, embedding1.kl_divergence)
+
+    def test_invalid_optimizer(self):
+        with self.assertRaises(ValueError):
+            TSNE(optimizer="sgd").prepare_initial(self.x)
+        with self.assertRaises(TypeError):
+            TSNE(optimizer=object()).prepare_initial(self.x)
+
+    def test_state_is_copied_and_permuted(self):
+        embedding = TSNE(perplexity=10, optimizer="adam").prepare_initial(self.x)
+        embedding = embedding.optimize(5)
+        optimizer = embedding.optimizer
+
+        optimizer_copy = optimizer.copy()
+        self.assertEqual(optimizer_copy.n_steps, optimizer.n_steps)
+        self.assertIsNot(optimizer_copy.second_moment, optimizer.second_moment)
+        np.testing.assert_array_equal(optimizer_copy.second_moment, optimizer.second_moment)
+
+        permutation = np.random.RandomState(1).permutation(self.x.shape[0])
+        permuted = embedding.permute(permutation)
+        np.testing.assert_array_equal(
+            permuted.optimizer.first_moment, optimizer.first_moment[permutation]
+        )
+
+
+class TestAutoStop(unittest.TestCase):
+    @staticmethod
+    def run_rule(rule, errors, every_iters=10):
+        rule.optimization_about_to_start()
+        for i, error in enumerate(errors):
+            if rule(i * every_iters, error):
+                return i * every_iters
+
+    def test_improvement_rate_peak(self):
+        errors = [5, 4.5, 4.2, 4.0, 3.9, 3.8, 3.6, 3.3, 3.2, 3.15, 3.1]
+        # The rate peaks between iterations 60 and 70
+        self.assertEqual(self.run_rule(stopping.ImprovementRatePeak(min_iter=0), errors), 80)
+        self.assertEqual(self.run_rule(stopping.ImprovementRatePeak(min_iter=90), errors), None)
+
+        # Stop as soon as the error increases
+        errors = [5, 4.5, 4.2, 4.3, 4.0]
+        self.assertEqual(self.run_rule(stopping.ImprovementRatePeak(min_iter=0), errors), 30)
+
+    def test_relative_improvement_below(self):
+        errors = [2, 1.5, 1.4, 1.39, 1.389, 1.3889]
+        self.assertEqual(self.run_rule(stopping.RelativeImprovementBelow(1e-3), errors), 30)
+        self.assertEqual(self.run_rule(stopping.RelativeImprovementBelow(1e-5), errors), 50)
+
+    def test_optimization_ends_once_converged(self):
+        x = np.random.RandomState(0).randn(100, 4)
+        embedding = TSNE(perplexity=10).prepare_initial(x)
+
+        rule = stopping.RelativeImprovementBelow(np.inf)
+        embedding.optimize(100, stopping_rule=rule, stopping_rule_every_iters=5, inplace=True)
+        # The rule needs two errors before it can decide to stop
+        self.assertEqual([iteration for iteration, _ in rule.errors], [0, 5])
+
+    def test_fit_with_auto_stop(self):
+        x = np.random.RandomState(0).randn(100, 4)
+        with patch("openTSNE.stopping.RelativeImprovementBelow.should_stop",
+                   return_value=True) as should_stop:
+            embedding = TSNE(perplexity=10, auto_stop=True).fit(x)
+        self.assertEqual(should_stop.call_count, 1)
+        self.assertIsNotNone(embedding.kl_divergence)
+
+
+class TestAutoLearningRate(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.x = np.random.RandomState(0).randn(600, 4)
+
+    @patch("openTSNE.tsne.gradient_descent.__call__")
+    def test_learning_rate_scales_with_exaggeration(self, gradient_descent):
+        gradient_descent.return_value = (1, MagicMock())
+        embedding = TSNE(perplexity=10, learning_rate="auto").prepare_initial(self.x)
+
+        embedding.optimize(10, exaggeration=12)
+        check_call_contains_kwargs(gradient_descent.mock_calls[-1], {"learning_rate": 50})
+        embedding.optimize(10, exaggeration=4)
+        check_call_contains_kwargs(gradient_descent.mock_calls[-1], {"learning_rate": 150})
+        embedding.optimize(10)
+        check_call_contains_kwargs(gradient_descent.mock_calls[-1], {"learning_rate": 600})
+
+    @patch("openTSNE.tsne.gradient_descent.__call__")
+    def test_auto_early_exaggeration(self, gradient_descent):
+        gradient_descent.return_value = (1, MagicMock())
+
+        TSNE(learning_rate="auto", early_exaggeration="auto").fit(self.x)
+        check_call_contains_kwargs(
+            gradient_descent.mock_calls[0], {"exaggeration": 12, "learning_rate": 50}
+        )
+
+        # With a small, fixed learning rate, the exaggeration is increased
+        gradient_descent.reset_mock()
+        TSNE(learning_rate=1, early_exaggeration="auto").fit(self.x)
+        check_call_contains_kwargs(
+            gradient_descent.mock_calls[0], {"exaggeration": 32, "learning_rate": 1}
+        )
+
+    def test_invalid_learning_rate(self):
+        embedding = TSNE(perplexity=10, learning_rate="fast").prepare_initial(self.x)
+        with self.assertRaises(ValueError):
+            embedding.optimize(10)
+
+
+class TestCheckpoints(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.x = np.random.RandomState(0).randn(100, 4)
+
+    def optimize_with_interruption(self, path, tsne, n_iter, interrupt_at):
+        from openTSNE.callbacks import Checkpoint
+
+        def interrupt(iteration, error, embedding):
+            return iteration == interrupt_at
+
+        embedding = tsne.prepare_initial(self.x)
+        embedding = embedding.optimize(10, exaggeration=12)
+        embedding.optimize(
+            n_iter, exaggeration=4, momentum=0.6, callbacks=[Checkpoint(path), interrupt],
+            callbacks_every_iters=10, inplace=True,
+        )
+        return embedding
+
+    def check_resume(self, tsne):
+        embedding = tsne.prepare_initial(self.x)
+        embedding = embedding.optimize(10, exaggeration=12)
+        expected = embedding.optimize(50, exaggeration=4, momentum=0.6)
+
+        with tempfile.TemporaryDirectory() as path:
+            interrupted = self.optimize_with_interruption(path, tsne, 50, 30)
+            self.assertFalse(np.allclose(interrupted, expected))
+
+            loaded = openTSNE.TSNEEmbedding.load_checkpoint(path)
+            self.assertEqual(loaded.optimizer.progress["iteration"], 29)
+            self.assertEqual(loaded.optimizer.progress["exaggeration"], 4)
+            # The affinities are memory-mapped instead of read into memory
+            self.assertFalse(loaded.affinities.P.data.flags.owndata)
+
+            resumed = loaded.resume()
+        np.testing.assert_allclose(resumed, expected)
+        self.assertAlmostEqual(resumed.kl_divergence, expected.kl_divergence)
+
+    def test_resume(self):
+        self.check_resume(TSNE(perplexity=10, random_state=np.random.RandomState(1)))
+
+    def test_resume_compact_affinities_and_adaptive_momentum(self):
+        self.check_resume(TSNE(
+            perplexity=10, compact_affinities=True, optimizer="adaptive_momentum",
+        ))
+
+    def check_resume_fit(self, make_tsne):
+        from openTSNE.callbacks import Checkpoint
+
+        def noop(iteration, error, embedding):
+            return False
+
+        expected = make_tsne(callbacks=[noop]).fit(self.x)
+
+        interrupted = []
+
+        def interrupt_once(iteration, error, embedding):
+            if iteration == 10 and not interrupted:
+                interrupted.append(iteration)
+                return True
+            return False
+
+        with tempfile.TemporaryDirectory() as path:
+            # Interrupt during early exaggeration
+            make_tsne(callbacks=[Checkpoint(path), interrupt_once]).fit(self.x)
+            self.assertEqual(interrupted, [10])
+
+            loaded = openTSNE.TSNEEmbedding.load_checkpoint(path)
+            self.assertEqual(loaded.optimizer.progress["iteration"], 9)
+            self.assertEqual(len(loaded.optimizer.phases), 1)
+
+            resumed = loaded.resume()
+        self.assertEqual(resumed.optimizer.phases, [])
+        np.testing.assert_allclose(resumed, expected)
+        self.assertAlmostEqual(resumed.kl_divergence, expected.kl_divergence)
+
+    def test_resume_fit_interrupted_during_early_exaggeration(self):
+        def make_tsne(**kwargs):
+            return TSNE(
+                perplexity=10, negative_gradient_method="sampling",
+                early_exaggeration_iter=20, n_iter=20, random_state=0,
+                callbacks_every_iters=5, **kwargs,
+            )
+
+        self.check_resume_fit(make_tsne)
+
+    def test_resume_fit_with_adaptive_theta(self):
+        from openTSNE.schedules import AdaptiveTheta
+
+        def make_tsne(**kwargs):
+            return TSNE(
+                perplexity=10, negative_gradient_method="bh",
+                theta=AdaptiveTheta(0.05, every_iters=5, n_samples=10, random_state=1),
+                early_exaggeration_iter=20, n_iter=20, random_state=0,
+                callbacks_every_iters=5, **kwargs,
+            )
+
+        self.check_resume_fit(make_tsne)
+
+    def test_resume_reordered_embedding(self):
+        embedding = TSNE(perplexity=10).prepare_initial(self.x)
+        permutation = np.random.RandomState(1).permutation(self.x.shape[0])
+        embedding = embedding.permute(permutation).optimize(5)
+
+        with tempfile.TemporaryDirectory() as path:
+            embedding.save_checkpoint(path)
+            loaded = openTSNE.TSNEEmbedding.load_checkpoint(path)
+
+        np.testing.assert_array_equal(loaded, embedding)
+        np.testing.assert_array_equal(loaded.affinities.permutation, permutation)
+        np.testing.assert_array_equal(
+            loaded.permute(np.argsort(permutation)).affinities.P.toarray(),
+            embedding.permute(np.argsort(permutation)).affinities.P.toarray(),
+        )
+
+    def test_affinities_are_written_once(self):
+        embedding = TSNE(perplexity=10).prepare_initial(self.x)
+        with tempfile.TemporaryDirectory() as path:
+            embedding.save_checkpoint(path)
+            filename = os.path.join(path, "affinities", "data.npy")
+            mtime = os.stat(filename).st_mtime_ns
+            embedding.optimize(5, inplace=True)
+            embedding.save_checkpoint(path)
+            self.assertEqual(os.stat(filename).st_mtime_ns, mtime)
+
+    def test_different_affinities_with_same_structure(self):
+        init = initialization.random(self.x, random_state=0)
+        embeddings = [
+            openTSNE.TSNEEmbedding(init, affinity.FixedSigmaNN(
+                self.x, sigma=sigma, k=10, method="exact",
+            ))
+            for sigma in (1, 3)
+        ]
+        P1, P2 = (e.affinities.P for e in embeddings)
+        self.assertEqual(P1.nnz, P2.nnz)
+
+        with tempfile.TemporaryDirectory() as path:
+            for embedding in embeddings:
+                embedding.save_checkpoint(path)
+                loaded = openTSNE.TSNEEmbedding.load_checkpoint(path, mmap_mode=None)
+                np.testing.assert_array_equal(
+                    loaded.affinities.P.toarray(), embedding.affinities.P.toarray()
+                )
+
+    def test_unpicklable_parameters(self):
+        embedding = TSNE(perplexity=10, theta=lambda i, n: 0.5).prepare_initial(self.x)
+        with tempfile.TemporaryDirectory() as path:
+            with self.assertRaises(ValueError):
+                embedding.save_checkpoint(path)
+            self.assertFalse(os.path.exists(os.path.join(path, "state")))
+
+        # Schedules from the library can be saved
+        embedding = TSNE(
+            perplexity=10, theta=schedules.Linear(0.8, 0.5),
+        ).prepare_initial(self.x)
+        with tempfile.TemporaryDirectory() as path:
+            embedding.save_checkpoint(path)
+            loaded = openTSNE.TSNEEmbedding.load_checkpoint(path)
+        self.assertIsInstance(loaded.gradient_descent_params["theta"], schedules.Linear)
+
+
+class TestBatchedTSNEEmbedding(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        random_state = np.random.RandomState(0)
+        cls.x = random_state.randn(100, 4)
+        cls.affinities = PerplexityBasedNN(cls.x, 10, method="exact")
+        cls.inits = [
+            initialization.random(cls.x, random_state=seed) for seed in range(3)
+        ]
+
+    def test_batch_matches_separate_optimization(self):
+        learning_rates = np.array([5, 10, 20])
+        for method in ("bh", "fft"):
+            for optimizer in ("gradient_descent", "adam"):
+                params = dict(negative_gradient_method=method, optimizer=optimizer)
+                batch = openTSNE.BatchedTSNEEmbedding(
+                    np.stack(self.inits), self.affinities, **params
+                )
+                batch = batch.optimize(10, exaggeration=12, learning_rate=learning_rates)
+                batch = batch.optimize(10)
+
+                for i, init in enumerate(self.inits):
+                    embedding = openTSNE.TSNEEmbedding(init, self.affinities, **params)
+                    embedding = embedding.optimize(
+                        10, exaggeration=12, learning_rate=learning_rates[i]
+                    )
+                    embedding = embedding.optimize(10)
+
+                    np.testing.assert_allclose(batch[i], embedding)
+                    self.assertAlmostEqual(batch.kl_divergence[i], embedding.kl_divergence)
+
+    def test_unstack(self):
+        batch = openTSNE.BatchedTSNEEmbedding(
+            np.stack(self.inits), self.affinities, negative_gradient_method="bh"
+        ).optimize(5)
+        embeddings = batch.unstack()
+
+        self.assertEqual(len(embeddings), len(self.inits))
+        for i, embedding in enumerate(embeddings):
+            self.assertIsInstance(embedding, openTSNE.TSNEEmbedding)
+            np.testing.assert_array_equal(embedding, batch[i])
+            np.testing.assert_array_equal(
+                embedding.optimizer.gains, batch.optimizer.optimizers[i].gains
+            )
+            self.assertEqual(embedding.kl_divergence, batch.kl_divergence[i])
+            # The embeddings can be optimized further on their own
+            embedding.optimize(5, inplace=True)
+
+    def test_invalid_shape(self):
+        with self.assertRaises(ValueError):
+            openTSNE.BatchedTSNEEmbedding(self.inits[0], self.affinities)
+
+    def test_buffers_are_reused(self):
+        batch = openTSNE.BatchedTSNEEmbedding(
+            np.stack(self.inits), self.affinities, negative_gradient_method="bh"
+        )
+        batch.optimize(2, inplace=True)
+        points = batch.optimizer._buffers["batch_points"]
+        self.assertEqual(points.shape, (100, 3, 2))
+        batch.optimize(2, inplace=True)
+        self.assertIs(batch.optimizer._buffers["batch_points"], points)
+
+    def test_stopping_rules_are_rejected(self):
+        batch = openTSNE.BatchedTSNEEmbedding(
+            np.stack(self.inits), self.affinities, negative_gradient_method="bh"
+        )
+        with self.assertRaises(ValueError):
+            batch.optimize(20, stopping_rule=stopping.ImprovementRatePeak())
+
+
+class TestNegativeSampling(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        random_state = np.random.RandomState(0)
+        cls.x = random_state.randn(200, 4)
+        cls.affinities = PerplexityBasedNN(cls.x, 10, method="exact")
+        cls.embedding = np.ascontiguousarray(random_state.randn(200, 2))
+
+    def _estimate(self, seed, with_neighbors=True, **kwargs):
+        # The neighbors are looked up with binary search in the rows of P
+        P = self.affinities.P.sorted_indices()
+        indices, indptr = P.indices, P.indptr
+        if not with_neighbors:
+            indices = indptr = np.empty(0, dtype=np.int32)
+        gradient = np.zeros_like(self.embedding)
+        sum_Q = _tsne.estimate_negative_gradient_sampled(
+            indices, indptr, self.embedding, self.embedding, gradient, seed=seed,
+            **kwargs,
+        )
+        return sum_Q, gradient
+
+    def test_estimates_are_unbiased(self):
+        gradient = np.zeros_like(self.embedding)
+        sum_Q = _tsne.estimate_negative_gradient_bh(
+            QuadTree(self.embedding), self.embedding, gradient, theta=0
+        )
+
+        for with_neighbors in (False, True):
+            n_trials = 2000
+            estimates = [
+                self._estimate(seed, with_neighbors, n_negative_samples=10)
+                for seed in range(n_trials)
+            ]
+            sum_Qs = np.array([q for q, _ in estimates])
+            gradients = np.mean([q * g for q, g in estimates], axis=0)
+
+            np.testing.assert_allclose(sum_Qs.mean(), sum_Q, rtol=0.01)
+            error = np.linalg.norm(gradients - sum_Q * gradient)
+            self.assertLess(error / np.linalg.norm(sum_Q * gradient), 0.1)
+
+    def test_independent_of_number_of_threads(self):
+        for batch_size in (1, 7):
+            _, gradient1 = self._estimate(42, batch_size=batch_size, num_threads=1)
+            _, gradient2 = self._estimate(42, batch_size=batch_size, num_threads=4)
+            np.testing.assert_array_equal(gradient1, gradient2)
+
+    def test_reproducible_with_random_state(self):
+        params = dict(negative_gradient_method="sampling", n_negative_samples=5)
+        embedding1 = openTSNE.TSNEEmbedding(
+            self.embedding, self.affinities, random_state=1, **params
+        ).optimize(20)
+        embedding2 = openTSNE.TSNEEmbedding(
+            self.embedding, self.affinities, random_state=1, **params
+        ).optimize(20)
+        np.testing.assert_array_equal(embedding1, embedding2)
+
+    def test_unsorted_affinities_are_not_modified(self):
+        # Reverse the neighbors in every row. P may be shared, e.g. between
+        # threads, so it must not be sorted in place
+        P = self.affinities.P.sorted_indices()
+        for i in range(P.shape[0]):
+            row = slice(P.indptr[i], P.indptr[i + 1])
+            P.indices[row], P.data[row] = P.indices[row][::-1], P.data[row][::-1]
+        P.has_sorted_indices = False
+        indices = P.indices.copy()
+        affinities = affinity.Affinities()
+        affinities.P = P
+
+        params = dict(negative_gradient_method="sampling", n_negative_samples=5)
+        embedding = openTSNE.TSNEEmbedding(
+            self.embedding, affinities, random_state=1, **params
+        ).optimize(5)
+        expected = openTSNE.TSNEEmbedding(
+            self.embedding, self.affinities, random_state=1, **params
+        ).optimize(5)
+        np.testing.assert_allclose(embedding, expected)
+        np.testing.assert_array_equal(P.indices, indices)
+
+    def test_tsne_with_sampling(self):
+        x_train, x_test = self.x[:150], self.x[150:]
+        for compact_affinities in (False, True):
+            embedding = TSNE(
+                perplexity=10,
+                early_exaggeration_iter=50,
+                n_iter=50,
+                negative_gradient_method="sampling",
+                compact_affinities=compact_affinities,
+                random_state=0,
+            ).fit(x_train)
+            self.assertTrue(np.all(np.isfinite(embedding)))
+            self.assertTrue(np.isfinite(embedding.kl_divergence))
+
+        partial_embedding = embedding.transform(x_test)
+        self.assertTrue(np.all(np.isfinite(partial_embedding)))
+
+
+class TestOptimizeAsync(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.x = np.random.RandomState(0).randn(100, 4)
+        cls.embedding = TSNE(perplexity=10).prepare_initial(cls.x)
+
+    def test_matches_synchronous_optimization(self):
+        expected = self.embedding.optimize(50, exaggeration=4)
+        handle = self.embedding.optimize_async(50, exaggeration=4)
+        embedding = handle.result(timeout=60)
+
+        self.assertTrue(handle.done())
+        np.testing.assert_allclose(embedding, expected)
+        self.assertAlmostEqual(embedding.kl_divergence, expected.kl_divergence)
+
+        iteration, snapshot = handle.snapshot()
+        self.assertEqual(iteration, 50)
+        np.testing.assert_array_equal(snapshot, embedding)
+        self.assertFalse(snapshot.flags.writeable)
+
+    def test_pause_and_cancel(self):
+        started, paused = threading.Event(), threading.Event()
+        handles, calls = [], []
+
+        # Callbacks run on the worker thread, so they can pause the
+        # optimization at a known iteration
+        def pause_at_iteration_5(iteration, error, embedding):
+            calls.append(iteration)
+            if iteration == 5:
+                started.wait(timeout=60)
+                handles[0].pause()
+                paused.set()
+
+        handle = self.embedding.optimize_async(
+            100000, snapshot_every_iters=1, callbacks=pause_at_iteration_5,
+            callbacks_every_iters=1,
+        )
+        handles.append(handle)
+        started.set()
+        self.assertTrue(paused.wait(timeout=60))
+        self.assertTrue(handle.paused)
+
+        # The worker blocks after finishing the iteration it was paused in
+        with self.assertRaises(concurrent.futures.TimeoutError):
+            handle.result(timeout=0.1)
+        self.assertFalse(handle.done())
+
+        handle.resume()
+        handle.cancel()
+        embedding = handle.result(timeout=60)
+        self.assertEqual(calls, [1, 2, 3, 4, 5])
+        self.assertEqual(embedding.optimizer.progress["iteration"], 5)
+        self.assertEqual(handle.snapshot()[0], 5)
+        self.assertIsNotNone(embedding.kl_divergence)
+
+    def test_resume_after_cancel(self):
+        expected = self.embedding.optimize(500, exaggeration=4)
+
+        handle = self.embedding.optimize_async(500, exaggeration=4)
+        handle.pause()
+        handle.cancel()
+        cancelled = handle.result(timeout=60)
+        self.assertLess(cancelled.optimizer.progress["iteration"], 500)
+
+        resumed = cancelled.resume()
+        np.testing.assert_allclose(resumed, expected)
+
+    def test_exceptions_are_propagated(self):
+        handle = self.embedding.optimize_async(10, negative_gradient_method="invalid")
+        with self.assertRaises(ValueError):
+            handle.result(timeout=60)
+
+
+class TestProfiling(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.x = np.random.RandomState(0).randn(100, 4)
+        cls.tsne = partial(TSNE, perplexity=10, early_exaggeration_iter=20, n_iter=30)
+
+    def test_profile_is_attached_to_embedding(self):
+        for method, phases in [
+            ("bh", ["gradient.bh.quad_tree", "gradient.bh.traversal"]),
+            ("fft", ["gradient.fft.interpolation", "gradient.fft.convolution",
+                     "gradient.fft.potentials"]),
+        ]:
+            embedding = self.tsne(negative_gradient_method=method, profile=True).fit(self.x)
+            report = embedding.profiler.report()
+
+            for phase in ["affinities", "affinities.knn", "affinities.perplexity",
+                          "affinities.symmetrize", "initialization", "gradient",
+                          "gradient.positive", "update"] + phases:
+                self.assertIn(phase, report)
+            self.assertEqual(report["update"]["count"], 50)
+            self.assertEqual(report["affinities.knn"]["count"], 1)
+            # Evaluating the final error runs the objective once more per phase
+            self.assertEqual(report[phases[-1]]["count"], 52)
+            self.assertIn("gradient.positive", str(embedding.profiler))
+
+    def test_export_hook(self):
+        records = []
+        profiler = profiling.Profiler(on_record=lambda *args: records.append(args))
+        embedding = self.tsne(profile=profiler).fit(self.x)
+
+        self.assertIs(embedding.profiler, profiler)
+        self.assertEqual(len(records), sum(map(len, profiler.timings.values())))
+        self.assertTrue(all(duration >= 0 for _, duration in records))
+
+    def test_disabled_by_default(self):
+        embedding = self.tsne().fit(self.x)
+        self.assertIsNone(embedding.profiler)
+        self.assertFalse(profiling.is_enabled())
+
+    def test_context_manager(self):
+        with profiling.Profiler() as profiler:
+            self.assertTrue(profiling.is_enabled())
+            embedding = self.tsne().prepare_initial(self.x)
+            embedding.optimize(10)
+        self.assertFalse(profiling.is_enabled())
+
+        report = profiler.report()
+        self.assertEqual(report["update"]["count"], 10)
+        self.assertIsNone(embedding.profiler)
+
+
+class TestQuadTree(unittest.TestCase):
+    @staticmethod
+    def _exact_negative_gradient(embedding, dof=1):
+        diff = embedding[:, np.newaxis] - embedding[np.newaxis]
+        sq_distances = np.sum(diff ** 2, axis=2)
+        q = (dof / (dof + sq_distances)) ** ((dof + 1) / 2)
+        # Barnes-Hut ignores the interactions between duplicate points
+        q[sq_distances < 1e-12] = 0
+        sum_Q = np.sum(q)
+        return sum_Q, -np.sum((q ** 2)[:, :, np.newaxis] * diff, axis=1) / sum_Q
+
+    def _bh_negative_gradient(self, embedding, theta=0, dof=1, num_threads=1, **tree_params):
+        gradient = np.zeros_like(embedding)
+        sum_Q = _tsne.estimate_negative_gradient_bh(
+            QuadTree(embedding, num_threads=num_threads, **tree_params), embedding,
+            gradient, theta=theta, dof=dof,
+        )
+        return sum_Q, gradient
+
+    def test_exact_without_approximation(self):
+        random_state = np.random.RandomState(0)
+        for n_dims in (1, 2, 3):
+            embedding = random_state.randn(300, n_dims)
+            # Duplicates must be accounted for with their multiplicity
+            embedding[:10] = embedding[0]
+
+            sum_Q, gradient = self._bh_negative_gradient(embedding)
+            expected_sum_Q, expected_gradient = self._exact_negative_gradient(embedding)
+            np.testing.assert_allclose(sum_Q, expected_sum_Q)
+            np.testing.assert_allclose(gradient, expected_gradient, atol=1e-12)
+
+    def test_exact_with_bucketed_leaves(self):
+        random_state = np.random.RandomState(0)
+        for n_dims in (1, 2, 3):
+            embedding = random_state.randn(300, n_dims)
+            embedding[:10] = embedding[0]
+            # Points close enough to be split only at the bottom of the tree
+            embedding[10:20] = embedding[10] + 1e-9 * random_state.randn(10, n_dims)
+
+            expected_sum_Q, expected_gradient = self._exact_negative_gradient(embedding)
+            for tree_params in [{"leaf_size": 8}, {"leaf_size": 64},
+                                {"max_depth": 3}, {"leaf_size": 4, "max_depth": 0}]:
+                sum_Q, gradient = self._bh_negative_gradient(embedding, **tree_params)
+                np.testing.assert_allclose(sum_Q, expected_sum_Q)
+                np.testing.assert_allclose(gradient, expected_gradient, atol=1e-12)
+
+    def test_exact_with_point_on_leaf_center(self):
+        # The middle point of the first leaf sits on the leaf's center of
+        # mass, but the other points of the leaf must still repel it
+        points = np.array([[-1, 0], [0, 0], [1, 0], [5, 5], [5, 6], [6, 5]], dtype=float)
+        for n_dims in (2, 3, 4):
+            embedding = np.zeros((len(points), n_dims))
+            embedding[:, :2] = points
+            expected_gradient = np.zeros_like(embedding)
+            expected_sum_Q = _tsne.estimate_negative_gradient_exact(
+                embedding, embedding, expected_gradient
+            )
+            for tree_params in [{"leaf_size": 3}, {"leaf_size": 3, "max_depth": 1},
+                                {"leaf_size": 1, "max_depth": 0}]:
+                sum_Q, gradient = self._bh_negative_gradient(embedding, **tree_params)
+                np.testing.assert_allclose(sum_Q, expected_sum_Q)
+                np.testing.assert_allclose(gradient, expected_gradient, atol=1e-12)
+
+    def test_exact_with_degrees_of_freedom(self):
+        random_state = np.random.RandomState(0)
+        # Two and three dimensional embeddings have their own kernels, and
+        # integer and half-integer degrees of freedom avoid `pow`
+        for n_dims in (1, 2, 3, 4):
+            embedding = random_state.randn(200, n_dims)
+            embedding[:10] = embedding[0]
+            for dof in (0.5, 1, 1.5, 2, 3, 0.7, 100):
+                for leaf_size in (1, 16):
+                    sum_Q, gradient = self._bh_negative_gradient(
+                        embedding, dof=dof, leaf_size=leaf_size
+                    )
+                    expected_sum_Q, expected_gradient = self._exact_negative_gradient(
+                        embedding, dof=dof
+                    )
+                    np.testing.assert_allclose(sum_Q, expected_sum_Q)
+                    np.testing.assert_allclose(gradient, expected_gradient, atol=1e-12)
+
+    def test_tree_size_limits(self):
+        random_state = np.random.RandomState(0)
+        # Tight clusters of near-duplicates would otherwise need deep trees
+        embedding = np.repeat(random_state.randn(20, 2), 50, axis=0)
+        embedding += 1e-5 * random_state.randn(*embedding.shape)
+
+        tree = QuadTree(embedding)
+        bucketed = QuadTree(embedding, leaf_size=64)
+        self.assertEqual(bucketed.leaf_size, 64)
+        self.assertLess(bucketed.n_nodes, tree.n_nodes / 10)
+
+        shallow = QuadTree(embedding, max_depth=5)
+        self.assertEqual(shallow.max_depth, 5)
+        self.assertLessEqual(shallow.n_levels, 6)
+        # The node arrays may have room for more nodes than are in use
+        n_nodes = shallow.n_nodes
+        leaves = np.asarray(shallow.first_child)[:n_nodes] == -1
+        num_points = np.asarray(shallow.num_points)[:n_nodes]
+        self.assertEqual(np.sum(num_points[leaves]), len(embedding))
+
+        with self.assertRaises(ValueError):
+            QuadTree(embedding, leaf_size=0)
+        with self.assertRaises(ValueError):
+            QuadTree(embedding, max_depth=-1)
+
+    def test_independent_of_number_of_threads(self):
+        embedding = np.random.RandomState(0).randn(2000, 2)
+        sum_Q1, gradient1 = self._bh_negative_gradient(embedding, theta=0.5, num_threads=1)
+        sum_Q2, gradient2 = self._bh_negative_gradient(embedding, theta=0.5, num_threads=4)
+        self.assertEqual(sum_Q1, sum_Q2)
+        np.testing.assert_array_equal(gradient1, gradient2)
+
+    def test_degenerate_inputs(self):
+        for embedding in (np.zeros((1, 2)), np.ones((5, 2)), np.zeros((0, 2))):
+            sum_Q, gradient = self._bh_negative_gradient(embedding)
+            self.assertEqual(sum_Q, 0)
+            np.testing.assert_array_equal(gradient, 0)
+
+    def test_rebuilding_reuses_tree(self):
+        random_state = np.random.RandomState(0)
+        tree = QuadTree()
+        for n_samples, n_dims in [(500, 2), (2000, 2), (100, 2), (300, 3), (200, 1)]:
+            embedding = random_state.randn(n_samples, n_dims)
+            tree.build(embedding)
+
+            gradient = np.zeros_like(embedding)
+            sum_Q = _tsne.estimate_negative_gradient_bh(
+                tree, embedding, gradient, theta=0.5
+            )
+            expected_sum_Q, expected_gradient = self._bh_negative_gradient(
+                embedding, theta=0.5
+            )
+            self.assertEqual(sum_Q, expected_sum_Q)
+            np.testing.assert_array_equal(gradient, expected_gradient)
+
+    def test_is_built_from(self):
+        embedding = np.random.RandomState(0).randn(100, 2)
+        tree = QuadTree(embedding)
+        self.assertTrue(tree.is_built_from(embedding))
+        self.assertTrue(tree.is_built_from(embedding.copy()))
+        self.assertFalse(tree.is_built_from(np.ascontiguousarray(embedding[:50])))
+        self.assertFalse(tree.is_built_from(np.ascontiguousarray(embedding[::-1])))
+
+        changed = embedding.copy()
+        changed[3, 1] += 1e-3
+        self.assertFalse(tree.is_built_from(changed))
+        self.assertFalse(QuadTree().is_built_from(embedding))
+
+    def test_add_points(self):
+        embedding = np.random.RandomState(0).randn(100, 2)
+        tree = QuadTree(embedding[:60])
+        tree.add_points(embedding[60:])
+
+        gradient = np.zeros_like(embedding)
+        sum_Q = _tsne.estimate_negative_gradient_bh(tree, embedding, gradient, theta=0)
+        expected_sum_Q, expected_gradient = self._exact_negative_gradient(embedding)
+        np.testing.assert_allclose(sum_Q, expected_sum_Q)
+        np.testing.assert_allclose(gradient, expected_gradient, atol=1e-12)
+
+
+class TestReferenceTreeCache(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        x = np.random.RandomState(0).randn(150, 5)
+        cls.x_train, cls.x_test = x[:100], x[100:]
+
+    def setUp(self):
+        self.embedding = TSNE(n_iter=10, early_exaggeration_iter=0).fit(self.x_train)
+
+    def _count_tree_builds(self, f):
+        with profiling.Profiler() as profiler:
+            result = f()
+        report = profiler.report()
+        builds = report["gradient.bh.quad_tree"]["count"] \
+            if "gradient.bh.quad_tree" in report else 0
+        return result, builds
+
+    def test_tree_is_built_once_per_reference(self):
+        new_embedding, builds = self._count_tree_builds(
+            lambda: self.embedding.transform(self.x_test, n_iter=20)
+        )
+        self.assertEqual(builds, 1)
+        tree = self.embedding._quad_tree
+
+        # Transforming again reuses the tree and gives the same result
+        new_embedding_cached, builds = self._count_tree_builds(
+            lambda: self.embedding.transform(self.x_test, n_iter=20)
+        )
+        self.assertEqual(builds, 0)
+        self.assertIs(self.embedding._quad_tree, tree)
+        np.testing.assert_array_equal(new_embedding, new_embedding_cached)
+
+    def test_tree_is_rebuilt_after_reference_changes(self):
+        self.embedding.transform(self.x_test, n_iter=5)
+        tree = self.embedding._quad_tree
+
+        self.embedding.optimize(5, inplace=True)
+        _, builds = self._count_tree_builds(
+            lambda: self.embedding.transform(self.x_test, n_iter=5)
+        )
+        self.assertEqual(builds, 1)
+        self.assertIsNot(self.embedding._quad_tree, tree)
+        self.assertTrue(self.embedding._quad_tree.is_built_from(np.asarray(self.embedding)))
+
+
+class TestDualTreeGradient(unittest.TestCase):
+    def _dual_negative_gradient(self, embedding, theta=0, num_threads=1, reference=None,
+                                **tree_params):
+        gradient = np.zeros_like(embedding)
+        sum_Q = _tsne.estimate_negative_gradient_bh_dual(
+            QuadTree(embedding, **tree_params), embedding, gradient, theta=theta,
+            num_threads=num_threads, pairwise_normalization=reference is None,
+            reference_tree=None if reference is None else QuadTree(reference, **tree_params),
+        )
+        return sum_Q, gradient
+
+    def test_exact_without_approximation(self):
+        random_state = np.random.RandomState(0)
+        for n_dims in (1, 2, 3):
+            embedding = random_state.randn(300, n_dims)
+            embedding[:10] = embedding[0]
+
+            expected_sum_Q, expected_gradient = TestQuadTree._exact_negative_gradient(embedding)
+            for leaf_size in (1, 8):
+                sum_Q, gradient = self._dual_negative_gradient(embedding, leaf_size=leaf_size)
+                np.testing.assert_allclose(sum_Q, expected_sum_Q)
+                np.testing.assert_allclose(gradient, expected_gradient, atol=1e-12)
+
+    def test_exact_with_reference_tree(self):
+        random_state = np.random.RandomState(0)
+        for n_dims in (1, 2, 3):
+            reference = random_state.randn(300, n_dims)
+            embedding = random_state.randn(50, n_dims)
+            # New points coinciding with reference points are not repelled by them
+            embedding[:5] = reference[:5]
+
+            sum_Q, gradient = self._dual_negative_gradient(embedding, reference=reference)
+            expected_gradient = np.zeros_like(embedding)
+            expected_sum_Q = _tsne.estimate_negative_gradient_bh(
+                QuadTree(reference), embedding, expected_gradient, theta=0,
+                pairwise_normalization=False,
+            )
+            np.testing.assert_allclose(sum_Q, expected_sum_Q)
+            np.testing.assert_allclose(gradient, expected_gradient, atol=1e-12)
+
+    def test_approximation_error(self):
+        random_state = np.random.RandomState(0)
+        for n_dims in (2, 3):
+            embedding = random_state.randn(2000, n_dims)
+            expected_sum_Q, expected_gradient = TestQuadTree._exact_negative_gradient(embedding)
+
+            errors = []
+            for theta in (0.2, 0.4, 0.8):
+                sum_Q, gradient = self._dual_negative_gradient(embedding, theta=theta)
+                self.assertAlmostEqual(sum_Q / expected_sum_Q, 1, delta=0.01)
+                errors.append(
+                    np.linalg.norm(gradient - expected_gradient) / np.linalg.norm(expected_gradient)
+                )
+            self.assertLess(errors[1], 0.02)
+            self.assertTrue(errors[0] < errors[1] < errors[2])
+
+    def test_independent_of_number_of_threads(self):
+        embedding = np.random.RandomState(0).randn(5000, 3)
+        sum_Q1, gradient1 = self._dual_negative_gradient(embedding, theta=0.4, num_threads=1)
+        sum_Q2, gradient2 = self._dual_negative_gradient(embedding, theta=0.4, num_threads=4)
+        self.assertEqual(sum_Q1, sum_Q2)
+        np.testing.assert_array_equal(gradient1, gradient2)
+
+    def test_degenerate_inputs(self):
+        for embedding in (np.zeros((1, 2)), np.ones((5, 2)), np.zeros((0, 2))):
+            sum_Q, gradient = self._dual_negative_gradient(embedding, theta=0.4)
+            self.assertEqual(sum_Q, 0)
+            np.testing.assert_array_equal(gradient, 0)
+
+    def test_too_many_dimensions(self):
+        embedding = np.random.RandomState(0).randn(50, 4)
+        with self.assertRaises(ValueError):
+            self._dual_negative_gradient(embedding, theta=0.4)
+
+        x = np.random.RandomState(0).randn(50, 5)
+        with self.assertRaises(ValueError):
+            TSNE(
+                n_components=4, neighbors="exact", negative_gradient_method="bh-dual",
+            ).fit(x)
+
+    def test_tsne_optimization(self):
+        x = np.random.RandomState(0).randn(150, 5)
+        x_train, x_test = x[:100], x[100:]
+        for n_components in (2, 3):
+            embedding = TSNE(
+                negative_gradient_method="bh-dual", n_components=n_components,
+                n_iter=100, random_state=0,
+            ).fit(x_train)
+            self.assertTrue(np.isfinite(embedding.kl_divergence))
+
+            # Without approximation, both traversals compute the same gradient
+            P = embedding.affinities.P
+            kl_bh, gradient_bh = kl_divergence_bh(
+                np.array(embedding), P, dof=1, bh_params={"theta": 0},
+                should_eval_error=True,
+            )
+            kl, gradient = kl_divergence_bh_dual(
+                np.array(embedding), P, dof=1, bh_params={"dual_tree_theta": 0},
+                should_eval_error=True,
+            )
+            self.assertAlmostEqual(kl, kl_bh)
+            np.testing.assert_allclose(gradient, gradient_bh, atol=1e-12)
+
+            new_embedding = embedding.transform(x_test, n_iter=20)
+            self.assertEqual(new_embedding.shape, (50, n_components))
+            self.assertTrue(np.all(np.isfinite(new_embedding)))
+
+
+class TestThetaSchedules(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        x = np.random.RandomState(0).randn(300, 4)
+        cls.embedding = TSNE(perplexity=10, random_state=0).prepare_initial(x)
+
+    def test_piecewise(self):
+        schedule = schedules.Piecewise([(100, 0.5), (0, 0.8), (200, 0.3)])
+        self.assertEqual([schedule(i, 300) for i in (0, 99, 100, 250)], [0.8, 0.8, 0.5, 0.3])
+        self.assertEqual(schedules.Piecewise([(10, 0.5)])(0, 100), 0.5)
+        with self.assertRaises(ValueError):
+            schedules.Piecewise([])
+
+    def test_linear(self):
+        schedule = schedules.Linear(0.8, 0.4)
+        self.assertEqual(schedule(0, 5), 0.8)
+        self.assertAlmostEqual(schedule(2, 5), 0.6)
+        self.assertAlmostEqual(schedule(4, 5), 0.4)
+
+    def test_schedule_evaluated_every_iteration(self):
+        for method in ("bh", "bh-dual"):
+            param = "theta" if method == "bh" else "dual_tree_theta"
+            schedule = MagicMock(return_value=0.5)
+            self.embedding.optimize(
+                20, negative_gradient_method=method, **{param: schedule}
+            )
+            called = [c[0] for c in schedule.call_args_list]
+            # The value for the first iteration is also used to compute the
+            # final error
+            self.assertEqual(called[0], (0, 20))
+            self.assertEqual(called[1:], [(i, 20) for i in range(20)])
+
+    def test_scheduled_gradient(self):
+        # A schedule producing a constant value computes the same gradients
+        embedding1 = self.embedding.optimize(20, theta=0.7)
+        embedding2 = self.embedding.optimize(20, theta=schedules.Piecewise([(0, 0.7)]))
+        np.testing.assert_array_equal(embedding1, embedding2)
+        self.assertEqual(embedding1.kl_divergence, embedding2.kl_divergence)
+
+    def test_adaptive_theta(self):
+        for method in ("bh", "bh-dual"):
+            param = "theta" if method == "bh" else "dual_tree_theta"
+            for target_error in (1e-4, 0.05):
+                schedule = schedules.AdaptiveTheta(
+                    target_error=target_error, every_iters=5, random_state=0
+                )
+                self.embedding.optimize(
+                    50, negative_gradient_method=method, **{param: schedule}
+                )
+                self.assertEqual([e[0] for e in schedule.errors], list(range(0, 50, 5)))
+                if target_error < 0.01:
+                    self.assertLess(schedule.theta, 0.5)
+                else:
+                    self.assertGreater(schedule.theta, 0.5)
+
+    def test_adaptive_theta_with_reference(self):
+        x = np.random.RandomState(1).randn(20, 4)
+        schedule = schedules.AdaptiveTheta(every_iters=5, random_state=0)
+        partial_embedding = self.embedding.prepare_partial(x, k=10)
+        partial_embedding.optimize(20, theta=schedule)
+        self.assertEqual(len(schedule.errors), 4)
+
+
+class TestExactGradient(unittest.TestCase):
+    @staticmethod
+    def _dense_negative_gradient(embedding, reference=None, dof=1):
+        pairwise = reference is None
+        if pairwise:
+            reference = embedding
+        diff = embedding[:, np.newaxis] - reference[np.newaxis]
+        q = (dof / (dof + np.sum(diff ** 2, axis=2))) ** ((dof + 1) / 2)
+        if pairwise:
+            np.fill_diagonal(q, 0)
+        sum_Qi = np.sum(q, axis=1)
+        sum_Q = np.sum(sum_Qi)
+        gradient = -np.sum((q ** 2)[:, :, np.newaxis] * diff, axis=1)
+        return sum_Q, gradient / (sum_Q if pairwise else sum_Qi[:, np.newaxis])
+
+    def _exact_negative_gradient(self, embedding, reference=None, **kwargs):
+        gradient = np.zeros_like(embedding)
+        sum_Q = _tsne.estimate_negative_gradient_exact(
+            embedding, embedding if reference is None else reference, gradient,
+            pairwise_normalization=reference is None, **kwargs,
+        )
+        return sum_Q, gradient
+
+    def test_matches_dense_computation(self):
+        random_state = np.random.RandomState(0)
+        # Several tiles, the last one partially filled
+        for n_dims in (1, 2, 3, 5):
+            embedding = random_state.randn(601, n_dims)
+            # Unlike the approximations, duplicates repel each other
+            embedding[:10] = embedding[0]
+            for dof in (1, 0.5, 0.7, 2):
+                sum_Q, gradient = self._exact_negative_gradient(embedding, dof=dof)
+                expected_sum_Q, expected_gradient = self._dense_negative_gradient(
+                    embedding, dof=dof
+                )
+                np.testing.assert_allclose(sum_Q, expected_sum_Q)
+                np.testing.assert_allclose(gradient, expected_gradient, atol=1e-14)
+
+    def test_with_reference(self):
+        random_state = np.random.RandomState(0)
+        for n_dims in (1, 2, 3):
+            reference = random_state.randn(700, n_dims)
+            embedding = random_state.randn(300, n_dims)
+            embedding[:5] = reference[:5]
+            sum_Q, gradient = self._exact_negative_gradient(embedding, reference, dof=1.5)
+            expected_sum_Q, expected_gradient = self._dense_negative_gradient(
+                embedding, reference, dof=1.5
+            )
+            np.testing.assert_allclose(sum_Q, expected_sum_Q)
+            np.testing.assert_allclose(gradient, expected_gradient, atol=1e-14)
+
+    def test_independent_of_number_of_threads(self):
+        embedding = np.random.RandomState(0).randn(1000, 2)
+        sum_Q1, gradient1 = self._exact_negative_gradient(embedding, num_threads=1)
+        sum_Q2, gradient2 = self._exact_negative_gradient(embedding, num_threads=4)
+        # The threads accumulate the forces separately, which only changes
+        # the order of the summation
+        np.testing.assert_allclose(sum_Q1, sum_Q2, rtol=1e-12)
+        np.testing.assert_allclose(gradient1, gradient2, rtol=1e-10, atol=1e-16)
+
+    def test_reuses_thread_buffers(self):
+        embedding = np.random.RandomState(0).randn(700, 2)
+        expected_sum_Q, expected_gradient = self._exact_negative_gradient(
+            embedding, num_threads=2
+        )
+        # The buffers are cleared before use, so leftovers of previous calls
+        # do not leak into the gradient
+        thread_gradient = np.full((2, 700, 2), np.nan)
+        for _ in range(2):
+            sum_Q, gradient = self._exact_negative_gradient(
+                embedding, num_threads=2, thread_gradient=thread_gradient
+            )
+            np.testing.assert_allclose(sum_Q, expected_sum_Q, rtol=1e-12)
+            np.testing.assert_allclose(gradient, expected_gradient, rtol=1e-10, atol=1e-16)
+
+    def test_degenerate_inputs(self):
+        for embedding in (np.zeros((1, 2)), np.zeros((0, 2))):
+            sum_Q, gradient = self._exact_negative_gradient(embedding)
+            self.assertEqual(sum_Q, 0)
+            np.testing.assert_array_equal(gradient, 0)
+
+    def test_kl_divergence(self):
+        x = np.random.RandomState(0).randn(300, 4)
+        embedding = TSNE(perplexity=10, random_state=0).prepare_initial(x)
+        embedding = embedding.optimize(50)
+        P = embedding.affinities.P
+
+        kl, _ = kl_divergence_all_pairs(np.array(embedding), P, dof=1, should_eval_error=True)
+        expected_kl = kl_divergence.kl_divergence_exact(
+            np.ascontiguousarray(P.toarray()), np.array(embedding)
+        )
+        self.assertAlmostEqual(kl, expected_kl)
+
+    def test_tsne_optimization(self):
+        x = np.random.RandomState(0).randn(150, 5)
+        x_train, x_test = x[:100], x[100:]
+        for n_components in (1, 2, 3):
+            embedding = TSNE(
+                negative_gradient_method="exact", n_components=n_components,
+                n_iter=100, random_state=0,
+            ).fit(x_train)
+            self.assertTrue(np.isfinite(embedding.kl_divergence))
+
+            new_embedding = embedding.transform(x_test, n_iter=20)
+            self.assertEqual(new_embedding.shape, (50, n_components))
+            self.assertTrue(np.all(np.isfinite(new_embedding)))
+
+
+class TestExactGradient1D(unittest.TestCase):
+    dense_negative_gradient = staticmethod(TestExactGradient._dense_negative_gradient)
+
+    @staticmethod
+    def _exact_negative_gradient(embedding, reference=None, **kwargs):
+        gradient = np.zeros_like(embedding)
+        sum_Q = _tsne.estimate_negative_gradient_exact_1d(
+            embedding, embedding if reference is None else reference, gradient,
+            pairwise_normalization=reference is None, **kwargs,
+        )
+        return sum_Q, gradient
+
+    def test_matches_dense_computation(self):
+        random_state = np.random.RandomState(0)
+        # Points much closer and much further apart than the scale of the kernel
+        for n_samples, scale in [(5, 1), (1000, 1), (2000, 0.01), (2000, 100), (2000, 1e4)]:
+            embedding = random_state.randn(n_samples) * scale
+            # Like in the exact method, duplicates repel each other
+            embedding[:3] = embedding[0]
+            sum_Q, gradient = self._exact_negative_gradient(embedding)
+            expected_sum_Q, expected_gradient = self.dense_negative_gradient(
+                embedding[:, np.newaxis]
+            )
+            np.testing.assert_allclose(sum_Q, expected_sum_Q, rtol=1e-12)
+            np.testing.assert_allclose(
+                gradient, expected_gradient.ravel(), rtol=0,
+                atol=1e-11 * np.max(np.abs(expected_gradient)),
+            )
+
+    def test_duplicates_and_clusters(self):
+        random_state = np.random.RandomState(0)
+        for embedding in (
+            # Leaves holding only duplicates interact with each other
+            random_state.randint(0, 2, 130).astype(float),
+            random_state.randint(0, 20, 3000).astype(float),
+            # Tight clusters far apart from each other
+            np.concatenate([c + 1e-3 * random_state.randn(1000) for c in (0, 5, 1e5)]),
+        ):
+            sum_Q, gradient = self._exact_negative_gradient(embedding)
+            expected_sum_Q, expected_gradient = self.dense_negative_gradient(
+                embedding[:, np.newaxis]
+            )
+            np.testing.assert_allclose(sum_Q, expected_sum_Q, rtol=1e-12)
+            np.testing.assert_allclose(
+                gradient, expected_gradient.ravel(), rtol=0,
+                atol=1e-11 * np.max(np.abs(expected_gradient)),
+            )
+
+    def test_with_reference(self):
+        random_state = np.random.RandomState(0)
+        reference = random_state.randn(3000) * 20
+        embedding = random_state.randn(500) * 30
+        embedding[:5] = reference[:5]
+        sum_Q, gradient = self._exact_negative_gradient(embedding, reference, num_threads=2)
+        expected_sum_Q, expected_gradient = self.dense_negative_gradient(
+            embedding[:, np.newaxis], reference[:, np.newaxis]
+        )
+        np.testing.assert_allclose(sum_Q, expected_sum_Q, rtol=1e-12)
+        np.testing.assert_allclose(
+            gradient, expected_gradient.ravel(), rtol=0,
+            atol=1e-11 * np.max(np.abs(expected_gradient)),
+        )
+
+    def test_reference_tree_is_built_once(self):
+        x = np.random.RandomState(0).randn(200, 5)
+        embedding = TSNE(
+            n_components=1, n_iter=10, early_exaggeration_iter=0,
+            negative_gradient_method="exact",
+        ).fit(x[:150])
+
+        with profiling.Profiler() as profiler:
+            new_embedding = embedding.transform(x[150:], n_iter=20)
+        self.assertEqual(profiler.report()["gradient.exact.interval_tree"]["count"], 1)
+
+        # Transforming again reuses the tree and gives the same result
+        with profiling.Profiler() as profiler:
+            new_embedding_cached = embedding.transform(x[150:], n_iter=20)
+        self.assertNotIn("gradient.exact.interval_tree", profiler.report())
+        np.testing.assert_array_equal(new_embedding, new_embedding_cached)
+
+    def test_independent_of_number_of_threads(self):
+        embedding = np.random.RandomState(0).randn(20000) * 100
+        sum_Q1, gradient1 = self._exact_negative_gradient(embedding, num_threads=1)
+        sum_Q2, gradient2 = self._exact_negative_gradient(embedding, num_threads=4)
+        np.testing.assert_allclose(sum_Q1, sum_Q2, rtol=1e-12)
+        np.testing.assert_allclose(gradient1, gradient2, rtol=1e-10, atol=1e-16)
+
+    def test_degenerate_inputs(self):
+        for embedding in (np.zeros(1), np.zeros(0)):
+            sum_Q, gradient = self._exact_negative_gradient(embedding)
+            self.assertEqual(sum_Q, 0)
+            np.testing.assert_array_equal(gradient, 0)
+
+    def test_used_by_exact_method(self):
+        embedding = np.random.RandomState(0).randn(500, 1) * 10
+        with patch("openTSNE._tsne.estimate_negative_gradient_exact_1d",
+                   wraps=_tsne.estimate_negative_gradient_exact_1d) as exact_1d:
+            sum_Q = openTSNE.tsne._negative_gradient_exact(
+                embedding, np.zeros_like(embedding), dof=1
+            )
+        exact_1d.assert_called_once()
+        expected_sum_Q, _ = TestExactGradient._dense_negative_gradient(embedding)
+        np.testing.assert_allclose(sum_Q, expected_sum_Q, rtol=1e-12)
+
+        # Other kernels sum over all pairs of points
+        with patch("openTSNE._tsne.estimate_negative_gradient_exact_1d") as exact_1d:
+            openTSNE.tsne._negative_gradient_exact(
+                embedding, np.zeros_like(embedding), dof=0.5
+            )
+        exact_1d.assert_not_called()
+
+
+class TestAutoNegativeGradientMethod(unittest.TestCase):
+    def test_method_choice(self):
+        choose = openTSNE.tsne._auto_negative_gradient_method
+        self.assertEqual(choose(500, 2), "exact")
+        self.assertEqual(choose(1999, 3, dof=0.5), "exact")
+        self.assertEqual(choose(5000, 2), "bh")
+        # One dimensional embeddings have a dedicated exact method
+        self.assertEqual(choose(50000, 1), "exact")
+        self.assertEqual(choose(50000, 1, n_reference_samples=100000), "exact")
+        self.assertEqual(choose(50000, 1, dof=0.5), "bh")
+        self.assertEqual(choose(50000, 2), "fft")
+        # Interpolation supports neither three dimensions nor other kernels
+        self.assertEqual(choose(50000, 3), "bh")
+        self.assertEqual(choose(50000, 2, dof=0.5), "bh")
+        # A few points can be added to a large reference embedding exactly
+        self.assertEqual(choose(10, 2, n_reference_samples=100000), "exact")
+        self.assertEqual(choose(100, 2, n_reference_samples=100000), "bh")
+
+    def test_chosen_per_optimization_call(self):
+        x = np.random.RandomState(0).randn(150, 4)
+        x_train, x_test = x[:100], x[100:]
+
+        with self.assertLogs(openTSNE.tsne.log, level="INFO") as logs:
+            embedding = TSNE(
+                negative_gradient_method="auto", early_exaggeration_iter=10,
+                n_iter=10, random_state=0,
+            ).fit(x_train)
+        messages = [m for m in logs.output if "negative gradient method" in m]
+        # Once for every phase
+        self.assertEqual(len(messages), 2)
+        self.assertTrue(all("`exact`" in m for m in messages))
+
+        with patch("openTSNE.tsne._auto_negative_gradient_method",
+                   return_value="bh") as choose:
+            embedding.transform(x_test, n_iter=10)
+        choose.assert_called_once_with(50, 2, dof=1, n_reference_samples=100)
+        self.assertEqual(embedding.gradient_descent_params["negative_gradient_method"], "auto")